@@ -5,6 +5,7 @@ Data: 2025
 """
 
 from pathlib import Path
+import importlib.util
 import os
 
 # ============================================================
@@ -91,6 +92,7 @@ MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "lab.middleware.RenovacaoSessaoMiddleware",
     "django.middleware.locale.LocaleMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -135,13 +137,92 @@ AUTH_PASSWORD_VALIDATORS = [
 # ============================================================
 # CACHE
 # ============================================================
-CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "LOCATION": "analinklab-cache",
+# Cache partilhada por todos os workers do gunicorn da mesma máquina: em
+# ficheiros (CACHE_DIR) por omissão, sem serviço externo; em Redis se
+# REDIS_URL estiver definido e o pacote redis instalado.
+REDIS_URL = os.environ.get("REDIS_URL", "")
+if REDIS_URL and importlib.util.find_spec("redis") is not None:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+            "KEY_PREFIX": "analinklab",
+        }
     }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.environ.get("CACHE_DIR", str(BASE_DIR / "var" / "cache")),
+            "KEY_PREFIX": "analinklab",
+            "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("CACHE_MAX_ENTRIES", 5000))},
+        }
+    }
+
+# Validade (segundos) por classe de dados; ver lab.utils.cache_partilhada.
+CACHE_TTL = {
+    "catalogo": 24 * 3600,   # catálogo de exames (também invalidado por versão)
+    "contagens": 60,         # totais das listagens do admin com filtros
+    "pdf": 7 * 24 * 3600,    # PDFs na cache de PDFs (além do limite MAX_BYTES)
+    "historico": 24 * 3600,  # resumo do histórico por paciente (também invalidado por versão)
 }
 
+# ============================================================
+# API REST
+# ============================================================
+REST_FRAMEWORK = {
+    "DEFAULT_PAGINATION_CLASS": "lab.pagination.CursorPaginacao",
+    "PAGE_SIZE": int(os.environ.get("API_PAGE_SIZE", 50)),
+    "MAX_PAGE_SIZE": int(os.environ.get("API_MAX_PAGE_SIZE", 500)),
+}
+
+# ============================================================
+# CACHE DO CATÁLOGO DE EXAMES (lab.utils.catalogo)
+# ============================================================
+# Cada processo revalida a sua cópia contra a versão partilhada no máximo
+# a cada VERIFICAR_S segundos; a validade na cache partilhada é CACHE_TTL["catalogo"].
+CATALOGO_CACHE = {
+    "VERIFICAR_S": 2,
+}
+
+# ============================================================
+# CACHE DE PDFs
+# ============================================================
+# Os PDFs gerados ficam em MEDIA_ROOT/pdf_cache; para outro backend defina
+# STORAGES["pdf_cache"]. Acima de MAX_BYTES os menos usados são removidos.
+PDF_CACHE = {
+    "MAX_BYTES": int(os.environ.get("PDF_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+}
+
+# ============================================================
+# RENDERIZAÇÃO DE PDFs EM SEGUNDO PLANO
+# ============================================================
+PDF_RENDER = {
+    "WORKERS": int(os.environ.get("PDF_RENDER_WORKERS", 2)),
+    "MAX_FILA": int(os.environ.get("PDF_RENDER_MAX_FILA", 20)),
+    "TIMEOUT": int(os.environ.get("PDF_RENDER_TIMEOUT", 120)),
+    "DIRETORIO": MEDIA_ROOT / "pdf_jobs",
+    "RETENCAO_HORAS": 24,
+    # requisições num único PDF juntado (montado em memória); lotes maiores só em ZIP
+    "MAX_PDF_UNICO": int(os.environ.get("PDF_RENDER_MAX_PDF_UNICO", 50)),
+}
+
+# ============================================================
+# EXPORTAÇÃO PARA ANÁLISE (Parquet / Arrow, requer pyarrow)
+# ============================================================
+# manage.py export_results escreve em DIRETORIO (particionado por mês e
+# setor); CHUNK_SIZE linhas lidas de cada vez do cursor da base de dados.
+EXPORTACAO = {
+    "DIRETORIO": os.environ.get("EXPORTACAO_DIR", str(BASE_DIR / "var" / "exportacoes")),
+    "CHUNK_SIZE": int(os.environ.get("EXPORTACAO_CHUNK_SIZE", 5000)),
+}
+
+# ============================================================
+# AUDITORIA
+# ============================================================
+# Grava o histórico de operações numa thread de segundo plano (ver lab/utils/auditoria.py)
+AUDITORIA_EM_SEGUNDO_PLANO = os.environ.get("AUDITORIA_EM_SEGUNDO_PLANO", "False") == "True"
+
 # ============================================================
 # LOGGING
 # ============================================================
@@ -197,13 +278,18 @@ TEMPLATES = [
 # ============================================================
 # SESSÕES
 # ============================================================
-SESSION_ENGINE = "django.contrib.sessions.backends.db"
+# Leitura pela cache partilhada, escrita na cache e na base de dados só
+# quando a sessão muda ou a renovação é devida (lab.middleware).
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
 SESSION_COOKIE_NAME = "analinklab_session"
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SAMESITE = "Lax"
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
-SESSION_SAVE_EVERY_REQUEST = True
-SESSION_COOKIE_AGE = 30 * 60  # 30 minutos
+SESSION_SAVE_EVERY_REQUEST = False
+SESSION_COOKIE_AGE = 30 * 60  # 30 minutos de inactividade
+# Renova a validade no máximo uma vez a cada N segundos (0 = em todos os pedidos).
+# Sessões expiradas: python manage.py limpar_sessoes (cron, por exemplo de hora a hora).
+SESSAO_RENOVAR_APOS = int(os.environ.get("SESSAO_RENOVAR_APOS", 5 * 60))
 
 # ============================================================
 # JAZZMIN SETTINGS — AnaBioLink
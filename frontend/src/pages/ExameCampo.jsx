@@ -4,6 +4,7 @@ import { getExameCampos, deleteExameCampo } from '../services/api';
 
 export default function ExameCampo() {
     const [exameCampos, setExameCampos] = useState([]);
+    const [next, setNext] = useState(null);
 
     useEffect(() => {
         fetchData();
@@ -11,7 +12,14 @@ export default function ExameCampo() {
 
     const fetchData = async () => {
         const data = await getExameCampos();
-        setExameCampos(data);
+        setExameCampos(data.results);
+        setNext(data.next);
+    };
+
+    const loadMore = async () => {
+        const data = await getExameCampos(next);
+        setExameCampos(prev => [...prev, ...data.results]);
+        setNext(data.next);
     };
 
     const handleDelete = async (id) => {
@@ -46,6 +54,7 @@ export default function ExameCampo() {
                     ))}
                 </tbody>
             </table>
+            {next && <button onClick={loadMore}>Carregar mais</button>}
         </div>
     );
 }
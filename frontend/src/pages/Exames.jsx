@@ -4,6 +4,7 @@ import { getExames, deleteExame } from '../services/api';
 
 export default function Exames() {
     const [exames, setExames] = useState([]);
+    const [next, setNext] = useState(null);
 
     useEffect(() => {
         fetchData();
@@ -11,7 +12,14 @@ export default function Exames() {
 
     const fetchData = async () => {
         const data = await getExames();
-        setExames(data);
+        setExames(data.results);
+        setNext(data.next);
+    };
+
+    const loadMore = async () => {
+        const data = await getExames(next);
+        setExames(prev => [...prev, ...data.results]);
+        setNext(data.next);
     };
 
     const handleDelete = async (id) => {
@@ -50,6 +58,7 @@ export default function Exames() {
                     ))}
                 </tbody>
             </table>
+            {next && <button onClick={loadMore}>Carregar mais</button>}
         </div>
     );
 }
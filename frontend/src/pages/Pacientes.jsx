@@ -3,13 +3,21 @@ import { getPacientes, createPaciente, deletePaciente } from '../services/api';
 
 export default function Pacientes() {
     const [pacientes, setPacientes] = useState([]);
+    const [next, setNext] = useState(null);
     const [nome, setNome] = useState("");
 
     useEffect(() => { loadPacientes(); }, []);
 
     const loadPacientes = async () => {
         const data = await getPacientes();
-        setPacientes(data);
+        setPacientes(data.results);
+        setNext(data.next);
+    };
+
+    const loadMore = async () => {
+        const data = await getPacientes(next);
+        setPacientes(prev => [...prev, ...data.results]);
+        setNext(data.next);
     };
 
     const handleCreate = async () => {
@@ -46,6 +54,7 @@ export default function Pacientes() {
                     ))}
                 </tbody>
             </table>
+            {next && <button onClick={loadMore}>Carregar mais</button>}
         </div>
     );
 }
@@ -4,6 +4,7 @@ import { getRequisicoes, deleteRequisicao, gerarPdfRequisicao } from '../service
 
 export default function Requisicoes() {
     const [requisicoes, setRequisicoes] = useState([]);
+    const [next, setNext] = useState(null);
 
     useEffect(() => {
         fetchData();
@@ -11,7 +12,14 @@ export default function Requisicoes() {
 
     const fetchData = async () => {
         const data = await getRequisicoes();
-        setRequisicoes(data);
+        setRequisicoes(data.results);
+        setNext(data.next);
+    };
+
+    const loadMore = async () => {
+        const data = await getRequisicoes(next);
+        setRequisicoes(prev => [...prev, ...data.results]);
+        setNext(data.next);
     };
 
     const handleDelete = async (id) => {
@@ -49,6 +57,7 @@ export default function Requisicoes() {
                     ))}
                 </tbody>
             </table>
+            {next && <button onClick={loadMore}>Carregar mais</button>}
         </div>
     );
 }
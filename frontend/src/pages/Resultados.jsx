@@ -4,6 +4,7 @@ import { getResultados, deleteResultado, gerarPdfResultado } from '../services/a
 
 export default function Resultados() {
     const [resultados, setResultados] = useState([]);
+    const [next, setNext] = useState(null);
 
     useEffect(() => {
         fetchData();
@@ -11,7 +12,14 @@ export default function Resultados() {
 
     const fetchData = async () => {
         const data = await getResultados();
-        setResultados(data);
+        setResultados(data.results);
+        setNext(data.next);
+    };
+
+    const loadMore = async () => {
+        const data = await getResultados(next);
+        setResultados(prev => [...prev, ...data.results]);
+        setNext(data.next);
     };
 
     const handleDelete = async (id) => {
@@ -49,6 +57,7 @@ export default function Resultados() {
                     ))}
                 </tbody>
             </table>
+            {next && <button onClick={loadMore}>Carregar mais</button>}
         </div>
     );
 }
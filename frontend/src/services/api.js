@@ -1,8 +1,15 @@
 import axios from 'axios';
 const API_URL = "http://localhost:8000/api";
 
+// As listagens são paginadas por cursor: cada chamada devolve { next, previous, results }.
+// Para a página seguinte, passe o `next` recebido como cursor.
+const getPagina = async (url, cursor = null, pageSize = null) => {
+    const params = !cursor && pageSize ? { page_size: pageSize } : {};
+    return axios.get(cursor || url, { params }).then(res => res.data);
+};
+
 // ----------------- PACIENTES -----------------
-export const getPacientes = async () => axios.get(`${API_URL}/pacientes/`).then(res => res.data);
+export const getPacientes = async (cursor = null, pageSize = null) => getPagina(`${API_URL}/pacientes/`, cursor, pageSize);
 export const createPaciente = async (data) => axios.post(`${API_URL}/pacientes/`, data).then(res => res.data);
 export const updatePaciente = async (id, data) => axios.put(`${API_URL}/pacientes/${id}/`, data).then(res => res.data);
 export const deletePaciente = async (id) => axios.delete(`${API_URL}/pacientes/${id}/`);
@@ -17,19 +24,19 @@ export const gerarPdfPaciente = async (id) => {
 };
 
 // ----------------- EXAMES -----------------
-export const getExames = async () => axios.get(`${API_URL}/exames/`).then(res => res.data);
+export const getExames = async (cursor = null, pageSize = null) => getPagina(`${API_URL}/exames/`, cursor, pageSize);
 export const createExame = async (data) => axios.post(`${API_URL}/exames/`, data).then(res => res.data);
 export const updateExame = async (id, data) => axios.put(`${API_URL}/exames/${id}/`, data).then(res => res.data);
 export const deleteExame = async (id) => axios.delete(`${API_URL}/exames/${id}/`);
 
 // ----------------- EXAME CAMPOS -----------------
-export const getExameCampos = async () => axios.get(`${API_URL}/examecampos/`).then(res => res.data);
+export const getExameCampos = async (cursor = null, pageSize = null) => getPagina(`${API_URL}/examecampos/`, cursor, pageSize);
 export const createExameCampo = async (data) => axios.post(`${API_URL}/examecampos/`, data).then(res => res.data);
 export const updateExameCampo = async (id, data) => axios.put(`${API_URL}/examecampos/${id}/`, data).then(res => res.data);
 export const deleteExameCampo = async (id) => axios.delete(`${API_URL}/examecampos/${id}/`);
 
 // ----------------- REQUISIÇÕES -----------------
-export const getRequisicoes = async () => axios.get(`${API_URL}/requisicoes/`).then(res => res.data);
+export const getRequisicoes = async (cursor = null, pageSize = null) => getPagina(`${API_URL}/requisicoes/`, cursor, pageSize);
 export const createRequisicao = async (data) => axios.post(`${API_URL}/requisicoes/`, data).then(res => res.data);
 export const updateRequisicao = async (id, data) => axios.put(`${API_URL}/requisicoes/${id}/`, data).then(res => res.data);
 export const deleteRequisicao = async (id) => axios.delete(`${API_URL}/requisicoes/${id}/`);
@@ -44,7 +51,7 @@ export const gerarPdfRequisicao = async (id) => {
 };
 
 // ----------------- RESULTADOS -----------------
-export const getResultados = async () => axios.get(`${API_URL}/resultados/`).then(res => res.data);
+export const getResultados = async (cursor = null, pageSize = null) => getPagina(`${API_URL}/resultados/`, cursor, pageSize);
 export const createResultado = async (data) => axios.post(`${API_URL}/resultados/`, data).then(res => res.data);
 export const updateResultado = async (id, data) => axios.put(`${API_URL}/resultados/${id}/`, data).then(res => res.data);
 export const deleteResultado = async (id) => axios.delete(`${API_URL}/resultados/${id}/`);
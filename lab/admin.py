@@ -1,25 +1,59 @@
 from typing import Any, Optional, Iterable
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django import forms
-from django.http import HttpRequest, HttpResponse
-from django.db.models import QuerySet
+from django.http import FileResponse, HttpRequest
+from django.http.response import HttpResponseBase
+from django.db.models import Count, OuterRef, Q, QuerySet, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.text import smart_split, unescape_string_literal
 
-from .models import Paciente, Exame, ExameCampo, RequisicaoAnalise, ResultadoItem
+from .models import Paciente, Exame, ExameCampo, RequisicaoAnalise, ResultadoItem, ResumoDiarioExame
 from .forms import RequisicaoAnaliseForm
-from .utils.pdf_generator import gerar_pdf_requisicao, gerar_pdf_resultados
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.dateparse import parse_date
+from django.utils.html import format_html, format_html_join
+
+from .pagination import ContagemEstimadaPaginator
+from .utils import pdf_cache, pdf_jobs, pdf_lote, pesquisa_pacientes, resumos
+from .utils.validacao import validar_requisicoes
 
 
 # =====================================
 # PACIENTE ADMIN
 # =====================================
+class PacienteChangeList(ChangeList):
+    def get_ordering_field_columns(self):
+        # com pesquisa e sem coluna escolhida a ordem é a relevância, não a do Meta
+        if self.query and ORDER_VAR not in self.params:
+            return {}
+        return super().get_ordering_field_columns()
+
+
 @admin.register(Paciente)
 class PacienteAdmin(admin.ModelAdmin):
     list_display = ('id_custom', 'nome', 'numero_id', 'idade', 'genero', 'proveniencia', 'data_registo_formatada')
-    search_fields = ('id_custom', 'nome', 'numero_id', 'contacto', 'proveniencia')
+    # a pesquisa é feita por lab.utils.pesquisa_pacientes (ver get_search_results)
+    search_fields = ('id_custom', 'nome', 'numero_id', 'contacto')
     list_filter = ('genero', 'proveniencia', 'data_registo')
     readonly_fields = ('data_registo', 'idade')
     list_per_page = 350
 
+    def get_search_results(self, request: HttpRequest, queryset: QuerySet[Paciente], search_term: str):
+        """
+        Pesquisa indexada e ordenada por relevância (no autocomplete e na
+        listagem). Na listagem, uma coluna escolhida para ordenar (?o=)
+        substitui a relevância.
+        """
+        resultados = pesquisa_pacientes.pesquisar(search_term, queryset)
+        if search_term and ORDER_VAR in request.GET:
+            resultados = resultados.order_by(*queryset.query.order_by)
+        return resultados, False
+
+    def get_changelist(self, request: HttpRequest, **kwargs):
+        return PacienteChangeList
+
     def idade(self, obj: Paciente) -> int:
         return obj.idade()
     idade.short_description = "Idade"
@@ -98,15 +132,22 @@ class RequisicaoAnaliseAdmin(admin.ModelAdmin):
     form = RequisicaoAnaliseForm
     inlines = [ResultadoItemInline]
 
-    list_display = ('id_custom', 'paciente', 'numero_id', 'status', 'analista', 'created_at')
-    search_fields = ('id_custom', 'paciente__nome', 'paciente__numero_id', 'exames__nome', 'status')
+    list_display = ('id_custom', 'paciente', 'numero_id', 'n_exames', 'progresso', 'status', 'analista', 'created_at')
+    list_select_related = ('paciente', 'analista')
+    # exames__nome é pesquisado por subconsulta em get_search_results (sem JOIN nem DISTINCT)
+    search_fields = ('id_custom', 'paciente__nome', 'paciente__numero_id', 'status')
     list_filter = ('status', 'analista', 'created_at')
     ordering = ['-created_at']
     list_per_page = 500
+    paginator = ContagemEstimadaPaginator
+    show_full_result_count = False
 
     autocomplete_fields = ('paciente', 'analista')
     readonly_fields = ('created_at', 'numero_id', 'updated_at', 'analista', 'status', 'id_custom')
-    actions = ['gerar_pdf_requisicao', 'gerar_pdf_resultados']
+    actions = [
+        'gerar_pdf_requisicao', 'gerar_pdf_resultados', 'exportar_resultados_zip',
+        'juntar_resultados_pdf', 'preparar_pdfs_resultados', 'validar_resultados',
+    ]
 
     fieldsets = (
         ("Informações Básicas", {"fields": ("paciente", 'analista',)}),
@@ -117,10 +158,41 @@ class RequisicaoAnaliseAdmin(admin.ModelAdmin):
         css = {"all": ["django_select2/django_select2.css"]}
         js = ["django_select2/django_select2.js"]
 
+    def get_queryset(self, request: HttpRequest) -> QuerySet[RequisicaoAnalise]:
+        exames = RequisicaoAnalise.exames.through.objects.filter(
+            requisicaoanalise=OuterRef('pk')
+        ).order_by().values('requisicaoanalise').annotate(n=Count('id')).values('n')
+        return super().get_queryset(request).annotate(n_exames=Coalesce(Subquery(exames), 0))
+
+    def get_search_results(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise], search_term: str):
+        """Pesquisa como o admin, acrescentando o nome dos exames por subconsulta."""
+        if not search_term:
+            return queryset, False
+        Ligacao = RequisicaoAnalise.exames.through
+        for termo in smart_split(search_term):
+            if termo.startswith(('"', "'")) and termo[0] == termo[-1]:
+                termo = unescape_string_literal(termo)
+            condicao = Q(id__in=Ligacao.objects.filter(exame__nome__icontains=termo).values('requisicaoanalise_id'))
+            for campo in self.get_search_fields(request):
+                condicao |= Q(**{f'{campo}__icontains': termo})
+            queryset = queryset.filter(condicao)
+        return queryset, False
+
     def numero_id(self, obj):
         return obj.paciente.numero_id
     numero_id.short_description = "Número ID"
 
+    def n_exames(self, obj):
+        return obj.n_exames
+    n_exames.short_description = "Exames"
+    n_exames.admin_order_field = 'n_exames'
+
+    def progresso(self, obj):
+        # contadores materializados: sem agregação sobre os resultados
+        return f"{obj.n_validados}/{obj.n_resultados}"
+    progresso.short_description = "Validados"
+    progresso.admin_order_field = 'n_validados'
+
     def save_model(self, request, obj, form, change):
         if not obj.analista:
             obj.analista = request.user
@@ -133,24 +205,99 @@ class RequisicaoAnaliseAdmin(admin.ModelAdmin):
     # ==========================
     # AÇÕES DE PDF
     # ==========================
-    def gerar_pdf_requisicao(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> Optional[HttpResponse]:
-        if queryset.count() != 1:
-            self.message_user(request, "Selecione apenas uma requisição.", level='warning')
-            return None
-        req = queryset.first()
-        pdf_content, filename = gerar_pdf_requisicao(req)
-        response = HttpResponse(pdf_content, content_type='application/pdf')
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        return response
+    def gerar_pdf_requisicao(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> HttpResponseBase:
+        if queryset.count() > 1:
+            return pdf_lote.exportar(queryset, 'requisicao', 'zip')
+        req = queryset.select_related('paciente', 'analista').first()
+        ficheiro, filename = pdf_cache.abrir_pdf_requisicao(req)
+        return FileResponse(ficheiro, as_attachment=True, filename=filename, content_type='application/pdf')
     gerar_pdf_requisicao.short_description = "Baixar PDF da Requisição"
 
-    def gerar_pdf_resultados(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> Optional[HttpResponse]:
-        if queryset.count() != 1:
-            self.message_user(request, "Selecione apenas uma requisição.", level='warning')
-            return None
-        req = queryset.first()
-        pdf_content, filename = gerar_pdf_resultados(req, apenas_validados=True)
-        response = HttpResponse(pdf_content, content_type='application/pdf')
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        return response
+    def gerar_pdf_resultados(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> HttpResponseBase:
+        if queryset.count() > 1:
+            return pdf_lote.exportar(queryset, 'resultados', 'zip')
+        req = queryset.select_related('paciente', 'analista').first()
+        ficheiro, filename = pdf_cache.abrir_pdf_resultados(req, apenas_validados=True)
+        return FileResponse(ficheiro, as_attachment=True, filename=filename, content_type='application/pdf')
     gerar_pdf_resultados.short_description = "Baixar PDF de Resultados"
+
+    def exportar_resultados_zip(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> HttpResponseBase:
+        return pdf_lote.exportar(queryset, 'resultados', 'zip')
+    exportar_resultados_zip.short_description = "Baixar PDFs de Resultados (ZIP)"
+
+    def juntar_resultados_pdf(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> Optional[HttpResponseBase]:
+        # o PDF único é montado em memória (ver pdf_lote.juntar_pdfs); lotes grandes só em ZIP
+        try:
+            return pdf_lote.exportar(queryset, 'resultados', 'pdf')
+        except pdf_lote.LoteGrande as e:
+            self.message_user(request, str(e), level='warning')
+            return None
+    juntar_resultados_pdf.short_description = "Baixar PDFs de Resultados num único PDF"
+
+    def get_actions(self, request: HttpRequest):
+        actions = super().get_actions(request)
+        if pdf_lote.PdfWriter is None:
+            actions.pop('juntar_resultados_pdf', None)
+        return actions
+
+    def preparar_pdfs_resultados(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> None:
+        trabalhos = []
+        for req in queryset.only('id', 'id_custom'):
+            try:
+                trabalhos.append((req.id_custom, pdf_jobs.submeter('resultados', req.id)))
+            except pdf_jobs.FilaCheia as e:
+                self.message_user(request, str(e), level='warning')
+                break
+        if trabalhos:
+            links = format_html_join(
+                ', ', '<a href="{}">{}</a>',
+                ((reverse('lab:pdf_trabalho_download', args=[job_id]), codigo) for codigo, job_id in trabalhos)
+            )
+            self.message_user(request, format_html("PDFs em preparação (disponíveis em instantes): {}", links))
+    preparar_pdfs_resultados.short_description = "Preparar PDFs de Resultados em segundo plano"
+
+    # ==========================
+    # VALIDAÇÃO EM MASSA
+    # ==========================
+    def validar_resultados(self, request: HttpRequest, queryset: QuerySet[RequisicaoAnalise]) -> None:
+        total = validar_requisicoes(queryset.values_list('id', flat=True), request.user)
+        self.message_user(request, f"{total} resultado(s) validado(s) em {queryset.count()} requisição(ões).")
+    validar_resultados.short_description = "Validar todos os resultados"
+
+
+# =====================================
+# PAINEL DE VOLUME E TRL
+# =====================================
+@admin.register(ResumoDiarioExame)
+class ResumoDiarioExameAdmin(admin.ModelAdmin):
+    """
+    Resumos mantidos por `manage.py calcular_resumos_diarios`; só de leitura.
+    painel/ mostra os totais do período, lidos apenas desta tabela.
+    """
+    list_display = ('dia', 'setor', 'exame', 'volume', 'validados', 'trl_mediana_h', 'trl_p95_h', 'fora_trl')
+    list_filter = ('setor', 'dia')
+    list_select_related = ('exame',)
+    date_hierarchy = 'dia'
+
+    def has_add_permission(self, request: HttpRequest) -> bool:
+        return False
+
+    def has_change_permission(self, request: HttpRequest, obj=None) -> bool:
+        return False
+
+    def get_urls(self):
+        painel = path('painel/', self.admin_site.admin_view(self.painel_view), name='lab_resumodiarioexame_painel')
+        return [painel, *super().get_urls()]
+
+    def painel_view(self, request: HttpRequest) -> TemplateResponse:
+        desde = parse_date(request.GET.get('desde') or '')
+        ate = parse_date(request.GET.get('ate') or '')
+        setor = request.GET.get('setor') or None
+        return TemplateResponse(request, 'admin/lab/resumodiarioexame/painel.html', {
+            **self.admin_site.each_context(request),
+            'title': 'Volume e tempo de resposta (TRL)',
+            'opts': self.model._meta,
+            'painel': resumos.painel(desde, ate, setor),
+            'setores': Exame.SetorExame.choices,
+            'dados_url': reverse('lab:painel_trl_dados'),
+        })
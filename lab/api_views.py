@@ -6,32 +6,180 @@ def teste(request):
     return Response({"mensagem": "Django funcionando!"})
 
 # lab/api_views.py
-from rest_framework import viewsets
+from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from .models import Paciente, Exame, ExameCampo, RequisicaoAnalise, ResultadoItem
 from .serializers import (
     PacienteSerializer, ExameSerializer, ExameCampoSerializer,
-    RequisicaoAnaliseSerializer, ResultadoItemSerializer
+    RequisicaoAnaliseSerializer, ResultadoItemSerializer,
+    ValidacaoLoteSerializer, campos_pedidos, expansoes_pedidas
 )
+from .pagination import (
+    PacientePaginacao, ExamePaginacao, ExameCampoPaginacao,
+    RequisicaoPaginacao, ResultadoPaginacao
+)
+from .utils import exportacao, historico_paciente, pdf_jobs, pesquisa_pacientes
+from .utils.validacao import validar_requisicoes
 
 class PacienteViewSet(viewsets.ModelViewSet):
     queryset = Paciente.objects.all()
     serializer_class = PacienteSerializer
+    pagination_class = PacientePaginacao
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def pesquisa(self, request):
+        """
+        Pacientes que correspondem a ?q=, por relevância (sem paginação por cursor,
+        que ordenaria por id). ?limite= até pesquisa_pacientes.LIMITE.
+        """
+        termo = request.query_params.get('q', '').strip()
+        if not termo:
+            return Response({"erro": "Indique o termo de pesquisa em ?q="}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limite = min(int(request.query_params.get('limite', pesquisa_pacientes.LIMITE)), pesquisa_pacientes.LIMITE)
+        except ValueError:
+            limite = pesquisa_pacientes.LIMITE
+        pacientes = pesquisa_pacientes.pesquisar(termo, self.get_queryset())[:max(limite, 1)]
+        return Response(self.get_serializer(pacientes, many=True).data)
+
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
+    def historico(self, request, pk=None):
+        """Resumo do histórico de resultados validados do paciente, por campo (em cache)."""
+        paciente = self.get_object()
+        return Response({"paciente": paciente.pk, "campos": historico_paciente.resumo(paciente.pk)})
 
 class ExameCampoViewSet(viewsets.ModelViewSet):
     queryset = ExameCampo.objects.all()
     serializer_class = ExameCampoSerializer
+    pagination_class = ExameCampoPaginacao
 
 class ExameViewSet(viewsets.ModelViewSet):
     queryset = Exame.objects.all()
     serializer_class = ExameSerializer
+    pagination_class = ExamePaginacao
 
 class ResultadoItemViewSet(viewsets.ModelViewSet):
-    queryset = ResultadoItem.objects.all()
+    # o sinal de cada resultado depende do sexo e idade do paciente
+    queryset = ResultadoItem.objects.select_related('requisicao__paciente')
     serializer_class = ResultadoItemSerializer
+    pagination_class = ResultadoPaginacao
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def estatisticas(self, request):
+        """
+        Estatísticas dos resultados numéricos por campo (?exame_campo= para um
+        só campo, com a mediana e o percentil 95), calculadas na base de dados.
+        """
+        qs = ResultadoItem.objects.all()
+        campo = request.query_params.get('exame_campo')
+        if campo is None:
+            return Response(qs.estatisticas())
+        if not campo.isdigit():
+            return Response({"erro": "exame_campo deve ser um id"}, status=status.HTTP_400_BAD_REQUEST)
+        qs = qs.filter(exame_campo=int(campo))
+        linhas = qs.estatisticas()
+        percentis = qs.percentis(0.5, 0.95)
+        return Response({
+            **(linhas[0] if linhas else {"exame_campo": int(campo), "n": 0}),
+            "mediana": percentis[0.5],
+            "p95": percentis[0.95],
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def exportar(self, request):
+        """
+        Resultados para análise, lidos por blocos: ?formato=arrow (fluxo Arrow
+        IPC, enviado à medida que é lido; por omissão) ou parquet (um
+        ficheiro). ?desde= (data/hora ISO) limita às linhas alteradas depois.
+        """
+        if exportacao.pa is None:
+            return Response({"erro": "Exportação indisponível: o pyarrow não está instalado."},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        desde = request.query_params.get('desde') or None
+        if desde is not None:
+            desde = parse_datetime(desde)
+            if desde is None:
+                return Response({"erro": "desde deve ser uma data/hora ISO 8601"}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(desde):
+                desde = timezone.make_aware(desde)
+        formato = request.query_params.get('formato', 'arrow')
+        qs = exportacao.consulta(desde)
+        chunk_size = getattr(settings, 'EXPORTACAO', {}).get('CHUNK_SIZE', exportacao.CHUNK_SIZE)
+        if formato == 'arrow':
+            resposta = StreamingHttpResponse(
+                exportacao.fluxo_arrow(qs, chunk_size), content_type='application/vnd.apache.arrow.stream'
+            )
+            resposta['Content-Disposition'] = 'attachment; filename="resultados.arrows"'
+            return resposta
+        if formato == 'parquet':
+            return FileResponse(
+                exportacao.ficheiro_parquet(qs, chunk_size), as_attachment=True,
+                filename='resultados.parquet', content_type='application/vnd.apache.parquet',
+            )
+        return Response({"erro": "formato deve ser arrow ou parquet"}, status=status.HTTP_400_BAD_REQUEST)
 
 class RequisicaoAnaliseViewSet(viewsets.ModelViewSet):
     queryset = RequisicaoAnalise.objects.all()
     serializer_class = RequisicaoAnaliseSerializer
+    pagination_class = RequisicaoPaginacao
+
+    def get_queryset(self):
+        """
+        Junta/pré-carrega exactamente as relações que o serializer vai
+        percorrer, conforme ?fields= e ?expand=, para um número constante
+        de consultas por página.
+        """
+        qs = super().get_queryset()
+        campos = campos_pedidos(self.request)
+        expandir = expansoes_pedidas(self.request, RequisicaoAnaliseSerializer.expansiveis)
+
+        def incluido(nome):
+            return campos is None or nome in campos
+
+        # o paciente também é lido para o sinal dos resultados expandidos
+        if (incluido('paciente') and 'paciente' in expandir) or (incluido('resultados') and 'resultados' in expandir):
+            qs = qs.select_related('paciente')
+        if incluido('exames'):
+            # os campos dos exames expandidos vêm do catálogo em cache
+            qs = qs.prefetch_related('exames')
+        if incluido('resultados'):
+            qs = qs.prefetch_related('resultados')
+        if any(incluido(nome) for nome in ('total_resultados', 'pendentes', 'validados')):
+            qs = qs.with_progress()
+        return qs
+
+    @action(detail=False, methods=['post'], serializer_class=ValidacaoLoteSerializer, permission_classes=[IsAuthenticated])
+    def validar(self, request):
+        """Valida de uma vez os resultados de uma ou várias requisições."""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        total = validar_requisicoes(
+            serializer.validated_data['requisicoes'],
+            request.user,
+            resultados=serializer.validated_data.get('resultados'),
+        )
+        return Response({"validados": total}, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'], url_path='pdf-trabalho', permission_classes=[IsAuthenticated])
+    def pdf_trabalho(self, request, pk=None):
+        """Submete a geração do PDF (?tipo=requisicao|resultados) ao pool de processos."""
+        requisicao = self.get_object()
+        tipo = request.query_params.get('tipo', 'resultados')
+        try:
+            job_id = pdf_jobs.submeter(tipo, requisicao.pk, apenas_validados=True)
+        except ValueError as e:
+            return Response({"erro": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except pdf_jobs.FilaCheia as e:
+            return Response({"erro": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "5"})
+        return Response({
+            "id": job_id,
+            "estado_url": request.build_absolute_uri(reverse("lab:pdf_trabalho_estado", args=[job_id])),
+        }, status=status.HTTP_202_ACCEPTED)
 
@@ -5,3 +5,6 @@ class LabConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'lab'
     verbose_name = 'AnaBioLink'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -6,6 +6,7 @@ from django.utils import timezone
 from django_select2.forms import Select2MultipleWidget
 from datetime import timedelta
 from .models import Paciente, RequisicaoAnalise
+from .utils import catalogo
 
 
 # =====================================
@@ -47,3 +48,10 @@ class RequisicaoAnaliseForm(forms.ModelForm):
 				"style": "width: 100%; min-width: 300px;"
 			}),
 		}
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		if "exames" in self.fields:
+			# opções a partir do catálogo em cache (a validação continua a usar o queryset)
+			exames = sorted(catalogo.obter().exames.values(), key=lambda e: e.nome)
+			self.fields["exames"].choices = [(e.pk, str(e)) for e in exames]
@@ -0,0 +1,40 @@
+"""
+Actualiza os resumos diários de volume e tempo de resposta por exame
+(ResumoDiarioExame), usados pelo painel de TRL do admin e por
+/painel/trl/dados/.
+
+Por omissão só recalcula os dias com requisições ou resultados alterados
+desde a execução anterior, pelo que pode correr de poucos em poucos minutos
+no cron. Requisições apagadas só deixam de contar com --completo (por
+exemplo, uma vez por noite). Com --dia recalcula apenas os dias indicados,
+sem avançar a marca da execução incremental.
+
+    python manage.py calcular_resumos_diarios [--completo] [--dia AAAA-MM-DD ...]
+"""
+
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lab.utils import resumos
+
+
+class Command(BaseCommand):
+    help = "Actualiza os resumos diários de volume e TRL por exame (incremental)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--completo", action="store_true", help="Recalcula todos os dias.")
+        parser.add_argument("--dia", action="append", default=[], help="Recalcula só este dia (AAAA-MM-DD); repetível.")
+
+    def handle(self, *args, completo, dia, **options):
+        if dia:
+            try:
+                dias = [date.fromisoformat(d) for d in dia]
+            except ValueError as erro:
+                raise CommandError(f"Dia inválido: {erro}")
+            resumo = {"dias": len(set(dias)), "linhas": resumos.recalcular(dias)}
+        else:
+            resumo = resumos.actualizar(completo=completo)
+        self.stdout.write(self.style.SUCCESS(
+            f"{resumo['dias']} dia(s) recalculado(s), {resumo['linhas']} resumo(s) gravado(s)."
+        ))
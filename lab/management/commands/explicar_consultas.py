@@ -0,0 +1,97 @@
+"""
+Mostra o plano de execução das consultas mais frequentes do laboratório,
+sem e com os índices da migração 0009 (índices por caminho de acesso).
+
+    python manage.py explicar_consultas [--analyze]
+
+Para obter o plano "antes", os índices são removidos dentro de uma transacção
+que é sempre revertida no fim. No PostgreSQL o DROP INDEX bloqueia as tabelas
+até ao fim dessa transacção: não correr em horas de ponta.
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from lab.models import RequisicaoAnalise, ResultadoItem
+
+# índices e restrição criados pela migração 0009; índices acrescentados
+# depois aos modelos não entram na comparação
+INDICES_0009 = (
+    "lab_req_status_criada_idx",
+    "lab_req_criada_id_idx",
+    "lab_res_valid_data_idx",
+    "lab_res_pendentes_idx",
+    "lab_res_req_campo_uniq",
+)
+
+class Command(BaseCommand):
+    help = "Compara os planos de execução das consultas principais sem e com os índices compostos."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--analyze", action="store_true",
+            help="Executa as consultas (EXPLAIN ANALYZE); só em PostgreSQL.",
+        )
+
+    def consultas(self):
+        """Consultas a analisar, com valores reais da base de dados quando existem."""
+        exemplo = ResultadoItem.objects.order_by("-id").values("requisicao_id", "exame_campo_id").first()
+        exemplo = exemplo or {"requisicao_id": 1, "exame_campo_id": 1}
+        prefixo = f"{RequisicaoAnalise.prefixo}{timezone.localdate():%Y%m}"
+        return [
+            ("Resultado por requisição e campo", ResultadoItem.objects.filter(**exemplo)),
+            ("Resultados pendentes da requisição", ResultadoItem.objects.filter(
+                requisicao_id=exemplo["requisicao_id"], validado=False
+            )),
+            ("Resultados validados nos últimos 7 dias", ResultadoItem.objects.filter(
+                validado=True, data_validacao__gte=timezone.now() - timedelta(days=7)
+            )),
+            ("Requisições pendentes mais recentes", RequisicaoAnalise.objects.filter(status="PEND").order_by("-created_at")[:100]),
+            ("Página de requisições da API", RequisicaoAnalise.objects.order_by("-created_at", "-id")[:50]),
+            ("Requisições por prefixo de id_custom", RequisicaoAnalise.objects.filter(id_custom__startswith=prefixo)),
+        ]
+
+    def indices(self):
+        """(modelo, índice ou restrição) de INDICES_0009."""
+        return [
+            (modelo, indice)
+            for modelo in (RequisicaoAnalise, ResultadoItem)
+            for indice in [*modelo._meta.indexes, *modelo._meta.constraints]
+            if indice.name in INDICES_0009
+        ]
+
+    def remover_indices(self):
+        if connection.vendor == "sqlite":
+            # o schema editor do SQLite não pode ser usado dentro de uma transacção
+            with connection.cursor() as cursor:
+                for _, indice in self.indices():
+                    cursor.execute(f'DROP INDEX IF EXISTS "{indice.name}"')
+            return
+        with connection.schema_editor(atomic=False) as editor:
+            for modelo, indice in self.indices():
+                if hasattr(indice, "fields") and indice in modelo._meta.indexes:
+                    editor.remove_index(modelo, indice)
+                else:
+                    editor.remove_constraint(modelo, indice)
+
+    def planos(self, analyze):
+        opcoes = {"analyze": True, "buffers": True} if analyze and connection.vendor == "postgresql" else {}
+        return [(nome, qs.explain(**opcoes)) for nome, qs in self.consultas()]
+
+    def handle(self, *args, analyze, **options):
+        with transaction.atomic():
+            self.remover_indices()
+            antes = self.planos(analyze)
+            transaction.set_rollback(True)
+        depois = self.planos(analyze)
+
+        for (nome, plano_antes), (_, plano_depois) in zip(antes, depois):
+            self.stdout.write(self.style.MIGRATE_HEADING(f"== {nome} =="))
+            self.stdout.write("-- sem índices --")
+            self.stdout.write(plano_antes)
+            self.stdout.write("-- com índices --")
+            self.stdout.write(plano_depois)
+            self.stdout.write("")
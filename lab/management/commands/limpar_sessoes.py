@@ -0,0 +1,32 @@
+"""
+Apaga as sessões expiradas de django_session por blocos.
+
+Ao contrário de `clearsessions` (um único DELETE sobre todas as linhas
+expiradas), cada bloco é uma transacção curta, pelo que o comando pode correr
+de hora a hora no cron sem bloquear os logins em curso.
+
+    python manage.py limpar_sessoes [--lote 5000]
+"""
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = "Apaga as sessões expiradas por blocos."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lote", type=int, default=5000, help="Sessões apagadas por instrução.")
+
+    def handle(self, *args, lote, **options):
+        agora = timezone.now()
+        apagadas = 0
+        while True:
+            chaves = list(
+                Session.objects.filter(expire_date__lt=agora).values_list("session_key", flat=True)[:lote]
+            )
+            if not chaves:
+                break
+            apagadas += Session.objects.filter(session_key__in=chaves).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f"{apagadas} sessão(ões) expirada(s) apagada(s)."))
@@ -0,0 +1,42 @@
+"""
+Recalcula RequisicaoAnalise.n_resultados/n_validados a partir de ResultadoItem.
+
+Os contadores são mantidos por UPDATE incremental; alterações feitas fora da
+aplicação (SQL directo, loaddata, conflitos em bulk_create) podem deixá-los
+desfasados. Este comando corrige-os por blocos de ids, sem bloquear a tabela
+inteira numa só transacção.
+
+    python manage.py reconciliar_contadores [--lote 5000] [--promover]
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Max
+from django.utils import timezone
+
+from lab.models import RequisicaoAnalise
+
+
+class Command(BaseCommand):
+    help = "Corrige os contadores n_resultados/n_validados das requisições."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lote", type=int, default=5000, help="Requisições por bloco (por id).")
+        parser.add_argument(
+            "--promover", action="store_true",
+            help='Passa a "VAL" as requisições pendentes com todos os resultados validados.',
+        )
+
+    def handle(self, *args, lote, promover, **options):
+        maximo = RequisicaoAnalise.objects.aggregate(m=Max("pk"))["m"] or 0
+        corrigidas = promovidas = 0
+        for inicio in range(0, maximo + 1, lote):
+            bloco = RequisicaoAnalise.objects.filter(pk__gte=inicio, pk__lt=inicio + lote)
+            corrigidas += bloco.reconciliar_contadores()
+            if promover:
+                promovidas += bloco.filter(
+                    status="PEND", n_resultados__gt=0, n_validados=F("n_resultados")
+                ).update(status="VAL", updated_at=timezone.now())
+
+        self.stdout.write(self.style.SUCCESS(f"{corrigidas} requisição(ões) com contadores corrigidos."))
+        if promover:
+            self.stdout.write(self.style.SUCCESS(f"{promovidas} requisição(ões) passaram a validadas."))
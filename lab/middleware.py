@@ -0,0 +1,43 @@
+# lab/middleware.py
+import time
+
+from django.conf import settings
+
+
+class RenovacaoSessaoMiddleware:
+    """
+    Renova a validade da sessão no máximo uma vez a cada
+    SESSAO_RENOVAR_APOS segundos, em vez de a gravar em todos os pedidos
+    (SESSION_SAVE_EVERY_REQUEST).
+
+    A hora da última renovação fica na própria sessão ("_renovada_em"); só
+    quando passou o intervalo a sessão é marcada como alterada e o
+    SessionMiddleware grava-a, o que renova a expiração (SESSION_COOKIE_AGE
+    a contar desse momento). A sessão expira, portanto, entre
+    SESSION_COOKIE_AGE - SESSAO_RENOVAR_APOS e SESSION_COOKIE_AGE depois do
+    último pedido. Com SESSAO_RENOVAR_APOS = 0 grava em todos os pedidos.
+
+    O login marca a hora na sessão (lab.signals.marcar_renovacao_sessao), pelo
+    que só as sessões criadas antes deste middleware são gravadas no primeiro
+    pedido.
+
+    Deve vir depois de django.contrib.sessions.middleware.SessionMiddleware.
+    """
+
+    CHAVE = "_renovada_em"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        sessao = getattr(request, "session", None)
+        # sem sessão (ex.: API com JWT) não há nada a renovar
+        if sessao is None or sessao.is_empty():
+            return response
+        agora = int(time.time())
+        intervalo = getattr(settings, "SESSAO_RENOVAR_APOS", 5 * 60)
+        # se a sessão já vai ser gravada, aproveita-se a escrita
+        if sessao.modified or agora - sessao.get(self.CHAVE, 0) >= intervalo:
+            sessao[self.CHAVE] = agora
+        return response
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:36
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def semear_sequencias(apps, schema_editor):
+    """Inicializa os contadores do dia a partir dos códigos já existentes."""
+    SequenciaDiaria = apps.get_model('lab', 'SequenciaDiaria')
+    hoje = timezone.now().date()
+    for modelo, prefixo in (('Paciente', 'PAC'), ('RequisicaoAnalise', 'REQ'), ('ResultadoItem', 'RES')):
+        Modelo = apps.get_model('lab', modelo)
+        inicio = f"{prefixo}{hoje:%Y%m%d}"
+        # o número pode ter mais de 4 dígitos: não comparar os códigos como texto
+        numeros = [
+            int(codigo[len(inicio):])
+            for codigo in Modelo.objects.filter(id_custom__startswith=inicio).values_list('id_custom', flat=True)
+            if codigo[len(inicio):].isdigit()
+        ]
+        if numeros:
+            SequenciaDiaria.objects.create(prefixo=prefixo, dia=hoje, ultimo_numero=max(numeros))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0004_alter_requisicaoanalise_analista_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SequenciaDiaria',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefixo', models.CharField(max_length=10, verbose_name='Prefixo')),
+                ('dia', models.DateField(verbose_name='Dia')),
+                ('ultimo_numero', models.PositiveIntegerField(default=0, verbose_name='Último número')),
+            ],
+            options={
+                'verbose_name': 'Sequência diária',
+                'verbose_name_plural': 'Sequências diárias',
+                'constraints': [models.UniqueConstraint(fields=('prefixo', 'dia'), name='lab_sequencia_prefixo_dia_uniq')],
+            },
+        ),
+        migrations.RunPython(semear_sequencias, migrations.RunPython.noop),
+    ]
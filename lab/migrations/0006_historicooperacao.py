@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0005_sequenciadiaria'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoricoOperacao',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('acao', models.CharField(max_length=60, verbose_name='Ação')),
+                ('detalhes', models.TextField(blank=True, verbose_name='Detalhes')),
+                ('data', models.DateTimeField(auto_now_add=True, verbose_name='Data')),
+                ('requisicao', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='historico', to='lab.requisicaoanalise', verbose_name='Requisição')),
+                ('utilizador', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='historico_operacoes', to=settings.AUTH_USER_MODEL, verbose_name='Utilizador')),
+            ],
+            options={
+                'verbose_name': 'Histórico de Operação',
+                'verbose_name_plural': 'Histórico de Operações',
+                'ordering': ['-data'],
+            },
+        ),
+    ]
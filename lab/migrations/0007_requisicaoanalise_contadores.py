@@ -0,0 +1,40 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:56
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def preencher_contadores(apps, schema_editor):
+    """Calcula n_resultados/n_validados das requisições existentes com um único UPDATE."""
+    RequisicaoAnalise = apps.get_model('lab', 'RequisicaoAnalise')
+    ResultadoItem = apps.get_model('lab', 'ResultadoItem')
+
+    def contagem(**filtros):
+        return Coalesce(Subquery(
+            ResultadoItem.objects.filter(requisicao=OuterRef('pk'), **filtros)
+            .order_by().values('requisicao').annotate(n=Count('id')).values('n')
+        ), 0)
+
+    RequisicaoAnalise.objects.update(n_resultados=contagem(), n_validados=contagem(validado=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0006_historicooperacao'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requisicaoanalise',
+            name='n_resultados',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Nº de resultados'),
+        ),
+        migrations.AddField(
+            model_name='requisicaoanalise',
+            name='n_validados',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Nº de resultados validados'),
+        ),
+        migrations.RunPython(preencher_contadores, migrations.RunPython.noop),
+    ]
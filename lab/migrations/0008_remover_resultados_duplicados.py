@@ -0,0 +1,50 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:58
+
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def remover_duplicados(apps, schema_editor):
+    """
+    Deixa um único ResultadoItem por (requisicao, exame_campo) antes de criar a
+    restrição única em 0009. Fica o resultado validado, depois o preenchido,
+    depois o mais antigo; os contadores das requisições afectadas são recalculados.
+    """
+    ResultadoItem = apps.get_model('lab', 'ResultadoItem')
+    RequisicaoAnalise = apps.get_model('lab', 'RequisicaoAnalise')
+
+    grupos = (
+        ResultadoItem.objects.order_by().values('requisicao_id', 'exame_campo_id')
+        .annotate(n=Count('id')).filter(n__gt=1)
+    )
+    afectadas = set()
+    for grupo in grupos.iterator():
+        linhas = ResultadoItem.objects.filter(
+            requisicao_id=grupo['requisicao_id'], exame_campo_id=grupo['exame_campo_id']
+        ).values_list('id', 'validado', 'resultado')
+        ordenadas = sorted(linhas, key=lambda r: (not r[1], r[2] in (None, ''), r[0]))
+        ResultadoItem.objects.filter(id__in=[r[0] for r in ordenadas[1:]]).delete()
+        afectadas.add(grupo['requisicao_id'])
+
+    if afectadas:
+        def contagem(**filtros):
+            return Coalesce(Subquery(
+                ResultadoItem.objects.filter(requisicao=OuterRef('pk'), **filtros)
+                .order_by().values('requisicao').annotate(n=Count('id')).values('n')
+            ), 0)
+
+        RequisicaoAnalise.objects.filter(id__in=afectadas).update(
+            n_resultados=contagem(), n_validados=contagem(validado=True)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0007_requisicaoanalise_contadores'),
+    ]
+
+    operations = [
+        migrations.RunPython(remover_duplicados, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:58
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0008_remover_resultados_duplicados'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='requisicaoanalise',
+            index=models.Index(fields=['status', '-created_at'], name='lab_req_status_criada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='requisicaoanalise',
+            index=models.Index(fields=['-created_at', '-id'], name='lab_req_criada_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resultadoitem',
+            index=models.Index(fields=['validado', 'data_validacao'], name='lab_res_valid_data_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resultadoitem',
+            index=models.Index(condition=models.Q(('validado', False)), fields=['requisicao'], name='lab_res_pendentes_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='resultadoitem',
+            constraint=models.UniqueConstraint(fields=('requisicao', 'exame_campo'), name='lab_res_req_campo_uniq'),
+        ),
+    ]
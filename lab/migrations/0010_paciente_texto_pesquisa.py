@@ -0,0 +1,45 @@
+# Generated by Django 5.2.8 on 2026-10-17 00:01
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+
+def preencher_texto_pesquisa(apps, schema_editor):
+    """
+    Calcula Paciente.texto_pesquisa dos pacientes existentes, por blocos.
+    Cópia de lab.utils.pesquisa_pacientes.texto_pesquisa, congelada aqui.
+    """
+    Paciente = apps.get_model('lab', 'Paciente')
+
+    def normalizar(texto):
+        decomposto = unicodedata.normalize('NFKD', str(texto or ''))
+        return ' '.join(''.join(c for c in decomposto if not unicodedata.combining(c)).lower().split())
+
+    lote = []
+    for paciente in Paciente.objects.only('id', 'nome', 'contacto').order_by('id').iterator(chunk_size=2000):
+        digitos = re.sub(r'\D', '', paciente.contacto or '')
+        paciente.texto_pesquisa = f"{normalizar(paciente.nome)} {digitos}".strip()
+        lote.append(paciente)
+        if len(lote) == 2000:
+            Paciente.objects.bulk_update(lote, ['texto_pesquisa'])
+            lote = []
+    if lote:
+        Paciente.objects.bulk_update(lote, ['texto_pesquisa'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0009_indices_caminhos_de_acesso'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paciente',
+            name='texto_pesquisa',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(preencher_texto_pesquisa, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# Só PostgreSQL: noutros motores a pesquisa funciona, mas sem estes índices.
+INDICES = {
+    'lab_pac_pesquisa_trgm': 'USING gin (texto_pesquisa gin_trgm_ops)',
+    'lab_pac_pesquisa_like': '(texto_pesquisa text_pattern_ops)',
+}
+
+
+def criar_indices(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for nome, definicao in INDICES.items():
+        schema_editor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON lab_paciente {definicao}')
+
+
+def remover_indices(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for nome in INDICES:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {nome}')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY não pode correr dentro de uma transacção
+    atomic = False
+
+    dependencies = [
+        ('lab', '0010_paciente_texto_pesquisa'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_indices, remover_indices),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.8 on 2026-10-17 00:16
+
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+
+LOTE = 5000
+
+
+def preencher_valor_numerico(apps, schema_editor):
+    """
+    Converte ResultadoItem.resultado dos resultados existentes em
+    valor_numerico, por blocos de LOTE linhas. Cópia de
+    lab.utils.referencias.valor_numerico, congelada aqui.
+    """
+    ResultadoItem = apps.get_model('lab', 'ResultadoItem')
+
+    def numero(texto):
+        try:
+            valor = float(str(texto).strip().replace(',', '.'))
+        except ValueError:
+            return None
+        return valor if math.isfinite(valor) else None
+
+    lote = []
+    preenchidos = ResultadoItem.objects.exclude(resultado='').only('id', 'resultado').order_by('id')
+    for ri in preenchidos.iterator(chunk_size=LOTE):
+        ri.valor_numerico = numero(ri.resultado)
+        if ri.valor_numerico is None:
+            continue
+        lote.append(ri)
+        if len(lote) == LOTE:
+            ResultadoItem.objects.bulk_update(lote, ['valor_numerico'])
+            lote = []
+    if lote:
+        ResultadoItem.objects.bulk_update(lote, ['valor_numerico'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0011_paciente_indices_pesquisa'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resultadoitem',
+            name='valor_numerico',
+            field=models.FloatField(blank=True, editable=False, null=True, verbose_name='Valor numérico'),
+        ),
+        # preenchido antes de criar o índice, para o construir uma só vez
+        migrations.RunPython(preencher_valor_numerico, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='resultadoitem',
+            index=models.Index(condition=models.Q(('valor_numerico__isnull', False)), fields=['exame_campo', 'valor_numerico'], name='lab_res_campo_valor_idx'),
+        ),
+    ]
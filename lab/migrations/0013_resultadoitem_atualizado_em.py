@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-17 00:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0012_resultadoitem_valor_numerico'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resultadoitem',
+            name='atualizado_em',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Atualizado em'),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='resultadoitem',
+            index=models.Index(fields=['atualizado_em'], name='lab_res_atualizado_idx'),
+        ),
+    ]
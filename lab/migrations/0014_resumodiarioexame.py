@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-17 00:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0013_resultadoitem_atualizado_em'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResumoDiarioExame',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia', models.DateField(verbose_name='Dia')),
+                ('setor', models.CharField(max_length=40, verbose_name='Setor')),
+                ('volume', models.PositiveIntegerField(default=0, verbose_name='Requisições')),
+                ('validados', models.PositiveIntegerField(default=0, verbose_name='Concluídas')),
+                ('trl_mediana_h', models.FloatField(blank=True, null=True, verbose_name='TRL mediano (h)')),
+                ('trl_p95_h', models.FloatField(blank=True, null=True, verbose_name='TRL p95 (h)')),
+                ('fora_trl', models.PositiveIntegerField(default=0, verbose_name='Acima do TRL')),
+                ('calculado_em', models.DateTimeField(verbose_name='Calculado em')),
+                ('exame', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resumos_diarios', to='lab.exame', verbose_name='Exame')),
+            ],
+            options={
+                'verbose_name': 'Resumo diário de exame',
+                'verbose_name_plural': 'Resumos diários de exames',
+                'ordering': ['-dia', 'setor', 'exame'],
+                'indexes': [models.Index(fields=['setor', 'dia'], name='lab_resumo_setor_dia_idx')],
+                'constraints': [models.UniqueConstraint(fields=('dia', 'exame'), name='lab_resumo_dia_exame_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-17 00:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0014_resumodiarioexame'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='requisicaoanalise',
+            index=models.Index(fields=['paciente', '-created_at'], name='lab_req_pac_criada_idx'),
+        ),
+    ]
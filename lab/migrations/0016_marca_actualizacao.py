@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-17 00:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0015_requisicao_paciente_criada_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarcaActualizacao',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tarefa', models.CharField(max_length=40, unique=True, verbose_name='Tarefa')),
+                ('ate', models.DateTimeField(verbose_name='Processado até')),
+            ],
+            options={
+                'verbose_name': 'Marca de actualização',
+                'verbose_name_plural': 'Marcas de actualização',
+            },
+        ),
+    ]
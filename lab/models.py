@@ -1,24 +1,108 @@
 from email.policy import default
 from sys import prefix
-from django.db import models
+from django.db import connection, connections, models
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth import get_user_model
 from django.forms import ValidationError
 from django.utils import timezone
 from datetime import date
+import math
+import re
+import threading
 User = get_user_model()
 
+# =====================================
+# SEQUÊNCIA DIÁRIA DE CÓDIGOS
+# =====================================
+class SequenciaDiaria(models.Model):
+    """
+    Contador por prefixo e por dia usado na geração dos códigos `id_custom`.
+    Cada linha guarda o último número atribuído, incrementado atomicamente.
+    """
+    prefixo = models.CharField("Prefixo", max_length=10)
+    dia = models.DateField("Dia")
+    ultimo_numero = models.PositiveIntegerField("Último número", default=0)
+
+    class Meta:
+        verbose_name = "Sequência diária"
+        verbose_name_plural = "Sequências diárias"
+        constraints = [
+            models.UniqueConstraint(fields=["prefixo", "dia"], name="lab_sequencia_prefixo_dia_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.prefixo}{self.dia:%Y%m%d} → {self.ultimo_numero}"
+
+
+_sequencias_local = threading.local()
+
+
+def _ligacao_sequencias():
+    """
+    Ligação para o contador. Dentro de uma transacção usa-se uma segunda
+    ligação à mesma base de dados, em autocommit (uma por thread): o
+    incremento é confirmado de imediato e o bloqueio da linha (prefixo, dia)
+    dura só essa instrução, em vez de ficar até ao commit do pedido. Se a
+    transacção do pedido for revertida, os números ficam por usar (falhas na
+    numeração são aceites). Em SQLite, que bloqueia a base inteira em cada
+    escrita, usa-se sempre a ligação do pedido.
+    """
+    if not connection.in_atomic_block or connection.vendor == "sqlite":
+        return connection
+    ligacao = getattr(_sequencias_local, "ligacao", None)
+    if ligacao is None:
+        ligacao = _sequencias_local.ligacao = connections.create_connection(connection.alias)
+    ligacao.close_if_unusable_or_obsolete()
+    return ligacao
+
+
+def _incrementar_sequencia(prefixo, dia, quantidade):
+    """
+    Incrementa o contador (prefixo, dia) em `quantidade` numa única instrução
+    (INSERT ... ON CONFLICT DO UPDATE ... RETURNING) e devolve o novo valor.
+    Suportado em PostgreSQL e SQLite >= 3.35; sem varrimento nem novas tentativas.
+    """
+    ligacao = _ligacao_sequencias()
+    tabela = ligacao.ops.quote_name(SequenciaDiaria._meta.db_table)
+    sql = (
+        f"INSERT INTO {tabela} (prefixo, dia, ultimo_numero) VALUES (%s, %s, %s) "
+        f"ON CONFLICT (prefixo, dia) DO UPDATE "
+        f"SET ultimo_numero = {tabela}.ultimo_numero + EXCLUDED.ultimo_numero "
+        f"RETURNING ultimo_numero"
+    )
+    with ligacao.cursor() as cursor:
+        cursor.execute(sql, [prefixo, dia, quantidade])
+        return cursor.fetchone()[0]
+
+
 # =====================================
 # UTILITÁRIO DE GERAÇÃO DE CÓDIGO
 # =====================================
-def gerar_codigo(prefixo, modelo):
-    hoje = timezone.now().strftime("%Y%m%d")
-    ultimo = modelo.objects.filter(id_custom__startswith=f"{prefixo}{hoje}").order_by('id_custom').last()
-    if ultimo and ultimo.id_custom:
-        ultimo_num = int(ultimo.id_custom[-4:])
-        nova_ordem = ultimo_num + 1
-    else:
-        nova_ordem = 1
-    return f"{prefixo}{hoje}{nova_ordem:04d}"
+def reservar_codigos(prefixo, quantidade=1):
+    """
+    Reserva um bloco de `quantidade` códigos consecutivos do dia para o prefixo.
+    Usado por inserções em massa (bulk_create), onde save() não é chamado.
+
+    O número tem pelo menos 4 dígitos; a partir de 10000 no mesmo dia ganha
+    mais dígitos (ler com numero_do_codigo, nunca com os últimos 4 caracteres).
+    """
+    if quantidade < 1:
+        return []
+    hoje = timezone.now().date()
+    ultimo = _incrementar_sequencia(prefixo, hoje, quantidade)
+    dia = hoje.strftime("%Y%m%d")
+    return [f"{prefixo}{dia}{n:04d}" for n in range(ultimo - quantidade + 1, ultimo + 1)]
+
+
+def numero_do_codigo(codigo):
+    """Número sequencial de um código (REQ202511130001 -> 1); None se não tiver o formato."""
+    correspondencia = re.fullmatch(r"[A-Z]+\d{8}(\d{4,})", codigo or "")
+    return int(correspondencia.group(1)) if correspondencia else None
+
+
+def gerar_codigo(prefixo, modelo=None):
+    """Gera o próximo código do dia para o prefixo (ex.: REQ202511130001)."""
+    return reservar_codigos(prefixo, 1)[0]
 
 # =====================================
 # MIXIN PARA ID CUSTOM
@@ -64,6 +148,8 @@ class Paciente(CustomIDMixin):
     proveniencia = models.CharField("Proveniência", max_length=50, choices=Proveniencia.choices, default=Proveniencia.OUTRO, blank=True)
     email = models.EmailField("Email", blank=True, null=True, unique=True, default=None )
     data_registo = models.DateTimeField("Data de registo", auto_now_add=True)
+    # nome sem acentos + dígitos do contacto; ver lab.utils.pesquisa_pacientes
+    texto_pesquisa = models.TextField(editable=False, blank=True, default="")
 
     class Meta:
         verbose_name = "Paciente"
@@ -73,6 +159,14 @@ class Paciente(CustomIDMixin):
     def __str__(self):
         return self.nome
 
+    def save(self, *args, **kwargs):
+        from .utils.pesquisa_pacientes import texto_pesquisa
+        self.texto_pesquisa = texto_pesquisa(self)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"nome", "contacto"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "texto_pesquisa"}
+        super().save(*args, **kwargs)
+
     def idade(self):
         if not self.data_nascimento:
             return "—"
@@ -159,6 +253,69 @@ class ExameCampo(models.Model):
 # =====================================
 # REQUISIÇÃO DE ANÁLISE
 # =====================================
+class RequisicaoAnaliseQuerySet(models.QuerySet):
+    def with_progress(self):
+        """
+        Anota progresso_total, progresso_pendentes e progresso_validados com
+        uma única agregação sobre os resultados, em vez de três COUNT por
+        requisição. As propriedades total_resultados, pendentes e validados
+        usam estas anotações quando existem.
+        """
+        return self.annotate(
+            progresso_total=models.Count("resultados", distinct=True),
+            progresso_pendentes=models.Count(
+                "resultados", filter=models.Q(resultados__validado=False), distinct=True
+            ),
+            progresso_validados=models.Count(
+                "resultados", filter=models.Q(resultados__validado=True), distinct=True
+            ),
+        )
+
+    def ajustar_contadores(self, resultados=0, validados=0):
+        """
+        Soma `resultados`/`validados` a n_resultados/n_validados num único
+        UPDATE e, no mesmo UPDATE, passa a "VAL" as requisições que ficam com
+        todos os resultados validados e devolve a "PEND" as validadas que
+        deixam de o estar (resultado novo ou validação retirada). Os lados
+        direitos do SET usam os valores anteriores da linha.
+        """
+        iguais = models.Q(n_validados=models.F("n_resultados") + (resultados - validados))
+        completa = iguais & models.Q(n_resultados__gt=-resultados)
+        promover = completa & ~models.Q(status="VAL")
+        despromover = ~iguais & models.Q(status="VAL")
+        return self.update(
+            n_resultados=Greatest(models.F("n_resultados") + resultados, 0),
+            n_validados=Greatest(models.F("n_validados") + validados, 0),
+            status=models.Case(
+                models.When(completa, then=models.Value("VAL")),
+                models.When(despromover, then=models.Value("PEND")),
+                default=models.F("status"),
+            ),
+            updated_at=models.Case(
+                models.When(promover | despromover, then=models.Value(timezone.now())),
+                default=models.F("updated_at"),
+            ),
+        )
+
+    def reconciliar_contadores(self):
+        """
+        Recalcula n_resultados/n_validados a partir de ResultadoItem nas
+        requisições em que divergem; devolve o número de requisições corrigidas.
+        """
+        def contagem(**filtros):
+            return Coalesce(models.Subquery(
+                ResultadoItem.objects.filter(requisicao=models.OuterRef("pk"), **filtros)
+                .order_by().values("requisicao").annotate(n=models.Count("id")).values("n")
+            ), 0)
+
+        desfasadas = self.annotate(real_resultados=contagem(), real_validados=contagem(validado=True)).exclude(
+            n_resultados=models.F("real_resultados"), n_validados=models.F("real_validados")
+        )
+        return self.model.objects.filter(pk__in=desfasadas.values("pk")).update(
+            n_resultados=contagem(), n_validados=contagem(validado=True)
+        )
+
+
 class RequisicaoAnalise(CustomIDMixin):
     prefixo = "REQ"
 
@@ -175,36 +332,67 @@ class RequisicaoAnalise(CustomIDMixin):
     status = models.CharField("Estado", max_length=10, choices=STATUS, default="PEND")
     created_at = models.DateTimeField("Criada em", auto_now_add=True)
     updated_at = models.DateTimeField("Atualizada em", auto_now=True)
+    # mantidos por UPDATE incremental (ver RequisicaoAnaliseQuerySet.ajustar_contadores)
+    n_resultados = models.PositiveIntegerField("Nº de resultados", default=0, editable=False)
+    n_validados = models.PositiveIntegerField("Nº de resultados validados", default=0, editable=False)
+
+    CONTADORES = ("n_resultados", "n_validados")
+
+    objects = RequisicaoAnaliseQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Requisição"
         verbose_name_plural = "Requisições"
         ordering = ["-created_at"]
+        indexes = [
+            # changelist filtrado por estado e ordenado por data
+            models.Index(fields=["status", "-created_at"], name="lab_req_status_criada_idx"),
+            # ordenação por omissão e paginação por cursor da API (-created_at, -id)
+            models.Index(fields=["-created_at", "-id"], name="lab_req_criada_id_idx"),
+            # histórico do paciente: requisições anteriores, da mais recente para a mais antiga
+            models.Index(fields=["paciente", "-created_at"], name="lab_req_pac_criada_idx"),
+        ]
 
     def __str__(self):
         return f"{self.id_custom} - {self.paciente}"
+
+    def save(self, *args, **kwargs):
+        # um save() normal não deve repor contadores lidos antes de um UPDATE incremental
+        if not self._state.adding and kwargs.get("update_fields") is None and not args:
+            excluidos = set(self.CONTADORES) | self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                f.attname for f in self._meta.concrete_fields
+                if not f.primary_key and f.attname not in excluidos
+            ]
+        super().save(*args, **kwargs)
     
     def analista_display(self):
         return f'{self.analista.first_name} {self.analista.last_name}'
     
     def criar_resultados_automaticos(self):
-        for exame in self.exames.all():
-            for campo in exame.campos.all():
-                ResultadoItem.objects.get_or_create(
-                    requisicao=self,
-                    exame_campo=campo
-                )
+        from .utils.resultados import materializar_resultados
+        return materializar_resultados(self)
+
+    def marcar_validada(self):
+        self.status = "VAL"
+        self.save(update_fields=["status", "updated_at"])
 
     @property
     def total_resultados(self):
+        if hasattr(self, "progresso_total"):
+            return self.progresso_total
         return self.resultados.count()
 
     @property
     def pendentes(self):
+        if hasattr(self, "progresso_pendentes"):
+            return self.progresso_pendentes
         return self.resultados.filter(validado=False).count()
 
     @property
     def validados(self):
+        if hasattr(self, "progresso_validados"):
+            return self.progresso_validados
         return self.resultados.filter(validado=True).count()
 
 # =====================================
@@ -215,6 +403,114 @@ from django.db import models
 from django.contrib.auth.models import User
 
 
+class PercentilCont(models.Aggregate):
+	"""percentile_cont(fracao) WITHIN GROUP (ORDER BY expr) — PostgreSQL."""
+	function = "percentile_cont"
+	name = "PercentilCont"
+	template = "%(function)s(%(fracao)s) WITHIN GROUP (ORDER BY %(expressions)s)"
+	output_field = models.FloatField()
+
+	def __init__(self, expression, fracao, **extra):
+		super().__init__(expression, fracao=float(fracao), **extra)
+
+
+class ResultadoItemQuerySet(models.QuerySet):
+	"""
+	Agregações sobre ResultadoItem.valor_numerico feitas na base de dados
+	(nenhuma linha de resultado é trazida para o Python).
+	"""
+
+	def numericos(self):
+		return self.filter(valor_numerico__isnull=False)
+
+	def fora_do_intervalo(self, sentido=None):
+		"""
+		Resultados abaixo ("L") / acima ("H") do valor de referência do
+		campo, ou fora dele em qualquer sentido (None). Ver condicoes_fora().
+		"""
+		campos = self.numericos().order_by().values_list("exame_campo", flat=True).distinct()
+		abaixo, acima = self.condicoes_fora(campos)
+		condicao = {"L": abaixo, "H": acima}.get(sentido, abaixo | acima)
+		return self.filter(condicao)
+
+	@staticmethod
+	def condicoes_fora(campos):
+		"""
+		(Q abaixo, Q acima) do intervalo de referência para os ExameCampo
+		indicados, com os limites de lab.utils.referencias. Referências por
+		sexo usam o género do paciente; por idade, a união das faixas.
+		"""
+		from .utils import catalogo, referencias
+
+		cat = catalogo.obter()
+		nada = models.Q(pk__in=[])
+		abaixo, acima = nada, nada
+		for campo_id in campos:
+			campo = cat.campo(campo_id)
+			if campo is None:
+				continue
+			ref = referencias.interpretar(campo.valor_referencia)
+			por_sexo = any(iv.sexo for iv in ref.intervalos)
+			for sexo in ("M", "F", None) if por_sexo else (None,):
+				baixo, alto = ref.limites(sexo, None)[:2]
+				filtro = models.Q(exame_campo=campo_id)
+				if por_sexo:
+					filtro &= (
+						models.Q(requisicao__paciente__genero=sexo) if sexo
+						else ~models.Q(requisicao__paciente__genero__in=["M", "F"])
+					)
+				if baixo == baixo:  # não é NaN
+					abaixo |= filtro & models.Q(valor_numerico__lt=baixo)
+				if alto == alto:
+					acima |= filtro & models.Q(valor_numerico__gt=alto)
+		return abaixo, acima
+
+	def estatisticas(self):
+		"""
+		Por exame_campo: n, média, mínimo, máximo, desvio-padrão e número de
+		resultados abaixo/acima da referência, numa única consulta agregada.
+		"""
+		qs = self.numericos().order_by()
+		abaixo, acima = self.condicoes_fora(qs.values_list("exame_campo", flat=True).distinct())
+		return list(
+			qs.values("exame_campo").annotate(
+				n=models.Count("valor_numerico"),
+				media=models.Avg("valor_numerico"),
+				minimo=models.Min("valor_numerico"),
+				maximo=models.Max("valor_numerico"),
+				desvio=models.StdDev("valor_numerico"),
+				abaixo=models.Count("pk", filter=abaixo),
+				acima=models.Count("pk", filter=acima),
+			).order_by("exame_campo")
+		)
+
+	def percentis(self, *fracoes):
+		"""
+		{fração: valor} dos percentis (interpolação linear, como
+		percentile_cont) de valor_numerico; None sem resultados numéricos.
+		No PostgreSQL numa só consulta; nas outras bases com uma contagem e
+		uma consulta de até duas linhas por fração, ordenada pelo índice.
+		"""
+		qs = self.numericos().order_by()
+		if connections[self.db].vendor == "postgresql":
+			valores = qs.aggregate(**{f"p{i}": PercentilCont("valor_numerico", f) for i, f in enumerate(fracoes)})
+			return {f: valores[f"p{i}"] for i, f in enumerate(fracoes)}
+		n = qs.count()
+		resultado = {}
+		for f in fracoes:
+			if not n:
+				resultado[f] = None
+				continue
+			posicao = f * (n - 1)
+			inicio = int(posicao)
+			valores = list(qs.order_by("valor_numerico").values_list("valor_numerico", flat=True)[inicio:inicio + 2])
+			if len(valores) == 1:
+				resultado[f] = valores[0]
+			else:
+				resultado[f] = valores[0] + (valores[1] - valores[0]) * (posicao - inicio)
+		return resultado
+
+
 class ResultadoItem(CustomIDMixin):
 	prefixo = "RES"
 
@@ -230,6 +526,8 @@ class ResultadoItem(CustomIDMixin):
 		verbose_name="Exame"
 	)
 	resultado = models.CharField("Resultado", max_length=120, blank=True)
+	# `resultado` convertido em número (None se não for numérico), mantido em save()
+	valor_numerico = models.FloatField("Valor numérico", null=True, blank=True, editable=False)
 
 	unidade = models.ForeignKey(
 		ExameCampo,
@@ -257,15 +555,55 @@ class ResultadoItem(CustomIDMixin):
 		related_name="validacoes_resultado"
 	)
 	data_validacao = models.DateTimeField("Data de validação", null=True, blank=True)
+	# marca de alteração para as exportações incrementais (lab.utils.exportacao)
+	atualizado_em = models.DateTimeField("Atualizado em", auto_now=True)
+
+	objects = ResultadoItemQuerySet.as_manager()
 
 	class Meta:
 		verbose_name = "Resultado"
 		verbose_name_plural = "Resultados"
 		ordering = ["requisicao", "exame_campo"]
+		constraints = [
+			# um resultado por campo e requisição; serve também de índice (requisicao, exame_campo)
+			models.UniqueConstraint(fields=["requisicao", "exame_campo"], name="lab_res_req_campo_uniq"),
+		]
+		indexes = [
+			# filtros do admin por validado / data de validação
+			models.Index(fields=["validado", "data_validacao"], name="lab_res_valid_data_idx"),
+			# resultados pendentes de uma requisição (só as linhas por validar)
+			models.Index(fields=["requisicao"], condition=models.Q(validado=False), name="lab_res_pendentes_idx"),
+			# estatísticas, percentis e limites por campo (só resultados numéricos)
+			models.Index(
+				fields=["exame_campo", "valor_numerico"],
+				condition=models.Q(valor_numerico__isnull=False),
+				name="lab_res_campo_valor_idx",
+			),
+			# linhas alteradas desde a última exportação
+			models.Index(fields=["atualizado_em"], name="lab_res_atualizado_idx"),
+		]
 
 	def __str__(self):
 		return f"{self.id_custom} - {self.exame_campo.nome_campo}"
 
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instancia = super().from_db(db, field_names, values)
+		# valor gravado, para os sinais saberem se a validação mudou (contadores da requisição)
+		instancia._validado_bd = instancia.__dict__.get("validado")
+		return instancia
+
+	def save(self, *args, **kwargs):
+		from .utils.referencias import valor_numerico
+		valor = valor_numerico(self.resultado)
+		self.valor_numerico = valor if math.isfinite(valor) else None
+		update_fields = kwargs.get("update_fields")
+		if update_fields is not None:
+			# auto_now só é gravado se constar de update_fields
+			extra = {"atualizado_em", "valor_numerico"} if "resultado" in update_fields else {"atualizado_em"}
+			kwargs["update_fields"] = {*update_fields, *extra}
+		super().save(*args, **kwargs)
+
 	# ========================== MÉTODOS AUXILIARES ==========================
 	def validar(self, usuario):
 		"""Marca o resultado como validado."""
@@ -298,3 +636,75 @@ class ResultadoItem(CustomIDMixin):
 		return self.exame_campo.nome_campo
 	campo_nome.short_description = "Campo"
 
+
+
+# =====================================
+# HISTÓRICO DE OPERAÇÕES
+# =====================================
+class HistoricoOperacao(models.Model):
+    utilizador = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="historico_operacoes", verbose_name="Utilizador")
+    requisicao = models.ForeignKey(RequisicaoAnalise, on_delete=models.CASCADE, related_name="historico", verbose_name="Requisição")
+    acao = models.CharField("Ação", max_length=60)
+    detalhes = models.TextField("Detalhes", blank=True)
+    data = models.DateTimeField("Data", auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Histórico de Operação"
+        verbose_name_plural = "Histórico de Operações"
+        ordering = ["-data"]
+
+    def __str__(self):
+        return f"{self.acao} - {self.requisicao_id}"
+
+
+# =====================================
+# RESUMO DIÁRIO (VOLUME E TRL)
+# =====================================
+class ResumoDiarioExame(models.Model):
+    """
+    Volume e tempo de resposta de um exame num dia (dia local da criação da
+    requisição). Uma "requisição do exame" fica concluída quando todos os
+    seus resultados estão validados; o tempo de resposta vai da criação da
+    requisição à última validação. Mantido por `manage.py
+    calcular_resumos_diarios` (lab/utils/resumos.py), nunca editado à mão.
+    """
+    dia = models.DateField("Dia")
+    setor = models.CharField("Setor", max_length=40)
+    exame = models.ForeignKey(Exame, on_delete=models.CASCADE, related_name="resumos_diarios", verbose_name="Exame")
+    volume = models.PositiveIntegerField("Requisições", default=0)
+    validados = models.PositiveIntegerField("Concluídas", default=0)
+    trl_mediana_h = models.FloatField("TRL mediano (h)", null=True, blank=True)
+    trl_p95_h = models.FloatField("TRL p95 (h)", null=True, blank=True)
+    fora_trl = models.PositiveIntegerField("Acima do TRL", default=0)
+    calculado_em = models.DateTimeField("Calculado em")
+
+    class Meta:
+        verbose_name = "Resumo diário de exame"
+        verbose_name_plural = "Resumos diários de exames"
+        ordering = ["-dia", "setor", "exame"]
+        constraints = [
+            models.UniqueConstraint(fields=["dia", "exame"], name="lab_resumo_dia_exame_uniq"),
+        ]
+        indexes = [
+            # painel: intervalo de dias, opcionalmente de um setor
+            models.Index(fields=["setor", "dia"], name="lab_resumo_setor_dia_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.dia:%d/%m/%Y} - {self.exame_id}"
+
+
+class MarcaActualizacao(models.Model):
+    """
+    Até quando uma tarefa incremental (ex.: os resumos diários) já processou
+    as alterações; a execução seguinte parte daqui. Uma linha por tarefa.
+    """
+    tarefa = models.CharField("Tarefa", max_length=40, unique=True)
+    ate = models.DateTimeField("Processado até")
+
+    class Meta:
+        verbose_name = "Marca de actualização"
+        verbose_name_plural = "Marcas de actualização"
+
+    def __str__(self):
+        return f"{self.tarefa}: {self.ate:%d/%m/%Y %H:%M}"
@@ -0,0 +1,88 @@
+# lab/pagination.py
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+from .utils.cache_partilhada import EspacoCache
+
+contagens = EspacoCache("contagens")
+
+
+class CursorPaginacao(CursorPagination):
+    """
+    Paginação por cursor sobre colunas indexadas: o custo de cada página não
+    cresce com o tamanho da tabela (sem OFFSET nem COUNT(*)).
+
+    O tamanho da página vem de REST_FRAMEWORK["PAGE_SIZE"] e pode ser pedido
+    pelo cliente com ?page_size=, até MAX_PAGE_SIZE.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'REST_FRAMEWORK', {}).get('MAX_PAGE_SIZE', 500)
+    ordering = ('-id',)
+
+
+class PacientePaginacao(CursorPaginacao):
+    ordering = ('-id',)
+
+
+class ExamePaginacao(CursorPaginacao):
+    ordering = ('nome',)
+
+
+class ExameCampoPaginacao(CursorPaginacao):
+    ordering = ('id',)
+
+
+class RequisicaoPaginacao(CursorPaginacao):
+    ordering = ('-created_at', '-id')
+
+
+class ResultadoPaginacao(CursorPaginacao):
+    ordering = ('-id',)
+
+
+class ContagemEstimadaPaginator(Paginator):
+    """
+    Paginator do admin para tabelas grandes.
+
+    Sem filtros nem pesquisa, o total vem da estimativa do PostgreSQL
+    (pg_class.reltuples) em vez de um COUNT(*) que percorre a tabela; abaixo
+    de LIMITE_EXATO linhas, com filtros ou noutras bases de dados, conta
+    normalmente. Os totais com filtros ficam na cache partilhada (espaço
+    "contagens", validade CACHE_TTL["contagens"]), para que mudar de página
+    não repita o COUNT(*).
+    """
+    LIMITE_EXATO = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None:
+            return super().count
+        if not query.where:
+            estimativa = self._estimativa(self.object_list.db, self.object_list.model._meta.db_table)
+            if estimativa is not None and estimativa > self.LIMITE_EXATO:
+                return estimativa
+            return super().count
+        try:
+            sql, params = query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        chave = hashlib.sha1(repr((self.object_list.db, sql, params)).encode('utf-8')).hexdigest()
+        return contagens.get_or_set(chave, self.object_list.count)
+
+    @staticmethod
+    def _estimativa(alias, tabela):
+        connection = connections[alias]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [tabela])
+            linha = cursor.fetchone()
+        # -1 (ou 0) enquanto a tabela nunca foi analisada
+        return linha[0] if linha and linha[0] > 0 else None
@@ -1,11 +1,55 @@
 # lab/serializers.py
+from django.db import models
 from rest_framework import serializers
 from .models import Paciente, Exame, ExameCampo, RequisicaoAnalise, ResultadoItem
+from .utils import catalogo, referencias
+
+
+def _parametro_lista(request, nome):
+    """Lê ?nome=a,b,c do pedido; devolve None se o parâmetro não foi enviado."""
+    if request is None or nome not in request.query_params:
+        return None
+    return {v.strip() for v in request.query_params.get(nome, '').split(',') if v.strip()}
+
+
+def campos_pedidos(request):
+    """Campos pedidos com ?fields= (None = todos)."""
+    return _parametro_lista(request, 'fields')
+
+
+def expansoes_pedidas(request, expansiveis):
+    """Relações a aninhar pedidas com ?expand= (sem o parâmetro, todas)."""
+    pedidas = _parametro_lista(request, 'expand')
+    return set(expansiveis) if pedidas is None else pedidas & set(expansiveis)
+
+
+class CamposDinamicosMixin:
+    """
+    Sparse fieldsets (?fields=id,paciente) e expansão opcional das relações
+    aninhadas (?expand=paciente,exames). Relações não expandidas são devolvidas
+    apenas com as chaves primárias.
+    """
+    expansiveis = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+
+        campos = campos_pedidos(request)
+        if campos is not None:
+            for nome in set(self.fields) - campos:
+                self.fields.pop(nome)
+
+        expandir = expansoes_pedidas(request, self.expansiveis)
+        for nome in self.expansiveis:
+            if nome in self.fields and nome not in expandir:
+                many = isinstance(self.fields[nome], serializers.ListSerializer)
+                self.fields[nome] = serializers.PrimaryKeyRelatedField(read_only=True, many=many)
 
 class PacienteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Paciente
-        fields = '__all__'
+        exclude = ('texto_pesquisa',)
 
 class ExameCampoSerializer(serializers.ModelSerializer):
     class Meta:
@@ -13,20 +57,53 @@ class ExameCampoSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 class ExameSerializer(serializers.ModelSerializer):
-    campos = ExameCampoSerializer(many=True, read_only=True, source='examecampo_set')
+    # campos lidos do catálogo em cache (lab.utils.catalogo), sem prefetch
+    campos = serializers.SerializerMethodField()
     class Meta:
         model = Exame
         fields = '__all__'
 
+    def get_campos(self, exame):
+        return ExameCampoSerializer(catalogo.obter().campos_do_exame(exame.pk), many=True, context=self.context).data
+
+class ResultadoItemListSerializer(serializers.ListSerializer):
+    """Calcula o sinal de todos os resultados da lista de uma vez (lab.utils.referencias)."""
+
+    def to_representation(self, data):
+        # aninhado numa requisição, `data` é o gestor da relação e traz a requisição
+        requisicao = getattr(data, 'instance', None)
+        if isinstance(data, models.Manager):
+            data = data.all()
+        return super().to_representation(referencias.sinalizar(data, requisicao))
+
+
 class ResultadoItemSerializer(serializers.ModelSerializer):
+    # "" | "N" | "L" | "H" | "LL" | "HH" face ao valor de referência
+    sinal = serializers.SerializerMethodField()
+
     class Meta:
         model = ResultadoItem
         fields = '__all__'
+        list_serializer_class = ResultadoItemListSerializer
+
+    def get_sinal(self, ri):
+        if not hasattr(ri, 'sinal'):
+            referencias.sinalizar([ri])
+        return ri.sinal
 
-class RequisicaoAnaliseSerializer(serializers.ModelSerializer):
+class ValidacaoLoteSerializer(serializers.Serializer):
+    requisicoes = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+    resultados = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+class RequisicaoAnaliseSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     paciente = PacienteSerializer(read_only=True)
     exames = ExameSerializer(many=True, read_only=True)
-    resultados = ResultadoItemSerializer(many=True, read_only=True, source='resultadoitem_set')
+    resultados = ResultadoItemSerializer(many=True, read_only=True)
+    total_resultados = serializers.IntegerField(read_only=True)
+    pendentes = serializers.IntegerField(read_only=True)
+    validados = serializers.IntegerField(read_only=True)
+
+    expansiveis = ('paciente', 'exames', 'resultados')
 
     class Meta:
         model = RequisicaoAnalise
@@ -6,10 +6,17 @@ Descrição: Automatiza criação de resultados, histórico e sincronização
 de estados entre modelos de análises laboratoriais.
 """
 
-from django.db.models.signals import post_save, m2m_changed
+import time
+
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, m2m_changed
 from django.dispatch import receiver
 from django.utils import timezone
-from .models import RequisicaoAnalise, ResultadoItem, HistoricoOperacao
+from .middleware import RenovacaoSessaoMiddleware
+from .models import Exame, ExameCampo, RequisicaoAnalise, ResultadoItem
+from .utils import catalogo, historico_paciente, pdf_cache
+from .utils.auditoria import registar_evento
+from .utils.resultados import materializar_resultados
 
 
 # ========================== REQUISIÇÃO ANALISE ==========================
@@ -20,57 +27,47 @@ def criar_resultados_apos_requisicao(sender, instance, created, **kwargs):
     todos os campos de resultados associados aos exames incluídos.
     """
     if created:
-        for exame in instance.exames.all():
-            for campo in exame.campos.all():
-                ResultadoItem.objects.get_or_create(
-                    requisicao=instance,
-                    exame_campo=campo,
-                    defaults={
-                        "unidade": campo.unidade,
-                        "valor_referencia": campo.valor_referencia,
-                    },
-                )
-        HistoricoOperacao.objects.create(
-            utilizador=instance.analista,
-            requisicao=instance,
-            acao="Criação de Requisição",
-            detalhes=f"Requisição criada para {instance.paciente.nome}.",
+        materializar_resultados(instance)
+        registar_evento(
+            instance.id,
+            "Criação de Requisição",
+            "Requisição criada para {paciente}.",
+            utilizador_id=instance.analista_id,
         )
 
 
 # ========================== ATUALIZAÇÃO DE EXAMES EM REQUISIÇÃO ==========================
 @receiver(m2m_changed, sender=RequisicaoAnalise.exames.through)
-def sincronizar_exames_requisicao(sender, instance, action, pk_set, **kwargs):
+def sincronizar_exames_requisicao(sender, instance, action, reverse, pk_set, **kwargs):
     """
     Mantém os resultados sincronizados com os exames da requisição.
     Cria novos ResultadoItem se novos exames forem adicionados.
     """
+    if reverse:
+        # exame.requisicoes.add(...): instance é um Exame
+        if action == "post_add":
+            for requisicao in RequisicaoAnalise.objects.filter(pk__in=pk_set):
+                materializar_resultados(requisicao, exames=[instance.pk])
+        return
+
     if action == "post_add":
-        for exame_id in pk_set:
-            exame = instance.exames.get(pk=exame_id)
-            for campo in exame.campos.all():
-                ResultadoItem.objects.get_or_create(
-                    requisicao=instance,
-                    exame_campo=campo,
-                    defaults={
-                        "unidade": campo.unidade,
-                        "valor_referencia": campo.valor_referencia,
-                    },
-                )
-        HistoricoOperacao.objects.create(
-            utilizador=instance.analista,
-            requisicao=instance,
-            acao="Adição de Exames",
-            detalhes=f"Foram adicionados novos exames à requisição {instance.id}.",
+        materializar_resultados(instance, exames=pk_set)
+        registar_evento(
+            instance.id,
+            "Adição de Exames",
+            "Foram adicionados novos exames à requisição {requisicao}.",
+            utilizador_id=instance.analista_id,
+            requisicao=instance.id,
         )
 
     elif action == "post_remove":
         # opcional: remover ResultadoItems de exames removidos
-        HistoricoOperacao.objects.create(
-            utilizador=instance.analista,
-            requisicao=instance,
-            acao="Remoção de Exames",
-            detalhes=f"Um ou mais exames foram removidos da requisição {instance.id}.",
+        registar_evento(
+            instance.id,
+            "Remoção de Exames",
+            "Um ou mais exames foram removidos da requisição {requisicao}.",
+            utilizador_id=instance.analista_id,
+            requisicao=instance.id,
         )
 
 
@@ -79,30 +76,121 @@ def sincronizar_exames_requisicao(sender, instance, action, pk_set, **kwargs):
 def registar_validacao(sender, instance, created, **kwargs):
     """
     Regista automaticamente no histórico cada resultado salvo ou validado.
+    Os eventos são agrupados e gravados no fim da transacção (ver utils.auditoria).
     """
+    data = ""
+    if instance.validado and instance.data_validacao:
+        data = timezone.localtime(instance.data_validacao).strftime('%d/%m/%Y %H:%M')
+
     if created:
-        HistoricoOperacao.objects.create(
-            utilizador=instance.requisicao.analista,
-            requisicao=instance.requisicao,
-            acao="Criação de Resultado",
-            detalhes=f"Campo '{instance.exame_campo.nome_campo}' criado para {instance.requisicao.paciente.nome}.",
+        registar_evento(
+            instance.requisicao_id,
+            "Criação de Resultado",
+            "Campo '{campo}' criado para {paciente}.",
+            exame_campo_id=instance.exame_campo_id,
         )
     else:
         acao = "Validação de Resultado" if instance.validado else "Atualização de Resultado"
-        detalhes = f"Campo '{instance.exame_campo.nome_campo}' atualizado."
+        detalhes = "Campo '{campo}' atualizado."
         if instance.validado:
-            detalhes += f" Validado por {instance.validado_por} em {timezone.localtime(instance.data_validacao).strftime('%d/%m/%Y %H:%M')}."
-        HistoricoOperacao.objects.create(
-            utilizador=instance.validado_por or instance.requisicao.analista,
-            requisicao=instance.requisicao,
-            acao=acao,
-            detalhes=detalhes,
+            detalhes += " Validado por {validador} em {data}."
+        registar_evento(
+            instance.requisicao_id,
+            acao,
+            detalhes,
+            utilizador_id=instance.validado_por_id,
+            exame_campo_id=instance.exame_campo_id,
+            validador_id=instance.validado_por_id,
+            data=data,
         )
 
     if instance.validado:
-        HistoricoOperacao.objects.create(
-            utilizador=instance.requisicao.analista,
-            requisicao=instance.requisicao,
-            acao="Validação de Resultado",
-            detalhes=f"Campo '{instance.exame_campo.nome_campo}' validado por {instance.validado_por} em {timezone.localtime(instance.data_validacao).strftime('%d/%m/%Y %H:%M')}.",
-        )
\ No newline at end of file
+        registar_evento(
+            instance.requisicao_id,
+            "Validação de Resultado",
+            "Campo '{campo}' validado por {validador} em {data}.",
+            exame_campo_id=instance.exame_campo_id,
+            validador_id=instance.validado_por_id,
+            data=data,
+        )
+
+
+# ========================== CONTADORES DA REQUISIÇÃO ==========================
+@receiver(post_save, sender=ResultadoItem)
+def actualizar_contadores_resultado(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Mantém RequisicaoAnalise.n_resultados/n_validados; só faz o UPDATE
+    quando o resultado é novo ou o seu estado de validação mudou.
+    """
+    if created:
+        delta_resultados, delta_validados = 1, int(instance.validado)
+    else:
+        anterior = getattr(instance, "_validado_bd", None)
+        if anterior is None or (update_fields is not None and "validado" not in update_fields):
+            return
+        delta_resultados, delta_validados = 0, int(instance.validado) - int(anterior)
+    instance._validado_bd = instance.validado
+    if delta_resultados or delta_validados:
+        RequisicaoAnalise.objects.filter(pk=instance.requisicao_id).ajustar_contadores(
+            delta_resultados, delta_validados
+        )
+
+
+@receiver(post_delete, sender=ResultadoItem)
+def descontar_resultado_apagado(sender, instance, origin=None, **kwargs):
+    """Desconta o resultado apagado (excepto quando é a própria requisição que está a ser apagada)."""
+    if isinstance(origin, RequisicaoAnalise) or getattr(origin, "model", None) is RequisicaoAnalise:
+        return
+    RequisicaoAnalise.objects.filter(pk=instance.requisicao_id).ajustar_contadores(-1, -int(instance.validado))
+
+
+# ========================== CACHE DE PDFs ==========================
+@receiver(post_save, sender=RequisicaoAnalise)
+@receiver(post_delete, sender=RequisicaoAnalise)
+def invalidar_pdfs_requisicao(sender, instance, **kwargs):
+    """Apaga da cache os PDFs da requisição alterada ou removida."""
+    pdf_cache.invalidar_no_commit(instance.pk)
+
+
+@receiver(post_save, sender=ResultadoItem)
+@receiver(post_delete, sender=ResultadoItem)
+def invalidar_pdfs_resultado(sender, instance, **kwargs):
+    """Apaga da cache os PDFs da requisição a que o resultado pertence."""
+    pdf_cache.invalidar_no_commit(instance.requisicao_id)
+
+
+# ========================== HISTÓRICO DO PACIENTE ==========================
+@receiver(post_save, sender=ResultadoItem)
+@receiver(post_delete, sender=ResultadoItem)
+def invalidar_historico_resultado(sender, instance, **kwargs):
+    """Muda, no fim da transacção, a versão do histórico do paciente do resultado."""
+    historico_paciente.invalidar_no_commit(instance.requisicao_id)
+
+
+@receiver(post_delete, sender=RequisicaoAnalise)
+def invalidar_historico_requisicao(sender, instance, **kwargs):
+    """
+    Os resultados apagados em cascata já não resolvem o paciente no fim da
+    transacção; a requisição removida indica-o directamente.
+    """
+    historico_paciente.invalidar_no_commit(paciente_id=instance.paciente_id)
+
+
+# ========================== CATÁLOGO DE EXAMES ==========================
+@receiver([post_save, post_delete], sender=Exame)
+@receiver([post_save, post_delete], sender=ExameCampo)
+def invalidar_catalogo(sender, **kwargs):
+    """Muda a versão do catálogo em cache no commit (ver utils.catalogo)."""
+    catalogo.invalidar_no_commit()
+
+
+# ========================== SESSÃO ==========================
+@receiver(user_logged_in)
+def marcar_renovacao_sessao(sender, request, user, **kwargs):
+    """
+    O login já grava a sessão: conta como renovação, para o primeiro pedido
+    seguinte não a voltar a gravar (ver RenovacaoSessaoMiddleware).
+    """
+    sessao = getattr(request, "session", None)
+    if sessao is not None:
+        sessao[RenovacaoSessaoMiddleware.CHAVE] = int(time.time())
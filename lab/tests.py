@@ -1,8 +1,35 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
 from .models import (
-    Paciente, Exame, RequisicaoAnalise, ItemRequisicao,
-    Resultado, ExameCampoResultado, ResultadoItem
+    Paciente, Exame, RequisicaoAnalise, ResultadoItem,
+    SequenciaDiaria, reservar_codigos, numero_do_codigo, ExameCampo, HistoricoOperacao, ResumoDiarioExame, MarcaActualizacao
+)
+from .middleware import RenovacaoSessaoMiddleware
+from .pagination import ContagemEstimadaPaginator
+from .utils.resultados import materializar_resultados
+from .utils.validacao import validar_requisicoes
+from .utils import (
+    cache_partilhada, catalogo, exportacao, folha_trabalho, historico_paciente, pdf_cache, pdf_generator,
+    pdf_jobs, pdf_lote, pesquisa_pacientes, referencias, resumos,
 )
 
 User = get_user_model()
@@ -145,3 +172,1244 @@ class SistemaLaboratorialTest(TestCase):
         for item in items:
             self.assertEqual(item.unidade, item.exame_campo.exame.unidade)
             self.assertEqual(item.valor_referencia, item.exame_campo.exame.valor_ref)
+
+
+class SequenciaDiariaTest(TestCase):
+    """
+    Alocação atómica dos códigos id_custom por prefixo e por dia.
+    """
+
+    def test_codigos_consecutivos(self):
+        p1 = Paciente.objects.create(nome="Paciente A", numero_id="A1")
+        p2 = Paciente.objects.create(nome="Paciente B", numero_id="B1")
+        self.assertEqual(numero_do_codigo(p2.id_custom), numero_do_codigo(p1.id_custom) + 1)
+        self.assertTrue(p1.id_custom.startswith("PAC"))
+
+    def test_reserva_em_bloco(self):
+        # noutras bases de dados o contador é confirmado fora da transacção do teste
+        antes = SequenciaDiaria.objects.filter(prefixo="REQ").values_list("ultimo_numero", flat=True).first() or 0
+        codigos = reservar_codigos("REQ", 5)
+        self.assertEqual(len(set(codigos)), 5)
+        seguinte = reservar_codigos("REQ", 1)[0]
+        self.assertEqual(numero_do_codigo(seguinte), numero_do_codigo(codigos[-1]) + 1)
+        self.assertEqual(SequenciaDiaria.objects.get(prefixo="REQ").ultimo_numero, antes + 6)
+
+    def test_mais_de_9999_codigos_no_dia(self):
+        SequenciaDiaria.objects.update_or_create(
+            prefixo="TST", dia=timezone.now().date(), defaults={"ultimo_numero": 9998}
+        )
+        codigos = reservar_codigos("TST", 2)
+        self.assertEqual([numero_do_codigo(c) for c in codigos], [9999, 10000])
+        self.assertEqual(codigos[1], f"TST{timezone.now():%Y%m%d}10000")
+
+
+class MaterializacaoResultadosTest(TestCase):
+    """
+    Criação em massa dos ResultadoItem em falta de uma requisição.
+    """
+
+    def setUp(self):
+        self.paciente = Paciente.objects.create(nome="Paciente M", numero_id="M1")
+        self.exame1 = Exame.objects.create(nome="Hemograma", codigo="HEM")
+        self.exame2 = Exame.objects.create(nome="Glicose", codigo="GLI")
+        for ordem, nome in enumerate(["Hemácias", "Leucócitos", "Plaquetas"], start=1):
+            ExameCampo.objects.create(exame=self.exame1, nome_campo=nome, ordem=ordem)
+        ExameCampo.objects.create(exame=self.exame2, nome_campo="Glicemia")
+        self.requisicao = RequisicaoAnalise.objects.create(paciente=self.paciente)
+        self.requisicao.exames.set([self.exame1, self.exame2])
+
+    def test_cria_apenas_em_falta(self):
+        # o sinal m2m_changed já materializou os resultados ao definir os exames
+        self.assertEqual(self.requisicao.resultados.count(), 4)
+        self.assertEqual(materializar_resultados(self.requisicao), 0)
+        self.requisicao.resultados.filter(exame_campo__exame=self.exame2).delete()
+        self.assertEqual(materializar_resultados(self.requisicao), 1)
+        codigos = set(self.requisicao.resultados.values_list("id_custom", flat=True))
+        self.assertEqual(len(codigos), 4)
+
+    def test_numero_constante_de_consultas(self):
+        self.requisicao.resultados.all().delete()
+        # diferença de conjuntos + reserva de códigos + bulk_create + contagem dos inseridos + contador
+        with self.assertNumQueries(5):
+            self.assertEqual(materializar_resultados(self.requisicao), 4)
+
+    def test_conflito_nao_conta(self):
+        # como se outra transacção tivesse criado um dos campos depois de calculada a diferença
+        campos = list(ExameCampo.objects.filter(exame__in=[self.exame1, self.exame2]).values_list("id", flat=True))
+        self.requisicao.resultados.exclude(exame_campo_id=campos[0]).delete()
+        RequisicaoAnalise.objects.filter(pk=self.requisicao.pk).update(n_resultados=1)
+        self.assertEqual(materializar_resultados(self.requisicao, em_falta=campos), 3)
+        self.requisicao.refresh_from_db()
+        self.assertEqual(self.requisicao.n_resultados, 4)
+
+
+class AuditoriaAgrupadaTest(TestCase):
+    """
+    O histórico de operações é gravado em lote no commit da transacção.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tech2", password="123456")
+        self.paciente = Paciente.objects.create(nome="Paciente H", numero_id="H1")
+        self.exame = Exame.objects.create(nome="Hemograma", codigo="HEM")
+        for ordem in range(1, 6):
+            ExameCampo.objects.create(exame=self.exame, nome_campo=f"Campo {ordem}", ordem=ordem)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.requisicao = RequisicaoAnalise.objects.create(paciente=self.paciente, analista=self.user)
+            self.requisicao.exames.set([self.exame])
+
+    def test_validacao_grava_historico_num_lote(self):
+        HistoricoOperacao.objects.all().delete()
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                for ri in self.requisicao.resultados.all():
+                    ri.validar(self.user)
+        # um callback para o histórico, um para a cache de PDFs e um para o histórico do paciente
+        self.assertEqual(len(callbacks), 3)
+        self.assertEqual(HistoricoOperacao.objects.count(), 0)
+        with self.assertNumQueries(4):
+            callbacks[0]()
+        self.assertEqual(HistoricoOperacao.objects.filter(acao="Validação de Resultado").count(), 10)
+        self.assertIn("validado por tech2", HistoricoOperacao.objects.first().detalhes)
+
+    def test_transacao_revertida_descarta_eventos(self):
+        HistoricoOperacao.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.requisicao.resultados.first().validar(self.user)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(HistoricoOperacao.objects.count(), 0)
+
+    def test_savepoint_revertido_descarta_so_os_seus_eventos(self):
+        HistoricoOperacao.objects.all().delete()
+        primeiro, segundo = self.requisicao.resultados.all()[:2]
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                primeiro.validar(self.user)
+                try:
+                    with transaction.atomic():
+                        segundo.validar(self.user)
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+        detalhes = " ".join(HistoricoOperacao.objects.filter(acao="Validação de Resultado").values_list("detalhes", flat=True))
+        self.assertIn(primeiro.exame_campo.nome_campo, detalhes)
+        self.assertNotIn(segundo.exame_campo.nome_campo, detalhes)
+
+
+class ValidacaoEmMassaTest(TestCase):
+    """
+    Validação de várias requisições com um único UPDATE.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tech3", password="123456")
+        self.paciente = Paciente.objects.create(nome="Paciente V", numero_id="V1")
+        self.exame = Exame.objects.create(nome="Glicose", codigo="GLI")
+        ExameCampo.objects.create(exame=self.exame, nome_campo="Glicemia", ordem=1)
+        ExameCampo.objects.create(exame=self.exame, nome_campo="HbA1c", ordem=2)
+        self.requisicoes = []
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                req = RequisicaoAnalise.objects.create(paciente=self.paciente, analista=self.user)
+                req.exames.set([self.exame])
+                self.requisicoes.append(req)
+
+    def test_valida_e_muda_estado(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            total = validar_requisicoes(self.requisicoes, self.user)
+        self.assertEqual(total, 6)
+        self.assertFalse(ResultadoItem.objects.filter(validado=False).exists())
+        self.assertEqual(RequisicaoAnalise.objects.filter(status="VAL").count(), 3)
+        self.assertEqual(HistoricoOperacao.objects.filter(acao="Validação de Resultados").count(), 3)
+
+    def test_validacao_parcial_mantem_pendente(self):
+        req = self.requisicoes[0]
+        primeiro = req.resultados.first()
+        validar_requisicoes([req], self.user, resultados=[primeiro.id])
+        req.refresh_from_db()
+        self.assertEqual(req.status, "PEND")
+        self.assertEqual(req.resultados.filter(validado=True).count(), 1)
+
+
+class PaginacaoApiTest(TestCase):
+    """
+    As listagens da API são paginadas por cursor.
+    """
+
+    def setUp(self):
+        for i in range(5):
+            Paciente.objects.create(nome=f"Paciente {i}", numero_id=f"P{i}")
+
+    def test_paginas_por_cursor(self):
+        resp = self.client.get("/api/pacientes/", {"page_size": 2})
+        self.assertEqual(resp.status_code, 200)
+        dados = resp.json()
+        self.assertEqual(len(dados["results"]), 2)
+        self.assertIsNone(dados["previous"])
+        vistos = [p["id"] for p in dados["results"]]
+        while dados["next"]:
+            dados = self.client.get(dados["next"]).json()
+            vistos += [p["id"] for p in dados["results"]]
+        self.assertEqual(vistos, sorted(vistos, reverse=True))
+        self.assertEqual(len(set(vistos)), 5)
+
+
+class RequisicaoApiConsultasTest(TestCase):
+    """
+    Número constante de consultas por página na API de requisições.
+    """
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exame1 = Exame.objects.create(nome="Hemograma", codigo="HEM")
+            self.exame2 = Exame.objects.create(nome="Glicose", codigo="GLI")
+            for exame in (self.exame1, self.exame2):
+                for ordem in range(1, 4):
+                    ExameCampo.objects.create(exame=exame, nome_campo=f"{exame.codigo} {ordem}", ordem=ordem)
+        self.addCleanup(catalogo.invalidar)
+        self.criar_requisicoes(3)
+
+    def criar_requisicoes(self, n):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(n):
+                paciente = Paciente.objects.create(nome=f"Paciente {i}", numero_id=f"Q{Paciente.objects.count()}")
+                req = RequisicaoAnalise.objects.create(paciente=paciente)
+                req.exames.set([self.exame1, self.exame2])
+
+    def test_consultas_constantes(self):
+        catalogo.obter()
+        # requisições+paciente, exames, resultados; os campos vêm do catálogo em cache
+        with self.assertNumQueries(3):
+            resp = self.client.get("/api/requisicoes/")
+        self.assertEqual(len(resp.json()["results"]), 3)
+        self.criar_requisicoes(5)
+        with self.assertNumQueries(3):
+            resp = self.client.get("/api/requisicoes/")
+        dados = resp.json()["results"]
+        self.assertEqual(len(dados), 8)
+        self.assertEqual(len(dados[0]["exames"][0]["campos"]), 3)
+        self.assertEqual(len(dados[0]["resultados"]), 6)
+
+    def test_fields_e_expand(self):
+        with self.assertNumQueries(1):
+            resp = self.client.get("/api/requisicoes/", {"fields": "id,id_custom,paciente", "expand": ""})
+        item = resp.json()["results"][0]
+        self.assertEqual(set(item), {"id", "id_custom", "paciente"})
+        self.assertIsInstance(item["paciente"], int)
+        with self.assertNumQueries(2):
+            resp = self.client.get("/api/requisicoes/", {"fields": "id,paciente,exames", "expand": "paciente"})
+        item = resp.json()["results"][0]
+        self.assertEqual(item["paciente"]["nome"][:8], "Paciente")
+        self.assertEqual(len(item["exames"]), 2)
+
+
+class CachePdfTest(TestCase):
+    """
+    PDFs validados são servidos da cache enquanto o conteúdo não muda.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        patcher = mock.patch.object(pdf_cache, "storage", FileSystemStorage(location=self.dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user(username="tech4", password="123456")
+        paciente = Paciente.objects.create(nome="Paciente C", numero_id="C1")
+        exame = Exame.objects.create(nome="Glicose", codigo="GLI")
+        ExameCampo.objects.create(exame=exame, nome_campo="Glicemia", ordem=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.requisicao = RequisicaoAnalise.objects.create(paciente=paciente, analista=self.user)
+            self.requisicao.exames.set([exame])
+            validar_requisicoes([self.requisicao], self.user)
+        self.requisicao.refresh_from_db()
+
+    def test_acerto_e_invalidacao(self):
+        with mock.patch.object(pdf_cache, "escrever_pdf_resultados", wraps=pdf_cache.escrever_pdf_resultados) as gerar:
+            pdf1, _ = pdf_cache.pdf_resultados(self.requisicao, apenas_validados=True)
+            pdf2, _ = pdf_cache.pdf_resultados(self.requisicao, apenas_validados=True)
+            self.assertEqual(gerar.call_count, 1)
+            self.assertEqual(pdf1, pdf2)
+            self.assertTrue(pdf1.startswith(b"%PDF"))
+
+            ResultadoItem.objects.filter(requisicao=self.requisicao).update(resultado="5.4")
+            pdf_cache.pdf_resultados(self.requisicao, apenas_validados=True)
+            self.assertEqual(gerar.call_count, 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, str(self.requisicao.pk)))), 1)
+
+    def test_abrir_devolve_ficheiro(self):
+        ficheiro, filename = pdf_cache.abrir_pdf_resultados(self.requisicao, apenas_validados=True)
+        with ficheiro:
+            self.assertEqual(ficheiro.read(4), b"%PDF")
+        self.assertIn(self.requisicao.id_custom, filename)
+        ficheiro, _ = pdf_cache.abrir_pdf_resultados(self.requisicao, apenas_validados=True)
+        with ficheiro:
+            self.assertTrue(ficheiro.name.startswith(self.dir))
+
+    def test_rotas_servem_da_cache_em_streaming(self):
+        self.client.force_login(self.user)
+        for rota in ("lab:pdf_requisicao", "lab:pdf_resultados"):
+            response = self.client.get(reverse(rota, args=[self.requisicao.pk]))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response["Content-Type"], "application/pdf")
+            self.assertIn(self.requisicao.id_custom, response["Content-Disposition"])
+            self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, str(self.requisicao.pk)))), 2)
+
+    @override_settings(PDF_CACHE={"MAX_BYTES": 1})
+    def test_limite_de_tamanho(self):
+        pdf_cache.pdf_resultados(self.requisicao, apenas_validados=True)
+        self.assertEqual(os.listdir(os.path.join(self.dir, str(self.requisicao.pk))), [])
+
+
+class CabecalhoPdfTest(TestCase):
+    """
+    O logótipo é codificado uma vez e o cabeçalho é partilhado entre páginas.
+    """
+
+    def test_cabecalho_como_form_xobject(self):
+        paciente = Paciente.objects.create(nome="Paciente H", numero_id="H1")
+        exame = Exame.objects.create(nome="Hemograma", codigo="HEM")
+        for ordem in range(120):
+            ExameCampo.objects.create(exame=exame, nome_campo=f"Campo {ordem}", ordem=ordem)
+        requisicao = RequisicaoAnalise.objects.create(paciente=paciente)
+        requisicao.exames.set([exame])
+
+        pdf_generator.recursos._imagens.clear()
+        with mock.patch.object(pdf_generator, "_safe_image_reader", wraps=pdf_generator._safe_image_reader) as leitor:
+            pdf, _ = pdf_generator.gerar_pdf_resultados(requisicao)
+            pdf_generator.gerar_pdf_resultados(requisicao)
+        self.assertEqual(leitor.call_count, 1)
+        self.assertGreater(pdf.count(b"/Type /Page\n"), 1)
+        # um Form XObject para o cabeçalho e outro para o total de páginas do rodapé
+        self.assertEqual(pdf.count(b"/Subtype /Form"), 2)
+
+
+@override_settings(PDF_RENDER={"WORKERS": 0})
+class ExportacaoPdfLoteTest(TestCase):
+    """
+    Várias requisições são exportadas num ZIP em streaming ou num único PDF.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        patcher = mock.patch.object(pdf_cache, "storage", FileSystemStorage(location=self.dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        exame = Exame.objects.create(nome="Ureia", codigo="URE")
+        ExameCampo.objects.create(exame=exame, nome_campo="Ureia", ordem=1)
+        self.requisicoes = []
+        for n in range(3):
+            paciente = Paciente.objects.create(nome=f"Paciente L{n}", numero_id=f"L{n}")
+            requisicao = RequisicaoAnalise.objects.create(paciente=paciente)
+            requisicao.exames.set([exame])
+            self.requisicoes.append(requisicao)
+
+    def test_zip_em_streaming(self):
+        response = pdf_lote.exportar(self.requisicoes, "resultados", "zip", apenas_validados=False)
+        self.assertTrue(response.streaming)
+        arquivo = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        nomes = arquivo.namelist()
+        self.assertEqual(len(nomes), 3)
+        self.assertIn(self.requisicoes[0].id_custom, nomes[0])
+        self.assertTrue(arquivo.read(nomes[0]).startswith(b"%PDF"))
+
+    def test_pdf_unico_com_numeracao_por_paciente(self):
+        if pdf_lote.PdfWriter is None:
+            self.skipTest("pypdf não instalado")
+        from pypdf import PdfReader
+
+        response = pdf_lote.exportar(self.requisicoes, "requisicao", "pdf")
+        leitor = PdfReader(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(len(leitor.pages), 3)
+        self.assertEqual(leitor.page_labels, [f"{r.id_custom}-1" for r in self.requisicoes])
+        self.assertEqual(len(leitor.outline), 3)
+
+    def test_pdf_unico_limitado(self):
+        with override_settings(PDF_RENDER=dict(settings.PDF_RENDER, MAX_PDF_UNICO=2)), \
+                mock.patch.object(pdf_jobs, "renderizar_em_lote") as renderizar:
+            with self.assertRaises(pdf_lote.LoteGrande):
+                pdf_lote.exportar(self.requisicoes, "resultados", "pdf")
+        renderizar.assert_not_called()
+
+    def test_accao_pdf_unico_recusa_lote_grande(self):
+        self.client.force_login(User.objects.create_superuser(username="admin", password="123456"))
+        with override_settings(PDF_RENDER=dict(settings.PDF_RENDER, MAX_PDF_UNICO=2)):
+            response = self.client.post(reverse("admin:lab_requisicaoanalise_changelist"), {
+                "action": "juntar_resultados_pdf",
+                "_selected_action": [r.pk for r in self.requisicoes],
+            }, follow=True)
+        self.assertContains(response, "no máximo 2 requisições")
+
+    def test_accao_do_admin_usa_zip_por_omissao(self):
+        admin = User.objects.create_superuser(username="admin", password="123456")
+        self.client.force_login(admin)
+        response = self.client.post(reverse("admin:lab_requisicaoanalise_changelist"), {
+            "action": "gerar_pdf_resultados",
+            "_selected_action": [r.pk for r in self.requisicoes],
+        })
+        self.assertEqual(response["Content-Type"], "application/zip")
+        self.assertEqual(len(zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))).namelist()), 3)
+
+
+class PdfJobsTest(TestCase):
+    """
+    O callback dos trabalhos de PDF conta falhas e cancelamentos e só reinicia o pool partido.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.dict(pdf_jobs._metricas, falhados=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, pdf_jobs, "_executor", pdf_jobs._executor)
+        self.addCleanup(setattr, pdf_jobs, "_em_curso", pdf_jobs._em_curso)
+
+    def _future(self, excecao=None, cancelado=False):
+        future = Future()
+        if cancelado:
+            future.cancel()
+        else:
+            future.set_exception(excecao)
+        return future
+
+    def test_pool_partido_e_reiniciado_uma_vez(self):
+        partido, novo = mock.Mock(), mock.Mock()
+        pdf_jobs._executor = partido
+        pdf_jobs._em_curso = 2
+        pdf_jobs._ao_terminar(partido, self._future(BrokenProcessPool()))
+        self.assertIsNone(pdf_jobs._executor)
+        partido.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+
+        # um future atrasado do pool antigo não derruba o pool que o substituiu
+        pdf_jobs._executor = novo
+        pdf_jobs._ao_terminar(partido, self._future(BrokenProcessPool()))
+        self.assertIs(pdf_jobs._executor, novo)
+        novo.shutdown.assert_not_called()
+        self.assertEqual(pdf_jobs._em_curso, 0)
+        self.assertEqual(pdf_jobs._metricas["falhados"], 2)
+
+    def test_cancelado_conta_como_falhado(self):
+        executor = mock.Mock()
+        pdf_jobs._executor = executor
+        pdf_jobs._em_curso = 1
+        pdf_jobs._ao_terminar(executor, self._future(cancelado=True))
+        self.assertIs(pdf_jobs._executor, executor)
+        self.assertEqual(pdf_jobs._em_curso, 0)
+        self.assertEqual(pdf_jobs._metricas["falhados"], 1)
+
+    def test_download_de_trabalho_inexistente(self):
+        self.client.force_login(User.objects.create_user(username="tech17", password="123456"))
+        with mock.patch.object(pdf_jobs, "caminho_pdf", return_value="/nao/existe.pdf"), \
+                mock.patch.object(pdf_jobs, "estado", return_value=None):
+            response = self.client.get(reverse("lab:pdf_trabalho_download", args=["abc"]))
+        self.assertEqual(response.status_code, 404)
+
+
+class RequisicaoAdminListagemTest(TestCase):
+    """
+    A listagem de requisições no admin faz o mesmo número de consultas
+    qualquer que seja o número de linhas, e a pesquisa por exame não duplica.
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username="admin", password="123456")
+        self.client.force_login(self.admin)
+        self.exames = [
+            Exame.objects.create(nome="Glicose Jejum", codigo="GLJ"),
+            Exame.objects.create(nome="Glicose Pós-Prandial", codigo="GLP"),
+        ]
+        self.url = reverse("admin:lab_requisicaoanalise_changelist")
+
+    def criar_requisicoes(self, n):
+        inicio = Paciente.objects.count()
+        for i in range(inicio, inicio + n):
+            paciente = Paciente.objects.create(nome=f"Paciente A{i}", numero_id=f"A{i}")
+            requisicao = RequisicaoAnalise.objects.create(paciente=paciente, analista=self.admin)
+            requisicao.exames.set(self.exames)
+
+    def contar_consultas(self, **params):
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return len(consultas), response
+
+    def test_consultas_constantes_por_pagina(self):
+        self.criar_requisicoes(2)
+        poucas, _ = self.contar_consultas()
+        self.criar_requisicoes(8)
+        muitas, _ = self.contar_consultas()
+        self.assertEqual(poucas, muitas)
+
+    def test_pesquisa_por_exame_sem_duplicados(self):
+        self.criar_requisicoes(3)
+        _, response = self.contar_consultas(q="glicose")
+        self.assertEqual(response.context["cl"].result_count, 3)
+        self.assertEqual(len(response.context["cl"].result_list), 3)
+        self.assertEqual(response.context["cl"].result_list[0].n_exames, 2)
+
+
+class ProgressoRequisicaoTest(TestCase):
+    """
+    with_progress() calcula total/pendentes/validados numa única consulta.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tech6", password="123456")
+        exame = Exame.objects.create(nome="Lipidograma", codigo="LIP")
+        for ordem in range(1, 5):
+            ExameCampo.objects.create(exame=exame, nome_campo=f"Campo {ordem}", ordem=ordem)
+        with self.captureOnCommitCallbacks(execute=True):
+            for n in range(3):
+                paciente = Paciente.objects.create(nome=f"Paciente P{n}", numero_id=f"P{n}")
+                requisicao = RequisicaoAnalise.objects.create(paciente=paciente, analista=self.user)
+                requisicao.exames.set([exame])
+            primeiro = requisicao.resultados.order_by("id")[:1]
+            validar_requisicoes([requisicao], self.user, resultados=primeiro)
+
+    def test_uma_consulta_para_todas_as_requisicoes(self):
+        with self.assertNumQueries(1):
+            progresso = sorted(
+                (r.total_resultados, r.pendentes, r.validados)
+                for r in RequisicaoAnalise.objects.with_progress()
+            )
+        self.assertEqual(progresso, [(4, 3, 1), (4, 4, 0), (4, 4, 0)])
+
+    def test_propriedades_sem_anotacao(self):
+        requisicao = RequisicaoAnalise.objects.filter(status="PEND").exclude(resultados__validado=True).first()
+        self.assertEqual((requisicao.total_resultados, requisicao.pendentes, requisicao.validados), (4, 4, 0))
+
+
+class ContadoresRequisicaoTest(TestCase):
+    """
+    n_resultados/n_validados acompanham a criação, validação e remoção de resultados.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tech7", password="123456")
+        exame = Exame.objects.create(nome="Função Renal", codigo="REN")
+        for ordem in range(1, 4):
+            ExameCampo.objects.create(exame=exame, nome_campo=f"Campo {ordem}", ordem=ordem)
+        paciente = Paciente.objects.create(nome="Paciente K", numero_id="K1")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.requisicao = RequisicaoAnalise.objects.create(paciente=paciente, analista=self.user)
+            self.requisicao.exames.set([exame])
+
+    def contadores(self):
+        return RequisicaoAnalise.objects.values_list("n_resultados", "n_validados", "status").get(pk=self.requisicao.pk)
+
+    def test_validacao_individual_promove_no_ultimo(self):
+        self.assertEqual(self.contadores(), (3, 0, "PEND"))
+        resultados = list(self.requisicao.resultados.all())
+        for ri in resultados[:-1]:
+            ri.validar(self.user)
+        self.assertEqual(self.contadores(), (3, 2, "PEND"))
+        # guardar uma instância desactualizada não repõe os contadores
+        self.requisicao.observacoes = "Amostra hemolisada"
+        self.requisicao.save()
+        with self.assertNumQueries(2):
+            resultados[-1].validar(self.user)
+        self.assertEqual(self.contadores(), (3, 3, "VAL"))
+        resultados[-1].validar(self.user)
+        self.assertEqual(self.contadores(), (3, 3, "VAL"))
+
+    def test_validacao_em_massa_e_remocao(self):
+        validar_requisicoes([self.requisicao], self.user)
+        self.assertEqual(self.contadores(), (3, 3, "VAL"))
+        self.requisicao.resultados.first().delete()
+        self.assertEqual(self.contadores(), (2, 2, "VAL"))
+
+    def test_validacao_retirada_volta_a_pendente(self):
+        validar_requisicoes([self.requisicao], self.user)
+        self.assertEqual(self.contadores(), (3, 3, "VAL"))
+        ri = self.requisicao.resultados.first()
+        ri.validado = False
+        ri.save()
+        self.assertEqual(self.contadores(), (3, 2, "PEND"))
+        ri.validar(self.user)
+        self.assertEqual(self.contadores(), (3, 3, "VAL"))
+        # um campo novo numa requisição validada também a reabre
+        campo = ExameCampo.objects.create(exame=ri.exame_campo.exame, nome_campo="Campo 4", ordem=4)
+        ResultadoItem.objects.create(requisicao=self.requisicao, exame_campo=campo)
+        self.assertEqual(self.contadores(), (4, 3, "PEND"))
+
+    def test_reconciliacao(self):
+        RequisicaoAnalise.objects.update(n_resultados=9, n_validados=7)
+        saida = io.StringIO()
+        call_command("reconciliar_contadores", stdout=saida)
+        self.assertEqual(self.contadores(), (3, 0, "PEND"))
+        self.assertIn("1 requisição", saida.getvalue())
+
+
+class IndicesCaminhosDeAcessoTest(TestCase):
+    """
+    Restrição única (requisição, campo) e comando de comparação de planos.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tech8", password="123456")
+        exame = Exame.objects.create(nome="Ionograma", codigo="ION")
+        ExameCampo.objects.create(exame=exame, nome_campo="Sódio", ordem=1)
+        paciente = Paciente.objects.create(nome="Paciente L", numero_id="L1")
+        self.requisicao = RequisicaoAnalise.objects.create(paciente=paciente, analista=self.user)
+        self.requisicao.exames.set([exame])
+
+    def test_resultado_duplicado_rejeitado(self):
+        existente = self.requisicao.resultados.get()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ResultadoItem.objects.create(requisicao=self.requisicao, exame_campo=existente.exame_campo)
+
+    def test_explicar_consultas_repoe_indices(self):
+        saida = io.StringIO()
+        call_command("explicar_consultas", stdout=saida)
+        self.assertIn("Resultados pendentes da requisição", saida.getvalue())
+        self.assertIn("-- sem índices --", saida.getvalue())
+        with connection.cursor() as cursor:
+            indices = connection.introspection.get_constraints(cursor, ResultadoItem._meta.db_table)
+        self.assertIn("lab_res_pendentes_idx", indices)
+        self.assertIn("lab_res_req_campo_uniq", indices)
+
+    def test_explicar_consultas_so_compara_indices_da_0009(self):
+        from lab.management.commands.explicar_consultas import INDICES_0009, Command
+
+        nomes = [indice.name for _, indice in Command().indices()]
+        self.assertCountEqual(nomes, INDICES_0009)
+        self.assertNotIn("lab_req_pac_criada_idx", nomes)
+
+
+class PesquisaPacientesTest(TestCase):
+    """
+    Pesquisa de pacientes por texto normalizado, prefixo de código e relevância.
+    """
+
+    def setUp(self):
+        self.ana = Paciente.objects.create(nome="Ana Conceição", numero_id="004512LA041", contacto="+244 923 111 222")
+        self.joana = Paciente.objects.create(nome="Joana Ananias", numero_id="N7781")
+        self.mariana = Paciente.objects.create(nome="Mariana Sousa", numero_id="N7782")
+
+    def nomes(self, termo):
+        return [p.nome for p in pesquisa_pacientes.pesquisar(termo)]
+
+    def test_texto_pesquisa_mantido_ao_gravar(self):
+        self.assertEqual(self.ana.texto_pesquisa, "ana conceicao 244923111222")
+        self.ana.nome = "Ana Conceição Brás"
+        self.ana.save(update_fields=["nome"])
+        self.ana.refresh_from_db()
+        self.assertEqual(self.ana.texto_pesquisa, "ana conceicao bras 244923111222")
+
+    def test_relevancia_e_acentos(self):
+        self.assertEqual(self.nomes("ANA"), ["Ana Conceição", "Joana Ananias", "Mariana Sousa"])
+        self.assertEqual(self.nomes("ananias"), ["Joana Ananias"])
+        self.assertEqual(self.nomes("conceicao ana"), ["Ana Conceição"])
+        self.assertEqual(self.nomes("an"), ["Ana Conceição"])
+        self.assertEqual(self.nomes("923 111"), ["Ana Conceição"])
+
+    def test_prefixo_de_codigo_primeiro(self):
+        self.assertEqual(self.nomes("n778"), ["Joana Ananias", "Mariana Sousa"])
+        self.assertEqual(self.nomes(self.mariana.id_custom), ["Mariana Sousa"])
+
+    def test_api_e_autocomplete(self):
+        self.assertIn(self.client.get("/api/pacientes/pesquisa/", {"q": "ana"}).status_code, (401, 403))
+        self.client.force_login(User.objects.create_user(username="pesq9", password="123456"))
+        resp = self.client.get("/api/pacientes/pesquisa/", {"q": "ana", "limite": 2})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([p["nome"] for p in resp.json()], ["Ana Conceição", "Joana Ananias"])
+        self.assertNotIn("texto_pesquisa", resp.json()[0])
+        self.assertEqual(self.client.get("/api/pacientes/pesquisa/").status_code, 400)
+
+        self.client.force_login(User.objects.create_superuser(username="admin2", password="123456"))
+        resp = self.client.get(reverse("admin:autocomplete"), {
+            "term": "sousa", "app_label": "lab", "model_name": "requisicaoanalise", "field_name": "paciente",
+        })
+        self.assertEqual([r["text"] for r in resp.json()["results"]], ["Mariana Sousa"])
+
+    def test_listagem_do_admin_mantem_relevancia(self):
+        self.client.force_login(User.objects.create_superuser(username="admin3", password="123456"))
+        url = reverse("admin:lab_paciente_changelist")
+        resp = self.client.get(url, {"q": "ana"})
+        self.assertEqual([p.nome for p in resp.context["cl"].result_list], ["Ana Conceição", "Joana Ananias", "Mariana Sousa"])
+        self.assertEqual(resp.context["cl"].get_ordering_field_columns(), {})
+        # ordenar por uma coluna substitui a relevância
+        resp = self.client.get(url, {"q": "ana", "o": "-2"})
+        self.assertEqual([p.nome for p in resp.context["cl"].result_list], ["Mariana Sousa", "Joana Ananias", "Ana Conceição"])
+
+
+class CatalogoCacheTest(TestCase):
+    """
+    Catálogo de exames em cache, com versão mudada no commit de cada alteração.
+    """
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exame = Exame.objects.create(nome="Lipidograma", codigo="LIP")
+            ExameCampo.objects.create(exame=self.exame, nome_campo="HDL", unidade="mg/dL", ordem=2)
+            ExameCampo.objects.create(exame=self.exame, nome_campo="Colesterol total", unidade="mg/dL", ordem=1)
+        self.addCleanup(catalogo.invalidar)
+
+    def test_sem_consultas_em_regime_estavel(self):
+        catalogo.obter()
+        with self.assertNumQueries(0):
+            campos = catalogo.obter().campos_do_exame(self.exame.pk)
+        self.assertEqual([c.nome_campo for c in campos], ["Colesterol total", "HDL"])
+        self.assertEqual(campos[0].exame.nome, "Lipidograma")
+
+    def test_versao_muda_no_commit(self):
+        versao = catalogo.versao()
+        campo = catalogo.obter().campos_do_exame(self.exame.pk)[0]
+        with self.captureOnCommitCallbacks() as callbacks:
+            ExameCampo.objects.filter(pk=campo.pk).update(unidade="mmol/L")
+            ExameCampo.objects.get(pk=campo.pk).save()
+            ExameCampo.objects.create(exame=self.exame, nome_campo="LDL", ordem=3)
+            # dentro da transacção lê-se o catálogo da própria transacção
+            self.assertEqual(len(catalogo.obter().campos_do_exame(self.exame.pk)), 3)
+            self.assertEqual(catalogo.versao(), versao)
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertNotEqual(catalogo.versao(), versao)
+        self.assertEqual(catalogo.obter().campo(campo.pk).unidade, "mmol/L")
+
+    def test_pdf_sem_consultas_ao_catalogo(self):
+        user = User.objects.create_user(username="tech9", password="123456")
+        paciente = Paciente.objects.create(nome="Paciente C", numero_id="C9")
+        requisicao = RequisicaoAnalise.objects.create(paciente=paciente, analista=user)
+        requisicao.exames.set([self.exame])
+        catalogo.obter()
+        with CaptureQueriesContext(connection) as consultas:
+            conteudo, _ = pdf_generator.gerar_pdf_resultados(requisicao)
+        self.assertTrue(conteudo.startswith(b"%PDF"))
+        tabela = ExameCampo._meta.db_table
+        self.assertFalse([q["sql"] for q in consultas if f'"{tabela}"' in q["sql"]])
+
+
+class CachePartilhadaTest(TestCase):
+    """
+    Espaços de nomes, validade por classe e estatísticas da cache partilhada.
+    """
+
+    def setUp(self):
+        cache_partilhada.limpar_estatisticas()
+        self.addCleanup(cache_partilhada.limpar_estatisticas)
+        self.espaco = cache_partilhada.EspacoCache("teste", classe="contagens")
+        self.addCleanup(self.espaco.delete, "x")
+
+    def test_prefixo_validade_e_estatisticas(self):
+        with override_settings(CACHE_TTL={"contagens": 5}):
+            self.assertEqual(cache_partilhada.ttl("contagens"), 5)
+            with mock.patch.object(cache_partilhada.cache, "set") as definir:
+                self.espaco.set("x", 1)
+            definir.assert_called_once_with("lab:teste:x", 1, 5)
+        calculos = []
+        for _ in range(3):
+            self.assertEqual(self.espaco.get_or_set("x", lambda: calculos.append(1) or 42), 42)
+        self.assertEqual(len(calculos), 1)
+        dados = cache_partilhada.estatisticas()["espacos"]["teste"]
+        self.assertEqual((dados["acertos"], dados["falhas"], dados["taxa_acerto"]), (2, 1, 0.6667))
+
+    def test_endpoint(self):
+        url = reverse("lab:cache_estatisticas")
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(User.objects.create_user(username="tech10", password="123456"))
+        dados = self.client.get(url).json()
+        self.assertIn("catalogo", dados["espacos"])
+        self.assertIn("backend", dados)
+
+    def test_contagem_filtrada_em_cache(self):
+        for i in range(3):
+            Paciente.objects.create(nome=f"Paciente Z{i}", numero_id=f"Z{i}")
+        qs = Paciente.objects.filter(nome__startswith="Paciente Z").order_by("id")
+        self.assertEqual(ContagemEstimadaPaginator(qs, 2).count, 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(ContagemEstimadaPaginator(qs, 2).count, 3)
+
+
+def _middleware_com_renovacao():
+    middleware = list(settings.MIDDLEWARE)
+    if "lab.middleware.RenovacaoSessaoMiddleware" not in middleware:
+        middleware.insert(middleware.index("django.contrib.sessions.middleware.SessionMiddleware") + 1,
+                          "lab.middleware.RenovacaoSessaoMiddleware")
+    return middleware
+
+
+@override_settings(
+    SESSION_ENGINE="django.contrib.sessions.backends.cached_db",
+    SESSION_SAVE_EVERY_REQUEST=False,
+    SESSAO_RENOVAR_APOS=300,
+    MIDDLEWARE=_middleware_com_renovacao(),
+)
+class RenovacaoSessaoTest(TestCase):
+    """
+    A sessão só é regravada (e a expiração renovada) uma vez por intervalo.
+    """
+
+    inicio = 1_000_000
+
+    def setUp(self):
+        with mock.patch("lab.signals.time.time", return_value=self.inicio):
+            self.client.force_login(User.objects.create_user(username="tech11", password="123456"))
+        self.url = reverse("lab:cache_estatisticas")
+
+    def escritas(self, agora):
+        with mock.patch("lab.middleware.time.time", return_value=agora), \
+                CaptureQueriesContext(connection) as consultas:
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        return sum(1 for q in consultas if "django_session" in q["sql"] and q["sql"].startswith(("UPDATE", "INSERT")))
+
+    def test_renovacao_agrupada(self):
+        inicio = self.inicio
+        # o login conta como renovação
+        self.assertEqual(self.escritas(inicio + 1), 0)
+        self.assertEqual(self.escritas(inicio + 60), 0)
+        self.assertEqual(self.escritas(inicio + 299), 0)
+        self.assertEqual(self.escritas(inicio + 300), 1)
+        self.assertEqual(self.escritas(inicio + 301), 0)
+
+    def test_sessao_sem_marca_gravada_no_primeiro_pedido(self):
+        sessao = self.client.session
+        del sessao[RenovacaoSessaoMiddleware.CHAVE]
+        sessao.save()
+        self.assertEqual(self.escritas(self.inicio + 1), 1)
+        self.assertEqual(self.escritas(self.inicio + 2), 0)
+
+    def test_limpar_sessoes(self):
+        passado = timezone.now() - timedelta(days=1)
+        for i in range(5):
+            Session.objects.create(session_key=f"expirada{i}", session_data="", expire_date=passado)
+        saida = io.StringIO()
+        call_command("limpar_sessoes", lote=2, stdout=saida)
+        self.assertFalse(Session.objects.filter(expire_date__lt=timezone.now()).exists())
+        self.assertTrue(Session.objects.exists())
+        self.assertIn("5 sessão", saida.getvalue())
+
+
+class ReferenciasTest(TestCase):
+    """
+    Interpretação de valor_referencia e sinalização em lote dos resultados.
+    """
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exame = Exame.objects.create(nome="Hemograma", codigo="HEMR")
+            self.hb = ExameCampo.objects.create(
+                exame=self.exame, nome_campo="Hemoglobina", ordem=1,
+                valor_referencia="H: 13 - 17; M: 12 - 15; Crítico: < 7 ou > 20",
+            )
+            self.plq = ExameCampo.objects.create(exame=self.exame, nome_campo="Plaquetas", ordem=2, valor_referencia="150 - 400")
+            self.obs = ExameCampo.objects.create(exame=self.exame, nome_campo="Observação", ordem=3, valor_referencia="")
+        self.addCleanup(catalogo.invalidar)
+
+    def requisicao(self, genero, resultados):
+        paciente = Paciente.objects.create(nome=f"Paciente {genero}", numero_id=f"R{genero}", genero=genero)
+        req = RequisicaoAnalise.objects.create(paciente=paciente)
+        req.exames.set([self.exame])
+        for campo, valor in resultados.items():
+            ri = ResultadoItem.objects.get(requisicao=req, exame_campo=campo)
+            ri.resultado = valor
+            ri.save(update_fields=["resultado"])
+        return req
+
+    def test_interpretar(self):
+        ref = referencias.interpretar("3,5 a 5,0; Crítico: < 2,5 ou > 6,5")
+        self.assertEqual(ref.limites(None, None), (3.5, 5.0, 2.5, 6.5))
+        self.assertEqual(referencias.interpretar("< 200").limites("F", 40)[1], 200.0)
+        por_sexo = referencias.interpretar("Masculino: 13-17 / Feminino: 12-15")
+        self.assertEqual(por_sexo.limites("F", 30)[:2], (12.0, 15.0))
+        # sem sexo conhecido aplica-se a união dos intervalos
+        self.assertEqual(por_sexo.limites(None, 30)[:2], (12.0, 17.0))
+        por_idade = referencias.interpretar("0-12 anos: 5-10; > 12 anos: 3-8")
+        self.assertEqual(por_idade.limites(None, 6)[:2], (5.0, 10.0))
+        self.assertEqual(por_idade.limites(None, 40)[:2], (3.0, 8.0))
+        self.assertEqual(referencias.interpretar("Negativo").intervalos, ())
+
+    def test_avaliar(self):
+        sinais = referencias.avaliar(
+            [1, 3, 4, 6, 7, float("nan"), 4],
+            [3.5] * 6 + [float("nan")], [5] * 6 + [float("nan")], [2.5] * 7, [6.5] * 7,
+        )
+        self.assertEqual(list(sinais), ["LL", "L", "N", "H", "HH", "", ""])
+
+    def test_sinal_por_sexo_na_revisao_pdf_e_api(self):
+        req_m = self.requisicao("M", {self.hb: "12,5", self.plq: "500", self.obs: "Normal"})
+        req_f = self.requisicao("F", {self.hb: "12,5", self.plq: "6", self.obs: ""})
+
+        itens = referencias.sinalizar(catalogo.ligar_campos(req_m.resultados.all()), req_m)
+        self.assertEqual([ri.sinal for ri in itens], ["L", "H", ""])
+
+        with mock.patch("lab.views.render", return_value=HttpResponse()) as render:
+            self.client.force_login(User.objects.create_user(username="tech12", password="123456"))
+            self.client.get(reverse("lab:revisar_resultados", args=[req_f.id]))
+        grouped = render.call_args.args[2]["grouped"]
+        self.assertEqual([ri.sinal for ri in grouped["Hemograma"]], ["N", "L", ""])
+
+        resp = self.client.get("/api/resultados/", {"page_size": 10})
+        sinais = {(r["requisicao"], r["exame_campo"]): r["sinal"] for r in resp.json()["results"]}
+        self.assertEqual(sinais[(req_m.id, self.hb.id)], "L")
+        self.assertEqual(sinais[(req_f.id, self.hb.id)], "N")
+        self.assertEqual(sinais[(req_f.id, self.plq.id)], "L")
+
+        pdf, _ = pdf_generator.gerar_pdf_resultados(req_m)
+        self.assertTrue(pdf.startswith(b"%PDF"))
+
+
+class ValorNumericoTest(TestCase):
+    """
+    ResultadoItem.valor_numerico mantido na gravação e agregações na base de dados.
+    """
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exame = Exame.objects.create(nome="Bioquímica", codigo="BIOQ")
+            self.hb = ExameCampo.objects.create(
+                exame=self.exame, nome_campo="Hemoglobina", ordem=1, valor_referencia="H: 13 - 17; M: 12 - 15",
+            )
+            self.gli = ExameCampo.objects.create(exame=self.exame, nome_campo="Glicose", ordem=2, valor_referencia="70 - 110")
+        self.addCleanup(catalogo.invalidar)
+        valores = [("M", "12,5", "60"), ("F", "12,5", "80"), ("M", "15", "120"), ("F", "Hemolisado", "100")]
+        for i, (genero, hb, gli) in enumerate(valores):
+            paciente = Paciente.objects.create(nome=f"Paciente N{i}", numero_id=f"N{i}", genero=genero)
+            req = RequisicaoAnalise.objects.create(paciente=paciente)
+            req.exames.set([self.exame])
+            for campo, valor in ((self.hb, hb), (self.gli, gli)):
+                ri = ResultadoItem.objects.get(requisicao=req, exame_campo=campo)
+                ri.resultado = valor
+                ri.save(update_fields=["resultado"])
+
+    def test_preenchido_na_gravacao(self):
+        valores = ResultadoItem.objects.filter(exame_campo=self.hb).order_by("id").values_list("valor_numerico", flat=True)
+        self.assertEqual(list(valores), [12.5, 12.5, 15.0, None])
+        ri = ResultadoItem.objects.filter(exame_campo=self.gli).first()
+        ri.resultado = ""
+        ri.save()
+        ri.refresh_from_db()
+        self.assertIsNone(ri.valor_numerico)
+
+    def test_estatisticas_e_fora_do_intervalo(self):
+        catalogo.obter()
+        # campos com resultados + uma agregação; os limites vêm do catálogo em cache
+        with self.assertNumQueries(2):
+            linhas = {l["exame_campo"]: l for l in ResultadoItem.objects.estatisticas()}
+        self.assertEqual(linhas[self.gli.id]["n"], 4)
+        self.assertAlmostEqual(linhas[self.gli.id]["media"], 90.0)
+        self.assertEqual((linhas[self.gli.id]["abaixo"], linhas[self.gli.id]["acima"]), (1, 1))
+        # 12,5 é baixo para um homem mas normal para uma mulher
+        self.assertEqual((linhas[self.hb.id]["abaixo"], linhas[self.hb.id]["acima"]), (1, 0))
+        self.assertEqual(ResultadoItem.objects.fora_do_intervalo("H").count(), 1)
+        self.assertEqual(ResultadoItem.objects.fora_do_intervalo().count(), 3)
+
+    def test_percentis(self):
+        qs = ResultadoItem.objects.filter(exame_campo=self.gli)
+        self.assertEqual(qs.percentis(0, 0.5, 1), {0: 60.0, 0.5: 90.0, 1: 120.0})
+        self.assertEqual(ResultadoItem.objects.none().percentis(0.5), {0.5: None})
+
+    def test_api(self):
+        self.assertIn(self.client.get("/api/resultados/estatisticas/").status_code, (401, 403))
+        self.client.force_login(User.objects.create_user(username="est12", password="123456"))
+        resp = self.client.get("/api/resultados/estatisticas/", {"exame_campo": self.gli.id})
+        dados = resp.json()
+        self.assertEqual((dados["n"], dados["mediana"]), (4, 90.0))
+        self.assertAlmostEqual(dados["p95"], 117.0)
+        self.assertEqual(self.client.get("/api/resultados/estatisticas/", {"exame_campo": "x"}).status_code, 400)
+
+
+class ExportacaoResultadosTest(TestCase):
+    """
+    Exportação colunar incremental (Parquet particionado) e fluxo Arrow da API.
+    """
+
+    def setUp(self):
+        self.destino = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.destino, ignore_errors=True)
+        self.hemo = Exame.objects.create(nome="Hemograma", codigo="HEXP", setor="Hematologia")
+        self.bioq = Exame.objects.create(nome="Glicemia", codigo="GEXP", setor="Bioquímica")
+        ExameCampo.objects.create(exame=self.hemo, nome_campo="Hemoglobina", ordem=1)
+        ExameCampo.objects.create(exame=self.bioq, nome_campo="Glicose", ordem=1)
+        paciente = Paciente.objects.create(nome="Paciente E", numero_id="E1", genero="F")
+        self.req = RequisicaoAnalise.objects.create(paciente=paciente)
+        self.req.exames.set([self.hemo, self.bioq])
+
+    def ler(self):
+        import pandas as pd
+        return pd.read_parquet(self.destino)
+
+    @mock.patch.object(exportacao, "MARGEM", timedelta(0))
+    def test_incremental_por_mes_e_setor(self):
+        call_command("export_results", destino=self.destino, chunk_size=1, stdout=io.StringIO())
+        df = self.ler()
+        self.assertEqual(len(df), 2)
+        self.assertEqual(sorted(df["setor"].astype(str)), ["Bioquímica", "Hematologia"])
+        self.assertNotIn("nome", df.columns)
+        self.assertEqual(len(os.listdir(self.destino)), 2)  # mes=... e _estado.json
+
+        # sem alterações: nada escrito
+        resumo = exportacao.exportar_parquet(self.destino)
+        self.assertEqual((resumo["linhas"], resumo["ficheiros"]), (0, []))
+
+        # só a linha alterada é reexportada
+        estado = exportacao.ler_estado(self.destino)
+        ri = ResultadoItem.objects.get(requisicao=self.req, exame_campo__exame=self.bioq)
+        ri.resultado = "5,4"
+        with mock.patch("django.utils.timezone.now", return_value=timezone.now() + timedelta(seconds=1)):
+            ri.save(update_fields=["resultado"])
+        resumo = exportacao.exportar_parquet(self.destino)
+        self.assertEqual((resumo["linhas"], len(resumo["ficheiros"])), (1, 1))
+        self.assertGreater(exportacao.ler_estado(self.destino)["ate"], estado["ate"])
+        df = self.ler().sort_values("atualizado_em").drop_duplicates("id", keep="last")
+        self.assertEqual(df.set_index("campo").loc["Glicose", "valor_numerico"], 5.4)
+
+    def test_api_arrow_e_parquet(self):
+        import pyarrow as pa
+        self.client.force_login(User.objects.create_user(username="tech13", password="123456"))
+        resp = self.client.get("/api/resultados/exportar/")
+        self.assertEqual(resp.status_code, 200)
+        tabela = pa.ipc.open_stream(b"".join(resp.streaming_content)).read_all()
+        self.assertEqual(tabela.num_rows, 2)
+        resp = self.client.get("/api/resultados/exportar/", {"formato": "parquet", "desde": "2999-01-01T00:00:00"})
+        self.assertEqual(b"".join(resp.streaming_content)[:4], b"PAR1")
+        self.assertEqual(self.client.get("/api/resultados/exportar/", {"desde": "ontem"}).status_code, 400)
+
+
+class ResumosDiariosTest(TestCase):
+    """
+    Resumos diários de volume/TRL: cálculo incremental, endpoint JSON e painel do admin.
+    """
+
+    def setUp(self):
+        from datetime import datetime
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exame = Exame.objects.create(nome="Glicemia", codigo="GTRL", setor="Bioquímica", trl_horas=24)
+            for ordem in (1, 2):
+                ExameCampo.objects.create(exame=self.exame, nome_campo=f"Campo {ordem}", ordem=ordem)
+        self.addCleanup(catalogo.invalidar)
+        self.dia = datetime(2026, 3, 2).date()
+        self.criada = timezone.make_aware(datetime(2026, 3, 2, 8, 0))
+        self.requisicoes = []
+        for i in range(3):
+            with mock.patch("django.utils.timezone.now", return_value=self.criada):
+                paciente = Paciente.objects.create(nome=f"Paciente T{i}", numero_id=f"T{i}")
+                req = RequisicaoAnalise.objects.create(paciente=paciente)
+                req.exames.set([self.exame])
+            self.requisicoes.append(req)
+        # concluídas em 10 h e 30 h; a terceira só tem um dos dois campos validado
+        self.validar(self.requisicoes[0], horas=10)
+        self.validar(self.requisicoes[1], horas=30)
+        self.validar(self.requisicoes[2], horas=5, campos=1)
+
+    def validar(self, req, horas, campos=2):
+        quando = self.criada + timedelta(hours=horas)
+        ids = list(req.resultados.order_by("exame_campo__ordem").values_list("id", flat=True)[:campos])
+        ResultadoItem.objects.filter(id__in=ids).update(validado=True, data_validacao=quando, atualizado_em=timezone.now())
+
+    def resumo(self):
+        return ResumoDiarioExame.objects.get(dia=self.dia, exame=self.exame)
+
+    def test_calculo_incremental(self):
+        call_command("calcular_resumos_diarios", stdout=io.StringIO())
+        r = self.resumo()
+        self.assertEqual((r.setor, r.volume, r.validados, r.fora_trl), ("Bioquímica", 3, 2, 1))
+        self.assertEqual((r.trl_mediana_h, r.trl_p95_h), (20.0, 29.0))
+
+        with mock.patch.object(resumos, "MARGEM", timedelta(0)):
+            self.assertEqual(resumos.actualizar()["dias"], 0)
+            self.validar(self.requisicoes[2], horas=48)
+            self.assertEqual(resumos.actualizar(), {"dias": 1, "linhas": 1})
+        r = self.resumo()
+        self.assertEqual((r.validados, r.fora_trl, r.trl_mediana_h), (3, 2, 30.0))
+
+    def test_blocos_de_dias_consecutivos(self):
+        d = self.dia
+        dias = [d + timedelta(days=n) for n in (0, 1, 2, 10, 11)] + [d + timedelta(days=20 + n) for n in range(35)]
+        blocos = list(resumos._blocos(reversed(dias)))
+        self.assertEqual([(b[0], len(b)) for b in blocos], [
+            (d, 3), (d + timedelta(days=10), 2),
+            (d + timedelta(days=20), resumos.DIAS_POR_BLOCO), (d + timedelta(days=20 + resumos.DIAS_POR_BLOCO), 4),
+        ])
+        # dias espaçados: cada um é lido e regravado sozinho, sem tocar nos dias entre eles
+        outro = ResumoDiarioExame.objects.create(
+            dia=d + timedelta(days=5), exame=self.exame, volume=7, validados=0, calculado_em=timezone.now()
+        )
+        with mock.patch.object(resumos, "_resumos", wraps=resumos._resumos) as calcular:
+            self.assertEqual(resumos.recalcular([d + timedelta(days=10), d]), 1)
+        self.assertEqual([c.args[:2] for c in calcular.call_args_list], [(d, d), (d + timedelta(days=10),) * 2])
+        self.assertEqual(self.resumo().volume, 3)
+        self.assertTrue(ResumoDiarioExame.objects.filter(pk=outro.pk).exists())
+
+    def test_dia_avulso_nao_avanca_a_marca(self):
+        with mock.patch.object(resumos, "MARGEM", timedelta(0)):
+            resumos.actualizar()
+            marca = MarcaActualizacao.objects.get(tarefa=resumos.TAREFA).ate
+            self.validar(self.requisicoes[2], horas=48)
+            call_command("calcular_resumos_diarios", dia=["2026-03-05"], stdout=io.StringIO())
+            self.assertEqual(MarcaActualizacao.objects.get(tarefa=resumos.TAREFA).ate, marca)
+            self.assertEqual(resumos.actualizar(), {"dias": 1, "linhas": 1})
+        self.assertEqual(self.resumo().validados, 3)
+
+    def test_endpoint_e_painel(self):
+        resumos.actualizar()
+        utilizador = User.objects.create_superuser(username="admin14", password="123456", email="a@b.c")
+        self.client.force_login(utilizador)
+        with self.assertNumQueries(4):  # utilizador e três agregações (a sessão vem da cache)
+            resp = self.client.get(reverse("lab:painel_trl_dados"), {"desde": "2026-03-01", "ate": "2026-03-31"})
+        dados = resp.json()
+        self.assertEqual(dados["setores"], [{
+            "setor": "Bioquímica", "volume": 3, "validados": 2, "fora_trl": 1, "trl_mediana_h": 20.0, "trl_p95_h": 29.0,
+        }])
+        self.assertEqual(dados["exames"][0]["exame"], "Glicemia")
+        self.assertEqual(dados["dias"][0]["dia"], "2026-03-02")
+        self.assertEqual(self.client.get(reverse("lab:painel_trl_dados"), {"desde": "ontem"}).status_code, 400)
+
+        resp = self.client.get(reverse("admin:lab_resumodiarioexame_painel"), {"desde": "2026-03-01", "ate": "2026-03-31"})
+        self.assertContains(resp, "Glicemia")
+
+
+class HistoricoPacienteTest(TestCase):
+    """
+    Valores anteriores do paciente por campo (uma consulta com ROW_NUMBER) e
+    resumo por paciente em cache, invalidado no fim da transacção.
+    """
+
+    def setUp(self):
+        from datetime import datetime
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exame = Exame.objects.create(nome="Glicemia", codigo="GHIS")
+            self.campo = ExameCampo.objects.create(exame=self.exame, nome_campo="Glicose", unidade="mg/dL", ordem=1)
+        self.addCleanup(catalogo.invalidar)
+        self.paciente = Paciente.objects.create(nome="Paciente Histórico", numero_id="H1")
+        outro = Paciente.objects.create(nome="Outro Paciente", numero_id="H2")
+        self.requisicoes = []
+        # as invalidações agendadas correm aqui, para não ficarem pendentes na transacção do teste
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, (paciente, valor, validado) in enumerate([
+                (self.paciente, "80", True), (self.paciente, "90", True), (outro, "300", True),
+                (self.paciente, "95", False), (self.paciente, "100", True), (self.paciente, "110", False),
+            ]):
+                with mock.patch("django.utils.timezone.now", return_value=timezone.make_aware(datetime(2026, 1, i + 1, 9))):
+                    req = RequisicaoAnalise.objects.create(paciente=paciente)
+                    req.exames.set([self.exame])
+                ri = req.resultados.get()
+                ri.resultado, ri.validado = valor, validado
+                ri.save()
+                self.requisicoes.append(req)
+        self.actual = self.requisicoes[-1]
+
+    def test_anteriores_numa_consulta(self):
+        with self.assertNumQueries(1):
+            por_campo = historico_paciente.anteriores(self.actual, [self.campo.id], k=2)
+        # só validados, do mesmo paciente, do mais recente para o mais antigo
+        self.assertEqual([a.resultado for a in por_campo[self.campo.id]], ["100", "90"])
+        self.assertEqual(por_campo[self.campo.id][0].requisicao_id, self.requisicoes[4].id)
+
+        ri = historico_paciente.ligar_anteriores(self.actual.resultados.all(), self.actual)[0]
+        self.assertEqual([a.valor_numerico for a in ri.anteriores], [100.0, 90.0, 80.0])
+        self.assertEqual(ri.delta, 10.0)
+        # a primeira requisição não tem anteriores
+        self.assertEqual(historico_paciente.anteriores(self.requisicoes[0], [self.campo.id]), {})
+
+    def test_impressao_digital_so_muda_com_o_anterior_mostrado(self):
+        inicial = pdf_cache.impressao_digital(self.actual, com_anteriores=True)
+        # resultados de outras requisições que não aparecem na coluna "Anterior"
+        with self.captureOnCommitCallbacks(execute=True):
+            ResultadoItem.objects.filter(requisicao=self.requisicoes[3]).update(resultado="96")
+            self.requisicoes[0].resultados.get().save()
+        self.assertEqual(pdf_cache.impressao_digital(self.actual, com_anteriores=True), inicial)
+        ResultadoItem.objects.filter(requisicao=self.requisicoes[4]).update(resultado="101")
+        self.assertNotEqual(pdf_cache.impressao_digital(self.actual, com_anteriores=True), inicial)
+
+    def test_resumo_em_cache_e_invalidado(self):
+        resumo = historico_paciente.resumo(self.paciente.pk)
+        self.assertEqual(len(resumo), 1)
+        self.assertEqual(
+            (resumo[0]["campo"], resumo[0]["n"], resumo[0]["ultimo_resultado"], resumo[0]["minimo"], resumo[0]["maximo"]),
+            ("Glicose", 3, "100", 80.0, 100.0),
+        )
+        with self.assertNumQueries(0):
+            historico_paciente.resumo(self.paciente.pk)
+
+        versao = historico_paciente.versao(self.paciente.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            validar_requisicoes([self.actual], User.objects.create_user(username="val15", password="123456"))
+        self.assertNotEqual(historico_paciente.versao(self.paciente.pk), versao)
+        self.assertEqual(historico_paciente.resumo(self.paciente.pk)[0]["ultimo_resultado"], "110")
+
+        url = f"/api/pacientes/{self.paciente.pk}/historico/"
+        self.assertIn(self.client.get(url).status_code, (401, 403))
+        self.client.force_login(User.objects.create_user(username="hist15", password="123456"))
+        self.assertEqual(self.client.get(url).json()["campos"][0]["n"], 4)
+
+    def test_revisao_mostra_anteriores(self):
+        self.client.force_login(User.objects.create_user(username="tech15", password="123456"))
+        with mock.patch("lab.views.render", return_value=HttpResponse()) as render:
+            self.client.get(reverse("lab:revisar_resultados", args=[self.actual.id]))
+        ri = render.call_args.args[2]["grouped"]["Glicemia"][0]
+        self.assertEqual([a.resultado for a in ri.anteriores], ["100", "90", "80"])
+        self.assertEqual(ri.delta, 10.0)
+
+
+class FolhaTrabalhoTest(TestCase):
+    """
+    Folha de trabalho partilhada pelas views de preenchimento, revisão e
+    validação: requisição, exames, campos e resultados em três consultas.
+    """
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exames = []
+            for nome, codigo in (("Ureia", "URF"), ("Creatinina", "CRF")):
+                exame = Exame.objects.create(nome=nome, codigo=codigo)
+                for ordem in (1, 2):
+                    ExameCampo.objects.create(exame=exame, nome_campo=f"{nome} {ordem}", tipo="NUM", ordem=ordem)
+                self.exames.append(exame)
+        self.addCleanup(catalogo.invalidar)
+        paciente = Paciente.objects.create(nome="Paciente Folha", numero_id="F1")
+        self.requisicao = RequisicaoAnalise.objects.create(paciente=paciente)
+        self.requisicao.exames.set(self.exames)
+        self.user = User.objects.create_user(username="tech16", password="123456")
+        self.client.force_login(self.user)
+
+    def test_carregar_em_tres_consultas(self):
+        catalogo.obter()
+        with self.assertNumQueries(3):
+            folha = folha_trabalho.carregar(self.requisicao.id)
+            grupos = folha.agrupados()
+        self.assertEqual([e.nome for e in folha.exames], ["Creatinina", "Ureia"])
+        self.assertEqual(list(grupos), ["Creatinina", "Ureia"])
+        self.assertEqual([ri.exame_campo.nome_campo for ri in grupos["Ureia"]], ["Ureia 1", "Ureia 2"])
+        self.assertEqual((folha.progresso.total, folha.progresso.pendentes), (4, 4))
+        self.assertEqual(folha.paciente.nome, "Paciente Folha")
+
+        # guardada no pedido: a segunda leitura não volta à base de dados
+        pedido = mock.Mock(spec=[])
+        folha = folha_trabalho.obter(pedido, self.requisicao.id)
+        with self.assertNumQueries(0):
+            self.assertIs(folha_trabalho.obter(pedido, str(self.requisicao.id)), folha)
+
+    def test_preencher_cria_em_falta_e_grava(self):
+        self.requisicao.resultados.filter(exame_campo__exame=self.exames[0]).delete()
+        resp = self.client.get(reverse("lab:preencher_resultados", args=[self.requisicao.id]))
+        self.assertEqual(resp.status_code, 200)
+        itens = list(self.requisicao.resultados.order_by("exame_campo__exame__nome", "exame_campo__ordem"))
+        self.assertEqual(len(itens), 4)
+        self.assertContains(resp, f'name="ri_{itens[0].id}"')
+
+        dados = {f"ri_{ri.id}": str(10 + i) for i, ri in enumerate(itens)}
+        resp = self.client.post(reverse("lab:preencher_resultados", args=[self.requisicao.id]), dados)
+        self.assertRedirects(resp, reverse("lab:revisar_resultados", args=[self.requisicao.id]), fetch_redirect_response=False)
+        self.assertEqual(self.requisicao.resultados.get(pk=itens[3].pk).resultado, "13")
+
+    def test_validacao_sem_consultas_por_resultado(self):
+        catalogo.obter()
+        with mock.patch("lab.views.render", return_value=HttpResponse()) as render:
+            # três da folha e uma para os valores anteriores, seja qual for o número de campos
+            with self.assertNumQueries(4):
+                self.client.get(reverse("lab:validar_resultados", args=[self.requisicao.id]))
+        contexto = render.call_args.args[2]
+        self.assertEqual(sum(len(itens) for itens in contexto["grouped"].values()), 4)
+        self.assertEqual((contexto["progresso"].validados, contexto["progresso"].pendentes), (0, 4))
+
+        self.client.post(reverse("lab:validar_resultados", args=[self.requisicao.id]))
+        self.assertFalse(self.requisicao.resultados.filter(validado=False).exists())
@@ -27,9 +27,17 @@ urlpatterns += [
     path("requisicao/<int:requisicao_id>/preencher-resultados/", views.preencher_resultados, name="preencher_resultados"),
     path("requisicao/<int:requisicao_id>/revisar-resultados/", views.revisar_resultados, name="revisar_resultados"),
     path("requisicao/<int:requisicao_id>/validar-resultados/", views.validar_resultados_view, name="validar_resultados"),
-    path("requisicao/<int:requisicao_id>/pdf/", views.RequisicaoPdf.as_view(), name="pdf_requisicao"),
-    # Resultados
-    path("resultados/<int:resultado_id>/pdf/", views.ResultadoPdf.as_view(), name="pdf_resultados"),
+    path("requisicao/<int:requisicao_id>/pdf/", views.pdf_requisicao, name="pdf_requisicao"),
+    # Resultados (da requisição; servidos em streaming da cache de PDFs)
+    path("resultados/<int:requisicao_id>/pdf/", views.pdf_resultados, name="pdf_resultados"),
+    # PDFs em segundo plano
+    path("requisicao/<int:requisicao_id>/pdf/<str:tipo>/trabalho/", views.pdf_trabalho_criar, name="pdf_trabalho_criar"),
+    path("pdf/trabalhos/<str:job_id>/", views.pdf_trabalho_estado, name="pdf_trabalho_estado"),
+    path("pdf/trabalhos/<str:job_id>/download/", views.pdf_trabalho_download, name="pdf_trabalho_download"),
+    path("pdf/lote/<str:tipo>/", views.pdf_lote_exportar, name="pdf_lote_exportar"),
+    path("pdf/metricas/", views.pdf_trabalhos_metricas, name="pdf_trabalhos_metricas"),
+    path("cache/estatisticas/", views.cache_estatisticas, name="cache_estatisticas"),
+    path("painel/trl/dados/", views.painel_trl_dados, name="painel_trl_dados"),
 ]
 
 from django.urls import path
@@ -0,0 +1,173 @@
+"""
+lab.utils.auditoria
+-------------------
+
+Escrita agrupada do histórico de operações (HistoricoOperacao).
+
+Os sinais registam eventos com `registar_evento()` em vez de criarem linhas
+uma a uma. Os eventos de uma transacção ficam em memória e são gravados com
+um único bulk_create em `transaction.on_commit`; se a transacção for
+revertida, são descartados.
+
+Os textos são guardados como modelos ("Campo '{campo}' criado para
+{paciente}.") e resolvidos no momento da gravação, com uma consulta por
+tipo de objecto para todo o lote, evitando aceder a requisicao.analista,
+requisicao.paciente ou exame_campo em cada evento.
+
+Com `AUDITORIA_EM_SEGUNDO_PLANO = True` nas settings, os lotes confirmados
+são entregues a uma thread que os grava fora do pedido HTTP.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+
+from lab.models import ExameCampo, HistoricoOperacao, RequisicaoAnalise
+from lab.utils import transacao
+
+logger = logging.getLogger(__name__)
+
+TAMANHO_LOTE = 500
+_fila: "queue.Queue[list]" = queue.Queue(maxsize=1000)
+_thread: Optional[threading.Thread] = None
+_thread_lock = threading.Lock()
+
+
+# ---------------------------------------------------------------------------
+# Registo de eventos
+# ---------------------------------------------------------------------------
+def registar_evento(requisicao_id: int, acao: str, detalhes: str = "", utilizador_id: Optional[int] = None,
+					exame_campo_id: Optional[int] = None, **params) -> None:
+	"""
+	Regista um evento de histórico para gravação no fim da transacção.
+
+	:param requisicao_id: id da RequisicaoAnalise
+	:param acao: texto curto da acção (ex.: "Validação de Resultado")
+	:param detalhes: modelo do texto; aceita {campo}, {paciente}, {validador} e chaves de `params`
+	:param utilizador_id: autor da operação; por omissão o analista da requisição
+	:param exame_campo_id: campo usado em {campo}
+	:param params: valores adicionais para o modelo de `detalhes`
+	"""
+	evento = {
+		"requisicao_id": requisicao_id,
+		"acao": acao,
+		"detalhes": detalhes,
+		"utilizador_id": utilizador_id,
+		"exame_campo_id": exame_campo_id,
+		"params": params,
+	}
+	transacao.acumular_no_commit("auditoria", evento, _entregar)
+
+
+def _entregar(eventos: list) -> None:
+	"""Grava o lote já confirmado, em linha ou através da thread de segundo plano."""
+	if not eventos:
+		return
+	if getattr(settings, "AUDITORIA_EM_SEGUNDO_PLANO", False):
+		_iniciar_thread()
+		try:
+			_fila.put_nowait(list(eventos))
+			return
+		except queue.Full:
+			logger.warning("Fila de auditoria cheia; a gravar %d eventos em linha.", len(eventos))
+	gravar_eventos(eventos)
+
+
+# ---------------------------------------------------------------------------
+# Gravação
+# ---------------------------------------------------------------------------
+def gravar_eventos(eventos: list) -> int:
+	"""
+	Resolve os textos e grava os eventos com um único bulk_create.
+
+	:returns: número de linhas de histórico criadas
+	"""
+	if not eventos:
+		return 0
+	User = get_user_model()
+
+	requisicoes = {
+		r["id"]: r for r in RequisicaoAnalise.objects.filter(
+			id__in={e["requisicao_id"] for e in eventos}
+		).values("id", "analista_id", "paciente__nome")
+	}
+	campos = dict(ExameCampo.objects.filter(
+		id__in={e["exame_campo_id"] for e in eventos if e["exame_campo_id"]}
+	).values_list("id", "nome_campo"))
+	validadores = {e["params"].get("validador_id") for e in eventos} - {None}
+	utilizadores = dict(User.objects.filter(id__in=validadores).values_list("id", User.USERNAME_FIELD)) if validadores else {}
+
+	linhas = []
+	for e in eventos:
+		req = requisicoes.get(e["requisicao_id"])
+		if req is None:
+			# requisição apagada antes da gravação
+			continue
+		params = dict(e["params"])
+		params.setdefault("validador", utilizadores.get(params.get("validador_id"), "—"))
+		detalhes = e["detalhes"].format(
+			campo=campos.get(e["exame_campo_id"], ""),
+			paciente=req["paciente__nome"],
+			**params,
+		)
+		linhas.append(HistoricoOperacao(
+			utilizador_id=e["utilizador_id"] or req["analista_id"],
+			requisicao_id=e["requisicao_id"],
+			acao=e["acao"],
+			detalhes=detalhes,
+		))
+	HistoricoOperacao.objects.bulk_create(linhas, batch_size=TAMANHO_LOTE)
+	return len(linhas)
+
+
+# ---------------------------------------------------------------------------
+# Modo em segundo plano
+# ---------------------------------------------------------------------------
+def _iniciar_thread() -> None:
+	global _thread
+	with _thread_lock:
+		if _thread is None or not _thread.is_alive():
+			_thread = threading.Thread(target=_drenar, name="lab-auditoria", daemon=True)
+			_thread.start()
+
+
+def _drenar() -> None:
+	"""Consome a fila, juntando lotes consecutivos até TAMANHO_LOTE eventos."""
+	while True:
+		eventos = _fila.get()
+		try:
+			while len(eventos) < TAMANHO_LOTE:
+				eventos.extend(_fila.get_nowait())
+		except queue.Empty:
+			pass
+		try:
+			close_old_connections()
+			gravar_eventos(eventos)
+		except Exception:
+			logger.exception("Erro ao gravar %d eventos de auditoria.", len(eventos))
+		finally:
+			close_old_connections()
+
+
+def drenar_pendentes() -> None:
+	"""Grava de imediato o que ainda estiver na fila (usado à saída do processo)."""
+	eventos = []
+	try:
+		while True:
+			eventos.extend(_fila.get_nowait())
+	except queue.Empty:
+		pass
+	if eventos:
+		try:
+			gravar_eventos(eventos)
+		except Exception:
+			logger.exception("Erro ao gravar %d eventos de auditoria à saída.", len(eventos))
+
+
+atexit.register(drenar_pendentes)
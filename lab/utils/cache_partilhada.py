@@ -0,0 +1,143 @@
+"""
+lab.utils.cache_partilhada
+--------------------------
+
+Espaços de nomes sobre a cache partilhada do Django (settings.CACHES), com
+validade por classe de dados e contagem de acertos/falhas.
+
+	contagens = EspacoCache("contagens")
+	total = contagens.get_or_set(chave, lambda: qs.count())
+
+Cada espaço prefixa as chaves com "lab:<nome>:" e usa por omissão a validade
+settings.CACHE_TTL[<classe>] (a classe é o nome do espaço, salvo indicação).
+
+Os acertos e falhas são somados em memória e enviados para a própria cache
+partilhada no máximo a cada INTERVALO_ENVIO segundos, para não acrescentar
+uma escrita a cada leitura; estatisticas() junta os valores de todos os
+processos. Com a cache em ficheiros o incremento não é atómico e, com vários
+processos, pode perder-se uma ou outra contagem; servem de indicação, não
+de contabilidade.
+"""
+
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Optional
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+TTL_PADRAO = {
+	"catalogo": 24 * 3600,
+	"contagens": 60,
+	"pdf": 7 * 24 * 3600,
+	"historico": 24 * 3600,
+}
+INTERVALO_ENVIO = 10
+
+_AUSENTE = object()
+_espacos = {}  # nome -> classe de validade, preenchido por EspacoCache()
+_pendentes = Counter()
+_lock = threading.Lock()
+_ultimo_envio = time.monotonic()
+
+
+def ttl(classe: str) -> Optional[int]:
+	"""Validade em segundos da classe de dados (None = sem expiração)."""
+	return {**TTL_PADRAO, **getattr(settings, "CACHE_TTL", {})}.get(classe, cache.default_timeout)
+
+
+class EspacoCache:
+	"""Vista da cache partilhada limitada às chaves "lab:<nome>:*"."""
+
+	def __init__(self, nome: str, classe: Optional[str] = None):
+		self.nome = nome
+		self.classe = classe or nome
+		_espacos[nome] = self.classe
+
+	def chave(self, chave) -> str:
+		return f"lab:{self.nome}:{chave}"
+
+	def _timeout(self, timeout):
+		return ttl(self.classe) if timeout is DEFAULT_TIMEOUT else timeout
+
+	def get(self, chave, default=None) -> Any:
+		valor = cache.get(self.chave(chave), _AUSENTE)
+		_registar(self.nome, valor is not _AUSENTE)
+		return default if valor is _AUSENTE else valor
+
+	def set(self, chave, valor, timeout=DEFAULT_TIMEOUT) -> None:
+		cache.set(self.chave(chave), valor, self._timeout(timeout))
+
+	def add(self, chave, valor, timeout=DEFAULT_TIMEOUT) -> bool:
+		return cache.add(self.chave(chave), valor, self._timeout(timeout))
+
+	def delete(self, chave) -> None:
+		cache.delete(self.chave(chave))
+
+	def get_or_set(self, chave, calcular: Callable[[], Any], timeout=DEFAULT_TIMEOUT) -> Any:
+		"""Devolve o valor em cache ou calcula-o, guarda-o e devolve-o."""
+		valor = self.get(chave, _AUSENTE)
+		if valor is _AUSENTE:
+			valor = calcular()
+			self.set(chave, valor, timeout)
+		return valor
+
+
+# ---------------------------------------------------------------------------
+# Estatísticas
+# ---------------------------------------------------------------------------
+def _chave_estatistica(espaco: str, tipo: str) -> str:
+	return f"lab:estatisticas:{espaco}:{tipo}"
+
+
+def _registar(espaco: str, acerto: bool) -> None:
+	with _lock:
+		_pendentes[(espaco, "acertos" if acerto else "falhas")] += 1
+		if time.monotonic() - _ultimo_envio < INTERVALO_ENVIO:
+			return
+	enviar_estatisticas()
+
+
+def enviar_estatisticas() -> None:
+	"""Soma na cache partilhada as contagens acumuladas neste processo."""
+	global _ultimo_envio
+	with _lock:
+		pendentes = dict(_pendentes)
+		_pendentes.clear()
+		_ultimo_envio = time.monotonic()
+	for (espaco, tipo), n in pendentes.items():
+		chave = _chave_estatistica(espaco, tipo)
+		if cache.add(chave, n, None):
+			continue
+		try:
+			cache.incr(chave, n)
+		except ValueError:  # expirou ou foi removida entre o add e o incr
+			cache.set(chave, n, None)
+
+
+def estatisticas() -> dict:
+	"""Acertos, falhas e taxa de acerto por espaço, somados em todos os processos."""
+	enviar_estatisticas()
+	espacos = sorted(_espacos)
+	chaves = [_chave_estatistica(e, t) for e in espacos for t in ("acertos", "falhas")]
+	valores = cache.get_many(chaves)
+	resultado = {}
+	for espaco in espacos:
+		acertos = valores.get(_chave_estatistica(espaco, "acertos"), 0)
+		falhas = valores.get(_chave_estatistica(espaco, "falhas"), 0)
+		total = acertos + falhas
+		resultado[espaco] = {
+			"acertos": acertos,
+			"falhas": falhas,
+			"taxa_acerto": round(acertos / total, 4) if total else None,
+			"ttl": ttl(_espacos[espaco]),
+		}
+	return {"backend": type(caches["default"]).__name__, "espacos": resultado}
+
+
+def limpar_estatisticas() -> None:
+	with _lock:
+		_pendentes.clear()
+	cache.delete_many([_chave_estatistica(e, t) for e in _espacos for t in ("acertos", "falhas")])
@@ -0,0 +1,163 @@
+"""
+lab.utils.catalogo
+------------------
+
+Cache do catálogo de exames: Exame e respectivos ExameCampo (ordenados, com
+unidade e valor de referência).
+
+O catálogo muda raramente mas é lido em cada requisição criada, formulário de
+resultados, PDF e listagem da API. É guardado em dois níveis:
+
+- na cache partilhada, no espaço "catalogo" de lab.utils.cache_partilhada
+  (validade CACHE_TTL["catalogo"]), sob uma chave que inclui a versão actual
+  do catálogo;
+- em memória no processo, revalidado contra a versão partilhada no máximo a
+  cada CATALOGO_CACHE["VERIFICAR_S"] segundos.
+
+Qualquer save/delete de Exame ou ExameCampo muda a versão no commit da
+transacção (sinais em lab.signals), pelo que as entradas antigas deixam de
+ser lidas em todos os processos. Dentro de uma transacção que alterou o
+catálogo usa-se uma cópia lida da base de dados e própria dessa transacção,
+nunca gravada na cache partilhada (o commit pode não chegar a acontecer).
+
+Os ExameCampo devolvidos trazem o `exame` já ligado e são partilhados entre
+pedidos: tratar como só de leitura.
+"""
+
+import threading
+import time
+import uuid
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.db.models import QuerySet
+
+from lab.models import Exame, ExameCampo
+from lab.utils import transacao
+from lab.utils.cache_partilhada import EspacoCache
+
+espaco = EspacoCache("catalogo")
+
+
+def _configuracao() -> dict:
+	return {"VERIFICAR_S": 2, **getattr(settings, "CATALOGO_CACHE", {})}
+
+
+class Catalogo:
+	"""Exames e campos indexados por id; campos de cada exame pela ordem de apresentação."""
+
+	def __init__(self, exames: Iterable[Exame], campos: Iterable[ExameCampo]):
+		self.exames = {e.pk: e for e in exames}
+		self.campos = {}
+		self.campos_por_exame = {pk: [] for pk in self.exames}
+		for c in sorted(campos, key=lambda c: (c.exame_id, c.ordem, c.pk)):
+			c.exame = self.exames[c.exame_id]
+			self.campos[c.pk] = c
+			self.campos_por_exame[c.exame_id].append(c)
+
+	def exame(self, pk) -> Optional[Exame]:
+		return self.exames.get(pk)
+
+	def campo(self, pk) -> Optional[ExameCampo]:
+		return self.campos.get(pk)
+
+	def campos_do_exame(self, exame_id) -> List[ExameCampo]:
+		return self.campos_por_exame.get(exame_id, [])
+
+	def activos(self) -> List[Exame]:
+		return sorted((e for e in self.exames.values() if e.activo), key=lambda e: e.nome)
+
+
+def _construir() -> Catalogo:
+	return Catalogo(Exame.objects.all(), ExameCampo.objects.all())
+
+
+# ---------------------------------------------------------------------------
+# Versão e leitura
+# ---------------------------------------------------------------------------
+_local = {"versao": None, "verificado": 0.0, "catalogo": None}
+_lock = threading.Lock()
+
+
+def versao() -> str:
+	"""Versão actual do catálogo na cache partilhada (criada se não existir)."""
+	atual = espaco.get("versao")
+	if atual is None:
+		espaco.add("versao", uuid.uuid4().hex, None)
+		atual = espaco.get("versao")
+	return atual
+
+
+def obter() -> Catalogo:
+	"""Catálogo actual; em regime estável não faz consultas à base de dados."""
+	estado = transacao.pendente("catalogo")
+	if estado is not None:
+		if estado.get("catalogo") is None:
+			estado["catalogo"] = _construir()
+		return estado["catalogo"]
+
+	config = _configuracao()
+	agora = time.monotonic()
+	with _lock:
+		if _local["catalogo"] is not None and agora - _local["verificado"] < config["VERIFICAR_S"]:
+			return _local["catalogo"]
+
+	atual = versao()
+	with _lock:
+		if _local["catalogo"] is not None and _local["versao"] == atual:
+			_local["verificado"] = agora
+			return _local["catalogo"]
+
+	catalogo = espaco.get_or_set(atual, _construir)
+	with _lock:
+		_local.update(versao=atual, verificado=agora, catalogo=catalogo)
+	return catalogo
+
+
+# ---------------------------------------------------------------------------
+# Invalidação
+# ---------------------------------------------------------------------------
+def invalidar() -> None:
+	"""Muda a versão partilhada e descarta a cópia deste processo."""
+	espaco.set("versao", uuid.uuid4().hex, None)
+	with _lock:
+		_local.update(versao=None, verificado=0.0, catalogo=None)
+
+
+def invalidar_no_commit() -> None:
+	"""
+	Agenda invalidar() para o commit da transacção actual (uma vez por
+	transacção) e, até lá, faz obter() ler o catálogo desta transacção.
+	"""
+	estado = transacao.acumular_no_commit("catalogo", None, lambda _: invalidar(), criar=dict)
+	estado["catalogo"] = None
+
+
+# ---------------------------------------------------------------------------
+# Atalhos
+# ---------------------------------------------------------------------------
+def ligar_campos(resultados: Iterable) -> list:
+	"""
+	Liga a cada ResultadoItem o seu ExameCampo (e Exame) do catálogo, em vez
+	de um select_related("exame_campo__exame"), e devolve-os numa lista pela
+	ordem de ResultadoItem.Meta.ordering (requisição, exame, ordem do campo).
+	Um queryset é lido sem ORDER BY, para não juntar as tabelas do catálogo.
+	"""
+	if isinstance(resultados, QuerySet):
+		resultados = resultados.order_by()
+	catalogo = obter()
+	resultados = list(resultados)
+	for ri in resultados:
+		campo = catalogo.campo(ri.exame_campo_id)
+		if campo is not None:
+			ri.exame_campo = campo
+	resultados.sort(key=lambda ri: (
+		ri.requisicao_id, ri.exame_campo.exame.nome, ri.exame_campo.ordem, ri.exame_campo_id
+	))
+	return resultados
+
+
+def campos_dos_exames(exame_ids: Iterable) -> List[ExameCampo]:
+	"""Campos dos exames indicados, agrupados por exame e ordenados."""
+	catalogo = obter()
+	return [c for pk in exame_ids for c in catalogo.campos_do_exame(pk)]
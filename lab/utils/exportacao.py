@@ -0,0 +1,250 @@
+"""
+lab.utils.exportacao
+--------------------
+
+Exportação colunar dos resultados para análise (Parquet / Arrow).
+
+Cada linha é um ResultadoItem com o campo, o exame, a requisição e o
+paciente. Do paciente só se exportam o id, o género, a idade à data da
+requisição e a proveniência, não o nome nem os contactos. As linhas são
+lidas em blocos com .iterator(chunk_size=...), que no PostgreSQL usa um
+cursor do lado do servidor, e cada bloco passa por um DataFrame pandas
+antes de ser escrito. A memória usada depende do bloco, não do total.
+
+exportar_parquet() escreve um conjunto particionado ao estilo Hive:
+
+	<destino>/mes=2026-10/setor=Bioqu%C3%ADmica/parte-20261017T101500.parquet
+
+Estes directórios são lidos por pandas.read_parquet(destino) ou por
+pyarrow.dataset. As exportações são incrementais: o ficheiro
+<destino>/_estado.json guarda o maior `atualizado_em` exportado. A execução
+seguinte só lê as linhas alteradas depois disso (menos MARGEM, para não
+perder transacções que confirmaram tarde) e acrescenta novos ficheiros
+"parte-*". Uma linha alterada aparece assim em mais do que um ficheiro;
+quem lê fica com a de maior `atualizado_em` para cada `id`.
+
+pyarrow é opcional: sem ele, estas funções levantam ImportError.
+"""
+
+import io
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+from urllib.parse import quote
+
+import pandas as pd
+from django.utils import timezone
+
+from lab.models import ResultadoItem
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:  # dependência opcional (requirements.txt)
+	pa = pq = None
+
+CHUNK_SIZE = 5000
+MARGEM = timedelta(minutes=5)
+FICHEIRO_ESTADO = "_estado.json"
+PARTICOES = ("mes", "setor")
+
+# nome da coluna -> caminho no ORM, pela ordem de saída
+COLUNAS = {
+	"id": "id",
+	"id_custom": "id_custom",
+	"requisicao_id": "requisicao_id",
+	"requisicao": "requisicao__id_custom",
+	"requisicao_criada_em": "requisicao__created_at",
+	"requisicao_estado": "requisicao__status",
+	"paciente_id": "requisicao__paciente_id",
+	"paciente_genero": "requisicao__paciente__genero",
+	"paciente_nascimento": "requisicao__paciente__data_nascimento",
+	"proveniencia": "requisicao__paciente__proveniencia",
+	"exame_id": "exame_campo__exame_id",
+	"exame": "exame_campo__exame__nome",
+	"exame_codigo": "exame_campo__exame__codigo",
+	"setor": "exame_campo__exame__setor",
+	"campo_id": "exame_campo_id",
+	"campo": "exame_campo__nome_campo",
+	"unidade": "exame_campo__unidade",
+	"valor_referencia": "exame_campo__valor_referencia",
+	"resultado": "resultado",
+	"valor_numerico": "valor_numerico",
+	"validado": "validado",
+	"data_validacao": "data_validacao",
+	"atualizado_em": "atualizado_em",
+}
+
+
+def exigir_pyarrow() -> None:
+	if pa is None:
+		raise ImportError("A exportação em Parquet/Arrow requer o pacote pyarrow (pip install pyarrow).")
+
+
+def esquema(com_particoes: bool = True) -> "pa.Schema":
+	"""Esquema Arrow das linhas exportadas (fixo, para todos os blocos coincidirem)."""
+	exigir_pyarrow()
+	momento = pa.timestamp("us", tz="UTC")
+	campos = [
+		("id", pa.int64()), ("id_custom", pa.string()),
+		("requisicao_id", pa.int64()), ("requisicao", pa.string()),
+		("requisicao_criada_em", momento), ("requisicao_estado", pa.string()),
+		("paciente_id", pa.int64()), ("paciente_genero", pa.string()),
+		("paciente_idade", pa.float64()), ("proveniencia", pa.string()),
+		("exame_id", pa.int64()), ("exame", pa.string()), ("exame_codigo", pa.string()),
+		("setor", pa.string()),
+		("campo_id", pa.int64()), ("campo", pa.string()), ("unidade", pa.string()),
+		("valor_referencia", pa.string()),
+		("resultado", pa.string()), ("valor_numerico", pa.float64()),
+		("validado", pa.bool_()), ("data_validacao", momento), ("atualizado_em", momento),
+		("mes", pa.string()),
+	]
+	return pa.schema([c for c in campos if com_particoes or c[0] not in PARTICOES])
+
+
+def consulta(desde: Optional[datetime] = None):
+	"""Linhas a exportar (alteradas depois de `desde`, se indicado), como tuplos pela ordem de COLUNAS."""
+	qs = ResultadoItem.objects.order_by()
+	if desde is not None:
+		qs = qs.filter(atualizado_em__gt=desde)
+	return qs.values_list(*COLUNAS.values())
+
+
+def lotes(qs, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+	"""DataFrames de até `chunk_size` linhas, lidas com .iterator(chunk_size=...)."""
+	bloco = []
+	for linha in qs.iterator(chunk_size=chunk_size):
+		bloco.append(linha)
+		if len(bloco) == chunk_size:
+			yield _dataframe(bloco)
+			bloco = []
+	if bloco:
+		yield _dataframe(bloco)
+
+
+def _dataframe(linhas) -> pd.DataFrame:
+	df = pd.DataFrame.from_records(linhas, columns=list(COLUNAS))
+	for coluna in ("requisicao_criada_em", "data_validacao", "atualizado_em"):
+		df[coluna] = pd.to_datetime(df[coluna], utc=True)
+	local = df["requisicao_criada_em"].dt.tz_convert(timezone.get_current_timezone_name())
+	df["mes"] = local.dt.strftime("%Y-%m")
+	# idade em anos à data da requisição; o nascimento não sai do sistema
+	nascimento = pd.to_datetime(df.pop("paciente_nascimento"))
+	df["paciente_idade"] = ((local.dt.tz_localize(None).dt.normalize() - nascimento).dt.days / 365.25).round(1)
+	df["setor"] = df["setor"].fillna("")
+	return df
+
+
+def tabela(df: pd.DataFrame, com_particoes: bool = True) -> "pa.Table":
+	esq = esquema(com_particoes)
+	return pa.Table.from_pandas(df[esq.names], schema=esq, preserve_index=False)
+
+
+# ---------------------------------------------------------------------------
+# Parquet particionado (comando export_results)
+# ---------------------------------------------------------------------------
+def ler_estado(destino: str) -> dict:
+	try:
+		with open(os.path.join(destino, FICHEIRO_ESTADO), encoding="utf-8") as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {}
+
+
+def _gravar_estado(destino: str, estado: dict) -> None:
+	caminho = os.path.join(destino, FICHEIRO_ESTADO)
+	with open(caminho + ".tmp", "w", encoding="utf-8") as f:
+		json.dump(estado, f, indent=2)
+	os.replace(caminho + ".tmp", caminho)
+
+
+def exportar_parquet(destino: str, incremental: bool = True, chunk_size: int = CHUNK_SIZE) -> dict:
+	"""
+	Escreve em `destino` as linhas alteradas desde a última exportação (ou
+	todas, com incremental=False), um ficheiro por partição mes/setor.
+
+	:returns: {"linhas", "ficheiros", "desde", "ate"}
+	"""
+	exigir_pyarrow()
+	os.makedirs(destino, exist_ok=True)
+	estado = ler_estado(destino) if incremental else {}
+	desde = datetime.fromisoformat(estado["ate"]) - MARGEM if estado.get("ate") else None
+
+	marca = timezone.now().strftime("%Y%m%dT%H%M%S%f")
+	esq = esquema(com_particoes=False)
+	escritores = {}  # (mes, setor) -> (caminho final, ParquetWriter sobre "<caminho>.tmp")
+	linhas, ate = 0, None
+	try:
+		for df in lotes(consulta(desde), chunk_size):
+			linhas += len(df)
+			maximo = df["atualizado_em"].max().to_pydatetime()
+			ate = maximo if ate is None else max(ate, maximo)
+			for (mes, setor), parte in df.groupby(list(PARTICOES), sort=False):
+				if (mes, setor) not in escritores:
+					pasta = os.path.join(destino, f"mes={mes}", f"setor={quote(setor or 'Sem setor', safe='')}")
+					os.makedirs(pasta, exist_ok=True)
+					caminho = os.path.join(pasta, f"parte-{marca}.parquet")
+					escritores[(mes, setor)] = (caminho, pq.ParquetWriter(caminho + ".tmp", esq))
+				escritores[(mes, setor)][1].write_table(tabela(parte, com_particoes=False))
+	except BaseException:
+		for caminho, escritor in escritores.values():
+			escritor.close()
+			os.remove(caminho + ".tmp")
+		raise
+	for _, escritor in escritores.values():
+		escritor.close()
+
+	# só com tudo escrito os ficheiros passam a visíveis e o estado avança
+	for caminho, _ in escritores.values():
+		os.replace(caminho + ".tmp", caminho)
+	if ate is not None or not estado:
+		_gravar_estado(destino, {
+			"ate": (ate or timezone.now()).isoformat(),
+			"linhas": linhas,
+			"executado_em": timezone.now().isoformat(),
+		})
+	return {
+		"linhas": linhas,
+		"ficheiros": sorted(c for c, _ in escritores.values()),
+		"desde": desde,
+		"ate": ate,
+	}
+
+
+# ---------------------------------------------------------------------------
+# Fluxos para a API
+# ---------------------------------------------------------------------------
+def fluxo_arrow(qs, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+	"""Formato de fluxo Arrow IPC, um record batch por bloco, emitido à medida que é lido."""
+	exigir_pyarrow()
+	saida = io.BytesIO()
+
+	def despejar() -> bytes:
+		dados = saida.getvalue()
+		saida.seek(0)
+		saida.truncate()
+		return dados
+
+	with pa.ipc.new_stream(saida, esquema()) as escritor:
+		yield despejar()
+		for df in lotes(qs, chunk_size):
+			escritor.write_table(tabela(df))
+			yield despejar()
+	yield despejar()
+
+
+def ficheiro_parquet(qs, chunk_size: int = CHUNK_SIZE):
+	"""
+	Um único ficheiro Parquet (não particionado) num ficheiro temporário,
+	posicionado no início. O Parquet só fica válido com o rodapé escrito no
+	fim, por isso não pode ser enviado à medida que é lido.
+	"""
+	exigir_pyarrow()
+	destino = tempfile.TemporaryFile()
+	with pq.ParquetWriter(destino, esquema()) as escritor:
+		for df in lotes(qs, chunk_size):
+			escritor.write_table(tabela(df))
+	destino.seek(0)
+	return destino
@@ -0,0 +1,105 @@
+"""
+lab.utils.folha_trabalho
+------------------------
+
+Folha de trabalho de uma requisição: a requisição com o paciente, os exames
+pedidos, os campos desses exames e os respectivos ResultadoItem. É a base das
+views de preenchimento, revisão e validação de resultados.
+
+São três consultas, seja qual for o número de exames e campos:
+
+1. a requisição com select_related("paciente");
+2. os ids dos exames pedidos;
+3. todos os ResultadoItem da requisição.
+
+Exames e campos vêm do catálogo em cache e ficam ligados aos resultados
+(catalogo.ligar_campos), pelo que percorrer ri.exame_campo.exame não faz
+consultas. O progresso (folha.progresso: total / validados / pendentes) é
+contado sobre os resultados lidos e passado às templates, em vez das
+propriedades da requisição, que fariam três COUNT.
+
+obter() guarda a folha no próprio pedido HTTP: chamadas repetidas no mesmo
+pedido não voltam à base de dados. A folha não acompanha o que o pedido
+gravar depois de a ler.
+"""
+
+from typing import Dict, List, NamedTuple, Tuple
+
+from django.shortcuts import get_object_or_404
+
+from lab.models import RequisicaoAnalise, ResultadoItem
+from lab.utils import catalogo
+from lab.utils.resultados import materializar_resultados
+
+
+class Progresso(NamedTuple):
+	"""Contagem sobre todos os resultados da requisição (como with_progress())."""
+	total: int
+	validados: int
+
+	@property
+	def pendentes(self) -> int:
+		return self.total - self.validados
+
+
+class FolhaTrabalho:
+	"""Requisição, paciente, exames (por nome), campos e resultados dos campos desses exames."""
+
+	def __init__(self, requisicao, exames, campos, resultados, progresso: Progresso):
+		self.requisicao = requisicao
+		self.exames = exames
+		self.campos = campos
+		self.resultados = resultados
+		self.progresso = progresso
+		existentes = {ri.exame_campo_id for ri in resultados}
+		self.em_falta = [c.pk for c in campos if c.pk not in existentes]
+
+	@property
+	def paciente(self):
+		return self.requisicao.paciente
+
+	def agrupados(self) -> Dict[str, List[ResultadoItem]]:
+		"""Resultados agrupados pelo nome do exame, pela ordem de apresentação."""
+		grupos = {}
+		for ri in self.resultados:
+			grupos.setdefault(ri.exame_campo.exame.nome, []).append(ri)
+		return grupos
+
+
+def _ler_resultados(requisicao, campos) -> Tuple[List[ResultadoItem], Progresso]:
+	todos = catalogo.ligar_campos(ResultadoItem.objects.filter(requisicao=requisicao))
+	progresso = Progresso(total=len(todos), validados=sum(ri.validado for ri in todos))
+	ids_campos = {c.pk for c in campos}
+	resultados = [ri for ri in todos if ri.exame_campo_id in ids_campos]
+	for ri in resultados:
+		ri.requisicao = requisicao
+	return resultados, progresso
+
+
+def carregar(requisicao_id, materializar: bool = False) -> FolhaTrabalho:
+	"""
+	Lê a folha de trabalho da requisição (Http404 se não existir).
+
+	:param materializar: cria antes os ResultadoItem em falta (mais uma
+		inserção e uma releitura dos resultados, só quando faltam)
+	"""
+	requisicao = get_object_or_404(RequisicaoAnalise.objects.select_related("paciente"), id=requisicao_id)
+	ids_exames = requisicao.exames.order_by().values_list("id", flat=True)
+	cat = catalogo.obter()
+	exames = sorted((e for e in map(cat.exame, ids_exames) if e is not None), key=lambda e: (e.nome, e.pk))
+	campos = catalogo.campos_dos_exames(e.pk for e in exames)
+
+	folha = FolhaTrabalho(requisicao, exames, campos, *_ler_resultados(requisicao, campos))
+	if materializar and folha.em_falta:
+		materializar_resultados(requisicao, em_falta=folha.em_falta)
+		folha = FolhaTrabalho(requisicao, exames, campos, *_ler_resultados(requisicao, campos))
+	return folha
+
+
+def obter(request, requisicao_id, materializar: bool = False) -> FolhaTrabalho:
+	"""Folha de trabalho da requisição, lida uma vez por pedido HTTP."""
+	folhas = request.__dict__.setdefault("_folhas_trabalho", {})
+	folha = folhas.get(int(requisicao_id))
+	if folha is None or (materializar and folha.em_falta):
+		folha = folhas[int(requisicao_id)] = carregar(requisicao_id, materializar)
+	return folha
@@ -0,0 +1,185 @@
+"""
+lab.utils.historico_paciente
+----------------------------
+
+Histórico de resultados do paciente: valores anteriores do mesmo
+ExameCampo, para comparar com o valor actual (controlo delta) na revisão,
+na validação e no PDF.
+
+anteriores() devolve os últimos K valores de cada campo de uma requisição,
+em requisições anteriores do mesmo paciente, com uma única consulta:
+
+	ROW_NUMBER() OVER (PARTITION BY exame_campo ORDER BY created_at DESC) <= K
+
+A consulta usa o índice (paciente, -created_at) de RequisicaoAnalise e o
+índice único (requisicao, exame_campo) de ResultadoItem, em vez de uma
+consulta por campo e por requisição anterior.
+
+resumo() agrega o histórico completo do paciente por campo (n, primeiro e
+último, mínimo, máximo e média). Fica na cache partilhada sob uma versão
+por paciente, que muda no fim das transacções que alteram resultados do
+paciente. Os PDFs não usam esta versão: a impressão digital inclui os
+próprios valores anteriores que mostram (ver pdf_cache.impressao_digital).
+"""
+
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from django.db.models import Avg, Count, F, Max, Min, Window
+from django.db.models.functions import RowNumber
+
+from lab.models import RequisicaoAnalise, ResultadoItem
+from lab.utils import catalogo, transacao
+from lab.utils.cache_partilhada import EspacoCache
+
+K_PADRAO = 3
+
+espaco = EspacoCache("historico")
+
+
+class ValorAnterior(NamedTuple):
+	data: datetime               # criação da requisição anterior
+	resultado: str
+	valor_numerico: Optional[float]
+	requisicao_id: int
+
+
+def _resultados(paciente_id, apenas_validados: bool):
+	qs = ResultadoItem.objects.order_by().filter(requisicao__paciente_id=paciente_id).exclude(resultado="")
+	if apenas_validados:
+		qs = qs.filter(validado=True)
+	return qs
+
+
+# ---------------------------------------------------------------------------
+# Últimos K valores
+# ---------------------------------------------------------------------------
+def anteriores(requisicao, campos: Iterable[int], k: int = K_PADRAO, apenas_validados: bool = True) -> Dict[int, List[ValorAnterior]]:
+	"""
+	{exame_campo_id: [ValorAnterior, ...]} com até `k` valores por campo, do
+	mais recente para o mais antigo, das requisições do mesmo paciente
+	criadas antes de `requisicao`.
+	"""
+	campos = set(campos)
+	if not campos or k < 1:
+		return {}
+	linhas = (
+		_resultados(requisicao.paciente_id, apenas_validados)
+		.filter(requisicao__created_at__lt=requisicao.created_at, exame_campo_id__in=campos)
+		.annotate(posicao=Window(
+			RowNumber(),
+			partition_by=[F("exame_campo_id")],
+			order_by=[F("requisicao__created_at").desc(), F("requisicao_id").desc()],
+		))
+		.filter(posicao__lte=k)
+		.values_list("exame_campo_id", "posicao", "requisicao__created_at", "resultado", "valor_numerico", "requisicao_id")
+	)
+	por_campo = {}
+	for campo_id, posicao, *valor in sorted(linhas, key=lambda l: (l[0], l[1])):
+		por_campo.setdefault(campo_id, []).append(ValorAnterior(*valor))
+	return por_campo
+
+
+def ligar_anteriores(resultados: Iterable, requisicao, k: int = K_PADRAO) -> list:
+	"""
+	Define em cada ResultadoItem da requisição `ri.anteriores` (lista de
+	ValorAnterior) e `ri.delta` (valor actual menos o anterior, ou None se
+	algum não for numérico). Devolve os resultados numa lista.
+	"""
+	resultados = list(resultados)
+	por_campo = anteriores(requisicao, {ri.exame_campo_id for ri in resultados}, k) if resultados else {}
+	for ri in resultados:
+		ri.anteriores = por_campo.get(ri.exame_campo_id, [])
+		ultimo = ri.anteriores[0].valor_numerico if ri.anteriores else None
+		ri.delta = None if ultimo is None or ri.valor_numerico is None else round(ri.valor_numerico - ultimo, 4)
+	return resultados
+
+
+# ---------------------------------------------------------------------------
+# Resumo por paciente (em cache)
+# ---------------------------------------------------------------------------
+def versao(paciente_id) -> str:
+	"""Versão do histórico do paciente na cache partilhada (criada se não existir)."""
+	atual = espaco.get(f"versao:{paciente_id}")
+	if atual is None:
+		espaco.add(f"versao:{paciente_id}", uuid.uuid4().hex)
+		atual = espaco.get(f"versao:{paciente_id}")
+	return atual
+
+
+def _calcular_resumo(paciente_id) -> list:
+	qs = _resultados(paciente_id, apenas_validados=True)
+	ultimos = dict(
+		(campo_id, (resultado, data))
+		for campo_id, resultado, data in qs.annotate(posicao=Window(
+			RowNumber(),
+			partition_by=[F("exame_campo_id")],
+			order_by=[F("requisicao__created_at").desc(), F("requisicao_id").desc()],
+		)).filter(posicao=1).values_list("exame_campo_id", "resultado", "requisicao__created_at")
+	)
+	cat = catalogo.obter()
+	linhas = []
+	for v in qs.values("exame_campo_id").annotate(
+		n=Count("id"),
+		primeiro=Min("requisicao__created_at"),
+		minimo=Min("valor_numerico"),
+		maximo=Max("valor_numerico"),
+		media=Avg("valor_numerico"),
+	):
+		campo = cat.campo(v["exame_campo_id"])
+		exame = cat.exame(campo.exame_id) if campo else None
+		ultimo, data = ultimos.get(v["exame_campo_id"], ("", None))
+		linhas.append({
+			"exame_campo": v["exame_campo_id"],
+			"exame": exame.nome if exame else None,
+			"campo": campo.nome_campo if campo else None,
+			"unidade": campo.unidade if campo else None,
+			"n": v["n"],
+			"primeiro": v["primeiro"].isoformat(),
+			"ultimo": data.isoformat() if data else None,
+			"ultimo_resultado": ultimo,
+			"minimo": v["minimo"],
+			"maximo": v["maximo"],
+			"media": None if v["media"] is None else round(v["media"], 4),
+		})
+	linhas.sort(key=lambda l: (l["exame"] or "", l["campo"] or ""))
+	return linhas
+
+
+def resumo(paciente_id) -> list:
+	"""Resumo do histórico validado do paciente por campo (lista de dicionários, do catálogo por exame e campo)."""
+	return espaco.get_or_set(f"resumo:{paciente_id}:{versao(paciente_id)}", lambda: _calcular_resumo(paciente_id))
+
+
+# ---------------------------------------------------------------------------
+# Invalidação
+# ---------------------------------------------------------------------------
+def invalidar(paciente_ids: Iterable[int]) -> None:
+	"""Muda a versão do histórico dos pacientes (o resumo antigo deixa de ser lido e expira)."""
+	for pk in set(paciente_ids):
+		espaco.delete(f"versao:{pk}")
+
+
+def invalidar_no_commit(requisicao_id: Optional[int] = None, paciente_id: Optional[int] = None) -> None:
+	"""
+	Agenda a invalidação do histórico do paciente da requisição (ou do
+	paciente indicado) para o fim da transacção actual. Tudo o que a
+	transacção altera é junto num único callback
+	(transacao.acumular_no_commit), que resolve os pacientes das
+	requisições com uma consulta.
+	"""
+	if requisicao_id is not None:
+		transacao.acumular_no_commit("historico", ("requisicao", requisicao_id), _executar, criar=set)
+	if paciente_id is not None:
+		transacao.acumular_no_commit("historico", ("paciente", paciente_id), _executar, criar=set)
+
+
+def _executar(pendentes: set) -> None:
+	requisicoes = {pk for tipo, pk in pendentes if tipo == "requisicao"}
+	pacientes = {pk for tipo, pk in pendentes if tipo == "paciente"}
+	if requisicoes:
+		pacientes = pacientes | set(
+			RequisicaoAnalise.objects.order_by().filter(id__in=requisicoes).values_list("paciente_id", flat=True)
+		)
+	invalidar(pacientes)
@@ -0,0 +1,223 @@
+"""
+lab.utils.pdf_cache
+-------------------
+
+Cache persistente dos PDFs gerados (requisição e resultados).
+
+Cada PDF é guardado num storage do Django (por omissão MEDIA_ROOT/pdf_cache,
+ou o alias "pdf_cache" de settings.STORAGES) com a chave:
+
+	<requisicao.pk>/<tipo>-<impressão digital>.pdf
+
+A impressão digital resume tudo o que aparece no documento: updated_at da
+requisição, dados do paciente, analista, exames, versão do catálogo, (id, resultado, validado,
+data_validacao) de cada resultado e, no PDF de resultados, o valor anterior
+de cada campo mostrado na coluna "Anterior". Qualquer alteração gera uma chave nova,
+pelo que uma entrada antiga nunca é servida; os sinais apagam as entradas
+obsoletas da requisição; os ficheiros não usados há mais de CACHE_TTL["pdf"]
+segundos e, acima de PDF_CACHE["MAX_BYTES"], os menos usados recentemente
+são removidos (LRU pela data de modificação, actualizada a cada acerto).
+
+abrir_pdf_requisicao / abrir_pdf_resultados devolvem um ficheiro aberto em
+vez de bytes, para as views o entregarem com FileResponse: numa falha o PDF
+é gerado para um ficheiro temporário e copiado para o storage aos blocos.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from datetime import timedelta
+from typing import BinaryIO, Callable, Tuple
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, InvalidStorageError, storages
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from lab.utils import cache_partilhada, catalogo, historico_paciente, transacao
+from lab.utils.pdf_generator import escrever_pdf_requisicao, escrever_pdf_resultados, nome_ficheiro_pdf
+
+logger = logging.getLogger(__name__)
+
+
+def _configuracao() -> dict:
+	return getattr(settings, "PDF_CACHE", {})
+
+
+def _criar_storage():
+	try:
+		return storages["pdf_cache"]
+	except InvalidStorageError:
+		return FileSystemStorage(location=os.path.join(settings.MEDIA_ROOT, "pdf_cache"))
+
+
+storage = SimpleLazyObject(_criar_storage)
+
+
+# ---------------------------------------------------------------------------
+# Impressão digital do conteúdo
+# ---------------------------------------------------------------------------
+def impressao_digital(requisicao, apenas_validados: bool = False, com_anteriores: bool = False) -> str:
+	"""
+	Calcula a impressão digital do conteúdo do PDF (duas consultas leves; três com com_anteriores).
+
+	:param requisicao: instância de RequisicaoAnalise (idealmente com select_related("paciente"))
+	:param apenas_validados: se True considera apenas resultados validados
+	:param com_anteriores: inclui os valores da coluna "Anterior" (mais uma consulta)
+	"""
+	paciente = requisicao.paciente
+	partes = [
+		requisicao.updated_at.isoformat() if requisicao.updated_at else "",
+		paciente.nome, paciente.numero_id or "", paciente.genero or "",
+		str(paciente.data_nascimento or ""), paciente.proveniencia or "",
+		str(requisicao.analista_id or ""),
+		",".join(str(pk) for pk in requisicao.exames.order_by("pk").values_list("pk", flat=True)),
+		# nomes, unidades e valores de referência vêm do catálogo
+		catalogo.versao(),
+	]
+	resultados = requisicao.resultados.order_by("pk")
+	if apenas_validados:
+		resultados = resultados.filter(validado=True)
+	campos = set()
+	for pk, campo_id, valor, validado, data in resultados.values_list(
+		"pk", "exame_campo_id", "resultado", "validado", "data_validacao"
+	):
+		campos.add(campo_id)
+		partes.append(f"{pk}:{valor}:{int(validado)}:{data.isoformat() if data else ''}")
+	if com_anteriores:
+		# coluna "Anterior": os mesmos valores que o PDF mostra (historico_paciente.ligar_anteriores, k=1)
+		for campo_id, valores in sorted(historico_paciente.anteriores(requisicao, campos, k=1).items()):
+			anterior = valores[0]
+			partes.append(f"a{campo_id}:{anterior.requisicao_id}:{anterior.resultado}:{anterior.data.isoformat()}")
+	return hashlib.sha1("|".join(partes).encode("utf-8")).hexdigest()[:20]
+
+
+# ---------------------------------------------------------------------------
+# Leitura / escrita
+# ---------------------------------------------------------------------------
+def _abrir(requisicao, tipo: str, escrever: Callable[[BinaryIO], None], apenas_validados: bool,
+		   com_anteriores: bool = False) -> BinaryIO:
+	"""Devolve o PDF em cache (ou acabado de gerar) como ficheiro aberto e posicionado no início."""
+	chave = f"{requisicao.pk}/{tipo}-{impressao_digital(requisicao, apenas_validados, com_anteriores)}.pdf"
+	try:
+		if storage.exists(chave):
+			ficheiro = storage.open(chave, "rb")
+			_tocar(chave)
+			return ficheiro
+	except OSError as e:
+		logger.warning("Falha ao ler %s da cache de PDFs: %s", chave, e)
+
+	temporario = tempfile.TemporaryFile()
+	try:
+		escrever(temporario)
+	except Exception:
+		temporario.close()
+		raise
+	temporario.seek(0)
+	try:
+		invalidar(requisicao.pk, tipo)
+		storage.save(chave, File(temporario))
+		aplicar_limite()
+	except OSError as e:
+		logger.warning("Falha ao gravar %s na cache de PDFs: %s", chave, e)
+	temporario.seek(0)
+	return temporario
+
+
+def abrir_pdf_requisicao(requisicao) -> Tuple[BinaryIO, str]:
+	"""Versão com cache de escrever_pdf_requisicao; devolve (ficheiro, filename)."""
+	ficheiro = _abrir(requisicao, "Requisicao", lambda destino: escrever_pdf_requisicao(requisicao, destino), False)
+	return ficheiro, nome_ficheiro_pdf(requisicao, "Requisicao")
+
+
+def abrir_pdf_resultados(requisicao, apenas_validados: bool = False) -> Tuple[BinaryIO, str]:
+	"""Versão com cache de escrever_pdf_resultados; devolve (ficheiro, filename)."""
+	tipo = "Resultados" if apenas_validados else "ResultadosTodos"
+	escrever = lambda destino: escrever_pdf_resultados(requisicao, destino, apenas_validados=apenas_validados)
+	ficheiro = _abrir(requisicao, tipo, escrever, apenas_validados, com_anteriores=True)
+	return ficheiro, nome_ficheiro_pdf(requisicao, "Resultados")
+
+
+def pdf_requisicao(requisicao) -> Tuple[bytes, str]:
+	"""Como abrir_pdf_requisicao, mas devolve (pdf_bytes, filename)."""
+	ficheiro, filename = abrir_pdf_requisicao(requisicao)
+	with ficheiro:
+		return ficheiro.read(), filename
+
+
+def pdf_resultados(requisicao, apenas_validados: bool = False) -> Tuple[bytes, str]:
+	"""Como abrir_pdf_resultados, mas devolve (pdf_bytes, filename)."""
+	ficheiro, filename = abrir_pdf_resultados(requisicao, apenas_validados=apenas_validados)
+	with ficheiro:
+		return ficheiro.read(), filename
+
+
+def _tocar(chave: str) -> None:
+	"""Marca a entrada como usada recentemente (só em storages locais)."""
+	try:
+		os.utime(storage.path(chave))
+	except (NotImplementedError, OSError):
+		pass
+
+
+# ---------------------------------------------------------------------------
+# Invalidação e despejo
+# ---------------------------------------------------------------------------
+def invalidar(requisicao_id: int, tipo: str = "") -> None:
+	"""Remove as entradas da requisição (todas ou apenas as do tipo indicado)."""
+	pasta = str(requisicao_id)
+	try:
+		if not storage.exists(pasta):
+			return
+		_, ficheiros = storage.listdir(pasta)
+	except (OSError, NotImplementedError):
+		return
+	for nome in ficheiros:
+		if not tipo or nome.startswith(f"{tipo}-"):
+			storage.delete(f"{pasta}/{nome}")
+
+
+def invalidar_no_commit(requisicao_id: int) -> None:
+	"""
+	Agenda a invalidação da requisição para o fim da transacção actual.
+	As requisições de uma transacção são juntas num único callback on_commit,
+	pelo que gravar N resultados da mesma requisição apaga a pasta uma só vez.
+	"""
+	transacao.acumular_no_commit("pdf_cache", requisicao_id, _invalidar_varias, criar=set)
+
+
+def _invalidar_varias(ids) -> None:
+	for pk in ids:
+		invalidar(pk)
+
+
+def aplicar_limite() -> None:
+	"""
+	Remove as entradas não usadas há mais de CACHE_TTL["pdf"] segundos e, depois,
+	as menos usadas até o total caber em PDF_CACHE["MAX_BYTES"].
+	"""
+	limite = _configuracao().get("MAX_BYTES")
+	validade = cache_partilhada.ttl("pdf")
+	if not limite and not validade:
+		return
+	entradas = []
+	try:
+		pastas, _ = storage.listdir("")
+		for pasta in pastas:
+			for nome in storage.listdir(pasta)[1]:
+				chave = f"{pasta}/{nome}"
+				entradas.append((storage.get_modified_time(chave), storage.size(chave), chave))
+	except (OSError, NotImplementedError) as e:
+		logger.warning("Falha ao percorrer a cache de PDFs: %s", e)
+		return
+
+	expiradas_antes = timezone.now() - timedelta(seconds=validade) if validade else None
+	total = sum(tamanho for _, tamanho, _ in entradas)
+	for modificado, tamanho, chave in sorted(entradas):
+		expirada = expiradas_antes is not None and modificado < expiradas_antes
+		if not expirada and (not limite or total <= limite):
+			break
+		storage.delete(chave)
+		total -= tamanho
@@ -8,6 +8,9 @@ Este módulo expõe duas funções principais:
 - gerar_pdf_requisicao(requisicao) -> (bytes, filename)
 - gerar_pdf_resultados(requisicao, apenas_validados=False) -> (bytes, filename)
 
+e as variantes escrever_pdf_requisicao / escrever_pdf_resultados, que
+escrevem directamente num ficheiro em vez de devolverem bytes.
+
 Design goals:
 - Manter compatibilidade com o código existente (não altera modelos).
 - Usar Times New Roman quando disponível; fallback para Courier.
@@ -17,10 +20,12 @@ Design goals:
 import os
 import io
 import logging
+import threading
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import BinaryIO, Optional, Tuple
 
 from django.conf import settings
+from django.utils import timezone
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 from reportlab.lib import colors
@@ -35,6 +40,9 @@ from reportlab.pdfgen import canvas as rl_canvas
 from reportlab.lib.enums import TA_LEFT, TA_RIGHT
 from PIL import Image
 
+from lab.models import Exame
+from lab.utils import catalogo, historico_paciente, referencias
+
 logger = logging.getLogger(__name__)
 
 # ---------------------------------------------------------------------------
@@ -58,42 +66,56 @@ except Exception as e:
 # ---------------------------------------------------------------------------
 # Canvas customizado
 # ---------------------------------------------------------------------------
+# Form XObject com o número total de páginas; definido em NumberedCanvas.save()
+FORM_TOTAL_PAGINAS = "AnaBioLinkTotalPaginas"
+
 class NumberedCanvas(rl_canvas.Canvas):
 	"""
-	Canvas customizado que salva estados de página, desenha rodapé com data/hora
-	e numeração "Página X de Y" ao salvar o documento.
+	Canvas customizado que desenha o rodapé com data/hora e numeração
+	"Página X de Y" em cada página.
+
+	O total Y ainda não é conhecido quando a página é fechada; o rodapé
+	referencia um Form XObject (FORM_TOTAL_PAGINAS) que só é definido em
+	save(), pelo que nenhuma página tem de ficar guardada em memória.
 	"""
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
-		self._saved_page_states = []
+		self._paginas = 0
+		self._gerado_em = datetime.now().strftime('%d/%m/%Y às %H:%M')
 
 	def showPage(self) -> None:
-		"""Armazena o estado atual da página e inicia uma nova."""
-		self._saved_page_states.append(dict(self.__dict__))
-		self._startPage()
+		"""Desenha o rodapé da página actual e inicia uma nova."""
+		self._paginas += 1
+		self._draw_footer()
+		super().showPage()
 
 	def save(self) -> None:
-		"""Desenha rodapé em todas as páginas salvas e efetiva o save final."""
-		num_pages = len(self._saved_page_states)
-		for state in self._saved_page_states:
-			self.__dict__.update(state)
-			self._draw_footer(num_pages)
-			rl_canvas.Canvas.showPage(self)
-		rl_canvas.Canvas.save(self)
-
-	def _draw_footer(self, total_pages: int) -> None:
-		"""Desenha o rodapé com data/hora de geração e numeração de páginas."""
+		"""Define o total de páginas referenciado pelos rodapés e efetiva o save final."""
+		self.beginForm(FORM_TOTAL_PAGINAS)
+		self._set_footer_font()
+		self.drawString(0, 0, str(self._paginas))
+		self.endForm()
+		super().save()
+
+	def _set_footer_font(self) -> None:
 		try:
 			self.setFont(FONT, 8)
 		except Exception:
 			# fallback muito seguro
 			self.setFont("Helvetica", 8)
 
-		page_num = self._pageNumber
-		footer_text = f"Gerado automaticamente por AnaBioLink em {datetime.now().strftime('%d/%m/%Y às %H:%M')}"
-		right = A4[0] - 1 * cm
-		self.drawRightString(right, 0.7 * cm, f"{footer_text} — Página {page_num} de {total_pages}")
+	def _draw_footer(self) -> None:
+		"""Desenha o rodapé com data/hora de geração e numeração de páginas."""
+		self.saveState()
+		self._set_footer_font()
+		footer_text = f"Gerado automaticamente por AnaBioLink em {self._gerado_em} — Página {self._pageNumber} de "
+		# espaço reservado para o total, que é desenhado alinhado à esquerda
+		x_total = A4[0] - 1 * cm - self.stringWidth("9999", self._fontname, self._fontsize)
+		self.drawRightString(x_total, 0.7 * cm, footer_text)
+		self.translate(x_total, 0.7 * cm)
+		self.doForm(FORM_TOTAL_PAGINAS)
+		self.restoreState()
 
 
 # ---------------------------------------------------------------------------
@@ -118,12 +140,52 @@ def _safe_image_reader(path: str) -> Optional[ImageReader]:
 		return None
 
 
-def draw_header(canvas_obj: rl_canvas.Canvas, doc) -> None:
+class RegistoRecursos:
 	"""
-	Desenha o cabeçalho do documento: logo, nome do sistema e contactos.
+	Registo, por processo, dos recursos gráficos usados nos PDFs.
+
+	Cada imagem é aberta, convertida e codificada uma única vez; a entrada é
+	recarregada quando a data de modificação do ficheiro muda.
 	"""
-	canvas_obj.saveState()
-	logo = _safe_image_reader(LOGO_PATH)
+
+	def __init__(self):
+		self._imagens = {}
+		self._lock = threading.Lock()
+
+	def imagem(self, path: str) -> Optional[ImageReader]:
+		"""Devolve o ImageReader pré-codificado de `path` (ou None se indisponível)."""
+		try:
+			mtime = os.stat(path).st_mtime_ns
+		except OSError:
+			return None
+		entrada = self._imagens.get(path)
+		if entrada and entrada[0] == mtime:
+			return entrada[1]
+		with self._lock:
+			entrada = self._imagens.get(path)
+			if not entrada or entrada[0] != mtime:
+				entrada = (mtime, _safe_image_reader(path))
+				self._imagens[path] = entrada
+		return entrada[1]
+
+	@property
+	def logo(self) -> Optional[ImageReader]:
+		return self.imagem(LOGO_PATH)
+
+
+recursos = RegistoRecursos()
+
+# Nome do Form XObject com o cabeçalho; é definido uma vez por documento
+FORM_CABECALHO = "AnaBioLinkCabecalho"
+
+
+def _definir_cabecalho(canvas_obj: rl_canvas.Canvas) -> None:
+	"""
+	Desenha o cabeçalho (logo, nome do sistema e contactos) num Form XObject,
+	que as páginas seguintes reutilizam por referência.
+	"""
+	canvas_obj.beginForm(FORM_CABECALHO)
+	logo = recursos.logo
 	if logo:
 		try:
 			canvas_obj.drawImage(logo, 20, A4[1] - 130, width=125, height=90, preserveAspectRatio=True)
@@ -146,6 +208,18 @@ def draw_header(canvas_obj: rl_canvas.Canvas, doc) -> None:
 	canvas_obj.setStrokeColor(colors.darkblue)
 	canvas_obj.setLineWidth(0.5)
 	canvas_obj.line(0 * cm, A4[1] - 120, A4[0], A4[1] - 120)
+	canvas_obj.endForm()
+
+
+def draw_header(canvas_obj: rl_canvas.Canvas, doc) -> None:
+	"""
+	Desenha o cabeçalho do documento: logo, nome do sistema e contactos.
+	O conteúdo é definido uma vez por documento e desenhado por referência.
+	"""
+	canvas_obj.saveState()
+	if not canvas_obj.hasForm(FORM_CABECALHO):
+		_definir_cabecalho(canvas_obj)
+	canvas_obj.doForm(FORM_CABECALHO)
 	canvas_obj.restoreState()
 
 
@@ -204,25 +278,44 @@ def _cell_paragraph(text: str, bold: bool = False) -> Paragraph:
 	return Paragraph(str(text), style)
 
 
+def nome_ficheiro_pdf(requisicao, tipo: str) -> str:
+	"""
+	Nome do ficheiro entregue no download.
+	:params tipo: "Requisicao" ou "Resultados"
+	"""
+	return f"AnaBioLink_{tipo}_{requisicao.id_custom}_{requisicao.paciente.nome}.pdf"
+
+
 # ---------------------------------------------------------------------------
 # Geração de PDF: Requisição
 # ---------------------------------------------------------------------------
 def gerar_pdf_requisicao(requisicao) -> Tuple[bytes, str]:
 	"""
-	Gera o PDF da requisição de exames.
+	Gera o PDF da requisição de exames em memória.
 
 	:param requisicao: instância de RequisicaoAnalise
 	:returns: tuple (pdf_bytes, filename)
 	"""
+	buffer = io.BytesIO()
+	escrever_pdf_requisicao(requisicao, buffer)
+	return buffer.getvalue(), nome_ficheiro_pdf(requisicao, "Requisicao")
+
+
+def escrever_pdf_requisicao(requisicao, destino: BinaryIO) -> None:
+	"""
+	Gera o PDF da requisição de exames directamente em `destino`.
+
+	:param requisicao: instância de RequisicaoAnalise
+	:param destino: ficheiro binário aberto para escrita
+	"""
 	import reportlab.lib.pagesizes as pagesizes
 
-	buffer = io.BytesIO()
 	page_width, _ = pagesizes.A4
 	left_margin, right_margin = 1 * cm, 1 * cm
 	usable_width = page_width - left_margin - right_margin
 
 	doc = SimpleDocTemplate(
-		buffer,
+		destino,
 		pagesize=pagesizes.A4,
 		leftMargin=left_margin,
 		rightMargin=right_margin,
@@ -286,11 +379,16 @@ def gerar_pdf_requisicao(requisicao) -> Tuple[bytes, str]:
 	story.append(Paragraph("Exames Requisitados", style_title))
 	story.append(Spacer(1, 0.3 * cm))
 
-	exames = requisicao.exames.all()
+	# só os ids vêm da base de dados; os exames vêm do catálogo em cache
+	exames_cat = catalogo.obter()
+	exames = sorted(
+		(exames_cat.exame(pk) or Exame.objects.get(pk=pk) for pk in requisicao.exames.values_list("id", flat=True)),
+		key=lambda e: e.nome,
+	)
 	exames_data = [
 		[_cell_paragraph(f"Nome do Exame: &nbsp;&nbsp;&nbsp&nbsp;&nbsp;&nbsp;{e.codigo.upper()}&nbsp;&nbsp;&nbsp;|&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;{e.nome.capitalize()}&nbsp;&nbsp;&nbsp;|&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;{e.metodo.capitalize()}&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;")]
 		for e in exames
-	] if exames.exists() else [[_cell_paragraph("Nenhum exame registrado.", bold=True)]]
+	] if exames else [[_cell_paragraph("Nenhum exame registrado.", bold=True)]]
 
 	tabela_exames = Table(exames_data, colWidths=[usable_width], hAlign="LEFT")
 	tabela_exames.setStyle(TableStyle([
@@ -307,32 +405,39 @@ def gerar_pdf_requisicao(requisicao) -> Tuple[bytes, str]:
 		canvasmaker=NumberedCanvas
 	)
 
-	pdf_bytes = buffer.getvalue()
-	buffer.close()
-	filename = f"AnaBioLink_Requisicao_{requisicao.id_custom}_{requisicao.paciente.nome}.pdf"
-	return pdf_bytes, filename
-
 
 # ---------------------------------------------------------------------------
 # Geração de PDF: Resultados
 # ---------------------------------------------------------------------------
 def gerar_pdf_resultados(requisicao, apenas_validados: bool = False) -> Tuple[bytes, str]:
 	"""
-	Gera o PDF com os resultados dos exames de uma requisição.
+	Gera o PDF com os resultados dos exames de uma requisição em memória.
 
 	:param requisicao: instância de RequisicaoAnalise
 	:param apenas_validados: se True inclui apenas resultados validados
 	:return: tuple (pdf_bytes, filename)
 	"""
+	buffer = io.BytesIO()
+	escrever_pdf_resultados(requisicao, buffer, apenas_validados=apenas_validados)
+	return buffer.getvalue(), nome_ficheiro_pdf(requisicao, "Resultados")
+
+
+def escrever_pdf_resultados(requisicao, destino: BinaryIO, apenas_validados: bool = False) -> None:
+	"""
+	Gera o PDF com os resultados dos exames directamente em `destino`.
+
+	:param requisicao: instância de RequisicaoAnalise
+	:param destino: ficheiro binário aberto para escrita
+	:param apenas_validados: se True inclui apenas resultados validados
+	"""
 	import reportlab.lib.pagesizes as pagesizes
 
-	buffer = io.BytesIO()
 	page_width, _ = pagesizes.A4
 	left_margin, right_margin = 3 * cm, 1 * cm
 	usable_width = page_width - left_margin - right_margin
 
 	doc = SimpleDocTemplate(
-		buffer,
+		destino,
 		pagesize=pagesizes.A4,
 		leftMargin=left_margin,
 		rightMargin=right_margin,
@@ -392,13 +497,15 @@ def gerar_pdf_resultados(requisicao, apenas_validados: bool = False) -> Tuple[by
 	if not resultados_qs:
 		elements.append(Paragraph("Nenhum resultado disponível para esta requisição.", cell_style))
 	else:
-		qs = resultados_qs.select_related("exame_campo__exame")
+		qs = resultados_qs.all()
 		if apenas_validados:
 			qs = qs.filter(validado=True)
 
-		# Agrupa por exame (exame.nome)
+		# Agrupa por exame (exame.nome); campos e exames vêm do catálogo em cache
 		exames_agrupados = {}
-		for r in qs:
+		resultados_ligados = referencias.sinalizar(catalogo.ligar_campos(qs), requisicao)
+		# último valor validado do mesmo campo em requisições anteriores (uma consulta)
+		for r in historico_paciente.ligar_anteriores(resultados_ligados, requisicao, k=1):
 			exame = r.exame_campo.exame
 			exames_agrupados.setdefault(exame.nome, []).append(r)
 
@@ -413,7 +520,8 @@ def gerar_pdf_resultados(requisicao, apenas_validados: bool = False) -> Tuple[by
 				_cell_paragraph(resultados[0].exame_campo.exame.metodo, bold=True),
 				_cell_paragraph("Resultado", bold=True),
 				_cell_paragraph("Unidade", bold=True),
-				_cell_paragraph("Valor de Ref.", bold=True)
+				_cell_paragraph("Valor de Ref.", bold=True),
+				_cell_paragraph("Anterior", bold=True),
 			]]
 
 			# Linhas com resultados
@@ -426,17 +534,27 @@ def gerar_pdf_resultados(requisicao, apenas_validados: bool = False) -> Tuple[by
 							valor = v
 							break
 
+				# H/L fora do intervalo de referência, HH/LL além do valor crítico (a negrito)
+				sinal = r.sinal if r.sinal != "N" else ""
+				anterior = r.anteriores[0] if r.anteriores else None
 				data.append([
 					_cell_paragraph(r.exame_campo.nome_campo),
-					_cell_paragraph(f"{valor} {r.exame_campo.unidade}" if valor not in (None, "") else "-"),
+					_cell_paragraph(
+						f"{valor} {r.exame_campo.unidade} {sinal}".strip() if valor not in (None, "") else "-",
+						bold=bool(sinal),
+					),
 					_cell_paragraph(r.exame_campo.unidade or "-"),
 					_cell_paragraph(r.exame_campo.valor_referencia or "-"),
+					_cell_paragraph(
+						f"{anterior.resultado} ({timezone.localtime(anterior.data).strftime('%d/%m/%Y')})"
+						if anterior else "-"
+					),
 				])
 
 			# Tabela de resultados
 			table = Table(
 				data,
-				colWidths=[usable_width * 0.35, usable_width * 0.35, usable_width * 0.15, usable_width * 0.15],
+				colWidths=[usable_width * 0.3, usable_width * 0.25, usable_width * 0.1, usable_width * 0.15, usable_width * 0.2],
 				hAlign="LEFT"
 			)
 			table.setStyle(TableStyle([
@@ -455,8 +573,3 @@ def gerar_pdf_resultados(requisicao, apenas_validados: bool = False) -> Tuple[by
 		onLaterPages=lambda c, d: _on_page(c, d, analista),
 		canvasmaker=NumberedCanvas
 	)
-
-	pdf = buffer.getvalue()
-	buffer.close()
-	filename = f"AnaBioLink_Resultados_{requisicao.id_custom}_{requisicao.paciente.nome}.pdf"
-	return pdf, filename
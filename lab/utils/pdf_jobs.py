@@ -0,0 +1,376 @@
+"""
+lab.utils.pdf_jobs
+------------------
+
+Serviço de renderização de PDFs num pool de processos.
+
+A geração com ReportLab é CPU-bound; em vez de bloquear o worker do gunicorn,
+as views, o admin e a API submetem um trabalho e recebem um id. Um
+ProcessPoolExecutor local (sem broker externo) gera o PDF e grava-o em
+PDF_RENDER["DIRETORIO"] juntamente com um ficheiro <id>.json de estado, pelo
+que qualquer processo da mesma máquina pode responder ao polling e servir o
+ficheiro final.
+
+Limites (settings.PDF_RENDER):
+- WORKERS: processos do pool;
+- MAX_FILA: trabalhos em curso por processo antes de recusar (FilaCheia);
+- TIMEOUT: segundos por trabalho (SIGALRM no processo do pool);
+- RETENCAO_HORAS: idade a partir da qual os ficheiros de trabalhos são apagados.
+- MAX_PDF_UNICO: requisições num PDF único de lab.utils.pdf_lote.
+
+`renderizar_em_lote()` usa o mesmo pool para exportações de várias
+requisições; com WORKERS = 0 os PDFs são gerados no próprio processo.
+"""
+
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TIPOS = ("requisicao", "resultados")
+
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+_em_curso = 0
+_ultima_limpeza = 0.0
+INTERVALO_LIMPEZA = 600
+_metricas = {
+	"submetidos": 0,
+	"concluidos": 0,
+	"falhados": 0,
+	"expirados": 0,
+	"recusados": 0,
+	"segundos_renderizacao": 0.0,
+}
+
+
+class FilaCheia(Exception):
+	"""O número de trabalhos em curso atingiu PDF_RENDER["MAX_FILA"]."""
+
+
+class TempoEsgotado(Exception):
+	"""O trabalho excedeu PDF_RENDER["TIMEOUT"]."""
+
+
+def _configuracao() -> dict:
+	padrao = {
+		"WORKERS": 2,
+		"MAX_FILA": 20,
+		"TIMEOUT": 120,
+		"DIRETORIO": os.path.join(settings.MEDIA_ROOT, "pdf_jobs"),
+		"RETENCAO_HORAS": 24,
+	}
+	padrao.update(getattr(settings, "PDF_RENDER", {}))
+	return padrao
+
+
+def _diretorio() -> str:
+	diretorio = str(_configuracao()["DIRETORIO"])
+	os.makedirs(diretorio, exist_ok=True)
+	return diretorio
+
+
+def _caminho(job_id: str, extensao: str) -> str:
+	# job_id é sempre um uuid hex; evita caminhos arbitrários vindos do pedido
+	if not job_id.isalnum():
+		raise ValueError("Identificador de trabalho inválido.")
+	return os.path.join(_diretorio(), f"{job_id}.{extensao}")
+
+
+def _gravar_estado(job_id: str, **dados) -> None:
+	caminho = _caminho(job_id, "json")
+	temporario = f"{caminho}.tmp"
+	with open(temporario, "w", encoding="utf-8") as f:
+		json.dump(dados, f)
+	os.replace(temporario, caminho)
+
+
+# ---------------------------------------------------------------------------
+# Código executado nos processos do pool
+# ---------------------------------------------------------------------------
+def _iniciar_worker(settings_module: str) -> None:
+	os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+	import django
+	django.setup()
+
+
+def _alarme(signum, frame):
+	raise TempoEsgotado()
+
+
+def _abrir(tipo: str, requisicao_id: int, apenas_validados: bool):
+	"""Abre o PDF através da cache de PDFs; devolve (ficheiro, filename)."""
+	from lab.models import RequisicaoAnalise
+	from lab.utils import pdf_cache
+
+	requisicao = RequisicaoAnalise.objects.select_related("paciente", "analista").get(pk=requisicao_id)
+	if tipo == "requisicao":
+		return pdf_cache.abrir_pdf_requisicao(requisicao)
+	return pdf_cache.abrir_pdf_resultados(requisicao, apenas_validados=apenas_validados)
+
+
+def _gerar(tipo: str, requisicao_id: int, apenas_validados: bool) -> Tuple[bytes, str]:
+	"""Como _abrir, mas devolve (pdf_bytes, filename)."""
+	ficheiro, filename = _abrir(tipo, requisicao_id, apenas_validados)
+	with ficheiro:
+		return ficheiro.read(), filename
+
+
+def _renderizar(job_id: str, tipo: str, requisicao_id: int, apenas_validados: bool, timeout: int) -> dict:
+	"""Gera o PDF (via cache de PDFs) e grava-o em <id>.pdf; devolve o estado final."""
+	from django.db import close_old_connections
+
+	inicio = time.monotonic()
+	signal.signal(signal.SIGALRM, _alarme)
+	signal.alarm(timeout)
+	base = {"tipo": tipo, "requisicao_id": requisicao_id, "criado_em": time.time()}
+	try:
+		_gravar_estado(job_id, estado="em_curso", **base)
+		ficheiro, filename = _abrir(tipo, requisicao_id, apenas_validados)
+		with ficheiro, open(_caminho(job_id, "pdf"), "wb") as f:
+			shutil.copyfileobj(ficheiro, f)
+			tamanho = f.tell()
+		final = dict(base, estado="concluido", filename=filename, tamanho=tamanho)
+	except TempoEsgotado:
+		final = dict(base, estado="expirado", erro=f"Tempo limite de {timeout}s excedido.")
+	except Exception as e:
+		logger.exception("Erro ao gerar PDF do trabalho %s", job_id)
+		final = dict(base, estado="erro", erro=str(e))
+	finally:
+		signal.alarm(0)
+		close_old_connections()
+	final["segundos"] = round(time.monotonic() - inicio, 3)
+	_gravar_estado(job_id, **final)
+	return final
+
+
+def _renderizar_conteudo(tipo: str, requisicao_id: int, apenas_validados: bool, timeout: int) -> Tuple[bytes, str]:
+	"""Versão de _renderizar para lotes: devolve os bytes em vez de os gravar em disco."""
+	from django.db import close_old_connections
+
+	signal.signal(signal.SIGALRM, _alarme)
+	signal.alarm(timeout)
+	try:
+		return _gerar(tipo, requisicao_id, apenas_validados)
+	finally:
+		signal.alarm(0)
+		close_old_connections()
+
+
+# ---------------------------------------------------------------------------
+# Lado do servidor web
+# ---------------------------------------------------------------------------
+def _obter_executor() -> ProcessPoolExecutor:
+	global _executor
+	with _lock:
+		if _executor is None:
+			_executor = ProcessPoolExecutor(
+				max_workers=_configuracao()["WORKERS"],
+				mp_context=multiprocessing.get_context("forkserver"),
+				initializer=_iniciar_worker,
+				initargs=(os.environ.get("DJANGO_SETTINGS_MODULE", "backend.settings"),),
+			)
+		return _executor
+
+
+def _ao_terminar(executor: ProcessPoolExecutor, future) -> None:
+	global _em_curso
+	try:
+		final = future.result()
+	except CancelledError:
+		# cancelado pelo shutdown de um pool partido (ver _reiniciar_executor)
+		final = None
+	except BrokenProcessPool:
+		# processo do pool morreu (ex.: OOM); o pool é recriado no próximo pedido
+		final = None
+		_reiniciar_executor(executor)
+	except Exception:
+		logger.exception("Erro inesperado num trabalho de PDF")
+		final = None
+	with _lock:
+		_em_curso -= 1
+		if final is None:
+			_metricas["falhados"] += 1
+			return
+		chave = {"concluido": "concluidos", "expirado": "expirados"}.get(final["estado"], "falhados")
+		_metricas[chave] += 1
+		_metricas["segundos_renderizacao"] += final.get("segundos", 0.0)
+
+
+def _reiniciar_executor(partido: ProcessPoolExecutor) -> None:
+	"""
+	Esquece o pool `partido` para que o próximo pedido crie outro. Não faz
+	nada se já tiver sido substituído (os futures de um pool partido terminam
+	todos com erro, mas só o primeiro o deve reiniciar).
+	"""
+	global _executor
+	with _lock:
+		if _executor is not partido:
+			return
+		_executor = None
+	# fora do lock: o shutdown cancela futures e os seus callbacks (_ao_terminar) voltam a pedi-lo
+	partido.shutdown(wait=False, cancel_futures=True)
+
+
+def submeter(tipo: str, requisicao_id: int, apenas_validados: bool = True) -> str:
+	"""
+	Submete a geração de um PDF e devolve o id do trabalho.
+
+	:param tipo: "requisicao" ou "resultados"
+	:param requisicao_id: id da RequisicaoAnalise
+	:param apenas_validados: para "resultados", incluir só resultados validados
+	:raises FilaCheia: se já houver PDF_RENDER["MAX_FILA"] trabalhos em curso
+	"""
+	global _em_curso
+	if tipo not in TIPOS:
+		raise ValueError(f"Tipo de PDF desconhecido: {tipo}")
+	config = _configuracao()
+	job_id = uuid.uuid4().hex
+
+	with _lock:
+		if _em_curso >= config["MAX_FILA"]:
+			_metricas["recusados"] += 1
+			raise FilaCheia(f"Fila de PDFs cheia ({config['MAX_FILA']} trabalhos em curso).")
+		_em_curso += 1
+		_metricas["submetidos"] += 1
+
+	_gravar_estado(job_id, estado="pendente", tipo=tipo, requisicao_id=requisicao_id, criado_em=time.time())
+	executor = _obter_executor()
+	try:
+		future = executor.submit(
+			_renderizar, job_id, tipo, requisicao_id, apenas_validados, int(config["TIMEOUT"])
+		)
+	except Exception:
+		with _lock:
+			_em_curso -= 1
+		_reiniciar_executor(executor)
+		raise
+	future.add_done_callback(functools.partial(_ao_terminar, executor))
+	_limpar_periodicamente()
+	return job_id
+
+
+def renderizar_em_lote(tipo: str, ids: Iterable[int], apenas_validados: bool = True) -> Iterator[dict]:
+	"""
+	Gera os PDFs de várias requisições em paralelo e devolve-os pela ordem de `ids`.
+
+	No máximo 2 × WORKERS PDFs estão em curso ou à espera de serem consumidos,
+	pelo que a memória usada não depende do tamanho do lote. Cada item é um dict
+	com requisicao_id, conteudo e filename, ou requisicao_id e erro.
+
+	:param tipo: "requisicao" ou "resultados"
+	:param ids: ids de RequisicaoAnalise
+	:param apenas_validados: para "resultados", incluir só resultados validados
+	"""
+	if tipo not in TIPOS:
+		raise ValueError(f"Tipo de PDF desconhecido: {tipo}")
+	config = _configuracao()
+	ids = iter(ids)
+
+	if not config["WORKERS"]:
+		for requisicao_id in ids:
+			try:
+				conteudo, filename = _gerar(tipo, requisicao_id, apenas_validados)
+				yield {"requisicao_id": requisicao_id, "conteudo": conteudo, "filename": filename}
+			except Exception as e:
+				logger.exception("Erro ao gerar PDF da requisição %s", requisicao_id)
+				yield {"requisicao_id": requisicao_id, "erro": str(e)}
+		return
+
+	executor = _obter_executor()
+	timeout = int(config["TIMEOUT"])
+	em_curso = deque()
+
+	def submeter_proximo() -> None:
+		requisicao_id = next(ids, None)
+		if requisicao_id is not None:
+			future = executor.submit(_renderizar_conteudo, tipo, requisicao_id, apenas_validados, timeout)
+			em_curso.append((requisicao_id, future))
+
+	for _ in range(2 * config["WORKERS"]):
+		submeter_proximo()
+	try:
+		while em_curso:
+			requisicao_id, future = em_curso.popleft()
+			try:
+				conteudo, filename = future.result()
+			except TempoEsgotado:
+				yield {"requisicao_id": requisicao_id, "erro": f"Tempo limite de {timeout}s excedido."}
+			except BrokenProcessPool:
+				_reiniciar_executor(executor)
+				raise
+			except Exception as e:
+				logger.exception("Erro ao gerar PDF da requisição %s", requisicao_id)
+				yield {"requisicao_id": requisicao_id, "erro": str(e)}
+			else:
+				yield {"requisicao_id": requisicao_id, "conteudo": conteudo, "filename": filename}
+			submeter_proximo()
+	finally:
+		# cliente desligou-se a meio do download: não gerar o resto do lote
+		for _, future in em_curso:
+			future.cancel()
+
+
+def estado(job_id: str) -> Optional[dict]:
+	"""Estado do trabalho (pendente, em_curso, concluido, expirado, erro) ou None se não existir."""
+	try:
+		with open(_caminho(job_id, "json"), encoding="utf-8") as f:
+			dados = json.load(f)
+	except (OSError, ValueError):
+		return None
+	dados["id"] = job_id
+	return dados
+
+
+def caminho_pdf(job_id: str) -> Optional[str]:
+	"""Caminho do PDF gerado, se o trabalho estiver concluído."""
+	dados = estado(job_id)
+	if not dados or dados.get("estado") != "concluido":
+		return None
+	return _caminho(job_id, "pdf")
+
+
+def metricas() -> dict:
+	"""Contadores do processo actual (cada worker do gunicorn tem o seu pool)."""
+	with _lock:
+		dados = dict(_metricas, em_curso=_em_curso, pid=os.getpid())
+	concluidos = dados["concluidos"] or 1
+	dados["segundos_medios"] = round(dados["segundos_renderizacao"] / concluidos, 3)
+	return dados
+
+
+def _limpar_periodicamente() -> None:
+	global _ultima_limpeza
+	agora = time.monotonic()
+	if agora - _ultima_limpeza >= INTERVALO_LIMPEZA:
+		_ultima_limpeza = agora
+		limpar_antigos()
+
+
+def limpar_antigos() -> int:
+	"""Apaga ficheiros de trabalhos mais antigos que PDF_RENDER["RETENCAO_HORAS"]."""
+	limite = time.time() - _configuracao()["RETENCAO_HORAS"] * 3600
+	removidos = 0
+	with os.scandir(_diretorio()) as entradas:
+		for entrada in entradas:
+			try:
+				if entrada.is_file() and entrada.stat().st_mtime < limite:
+					os.remove(entrada.path)
+					removidos += 1
+			except OSError:
+				pass
+	return removidos
@@ -0,0 +1,190 @@
+"""
+lab.utils.pdf_lote
+------------------
+
+Exportação de PDFs de várias requisições num só download.
+
+Os PDFs são gerados em paralelo pelo pool de lab.utils.pdf_jobs (passando
+pela cache de PDFs) e entregues num de dois formatos:
+
+- "zip": um PDF por requisição, enviado em streaming à medida que cada
+  ficheiro fica pronto (sem compressão; os PDFs já vêm comprimidos);
+- "pdf": um único documento com um marcador e uma numeração de páginas
+  própria por paciente, escrito num ficheiro temporário e servido com
+  FileResponse.
+
+"zip" é o formato por omissão, nas acções do admin e na view pdf_lote_exportar.
+"pdf" só é usado quando pedido explicitamente e precisa do pacote opcional
+pypdf: o PdfWriter mantém em memória as páginas de todos os PDFs do lote até
+ao fim (no ZIP fica em memória no máximo um PDF de cada vez) e o download só
+começa depois de todos estarem gerados. Por isso o número de requisições num
+PDF único está limitado a PDF_RENDER["MAX_PDF_UNICO"]; acima disso
+exportar() recusa o pedido com LoteGrande e o ZIP é a alternativa.
+"""
+
+import io
+import logging
+import tempfile
+import zipfile
+from typing import Iterable, Iterator
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from lab.models import RequisicaoAnalise
+from lab.utils import pdf_jobs
+
+try:
+	from pypdf import PdfReader, PdfWriter
+except ImportError:  # pragma: no cover - dependência opcional
+	PdfReader = PdfWriter = None
+
+logger = logging.getLogger(__name__)
+
+FORMATOS = ("zip", "pdf")
+MAX_PDF_UNICO = 50
+
+
+class LoteGrande(Exception):
+	"""O lote tem mais requisições do que as permitidas num PDF único."""
+
+
+def max_pdf_unico() -> int:
+	"""Número máximo de requisições num PDF único (PDF_RENDER["MAX_PDF_UNICO"])."""
+	return int(getattr(settings, "PDF_RENDER", {}).get("MAX_PDF_UNICO", MAX_PDF_UNICO))
+
+
+def _ids(requisicoes: Iterable) -> list:
+	if isinstance(requisicoes, QuerySet):
+		return list(requisicoes.values_list("id", flat=True))
+	return [getattr(r, "pk", r) for r in requisicoes]
+
+
+def _nome_lote(tipo: str, extensao: str) -> str:
+	return f"AnaBioLink_{tipo.capitalize()}_{timezone.localtime().strftime('%Y%m%d_%H%M')}.{extensao}"
+
+
+# ---------------------------------------------------------------------------
+# ZIP em streaming
+# ---------------------------------------------------------------------------
+class _SaidaZip:
+	"""Destino não posicionável para o ZipFile; acumula o que ainda não foi enviado."""
+
+	def __init__(self):
+		self._partes = []
+
+	def write(self, dados) -> int:
+		self._partes.append(bytes(dados))
+		return len(dados)
+
+	def flush(self) -> None:
+		pass
+
+	def esvaziar(self) -> bytes:
+		dados = b"".join(self._partes)
+		self._partes.clear()
+		return dados
+
+
+def fluxo_zip(itens: Iterable[dict]) -> Iterator[bytes]:
+	"""
+	Escreve os itens de pdf_jobs.renderizar_em_lote num ZIP e devolve-o aos pedaços.
+	As requisições que falharem são listadas em erros.txt no fim do arquivo.
+	"""
+	saida = _SaidaZip()
+	erros = []
+	with zipfile.ZipFile(saida, "w", compression=zipfile.ZIP_STORED) as arquivo:
+		for item in itens:
+			if "erro" in item:
+				erros.append(f"Requisição {item['requisicao_id']}: {item['erro']}")
+				continue
+			arquivo.writestr(item["filename"], item["conteudo"])
+			yield saida.esvaziar()
+		if erros:
+			arquivo.writestr("erros.txt", "\n".join(erros) + "\n")
+	yield saida.esvaziar()
+
+
+# ---------------------------------------------------------------------------
+# PDF único
+# ---------------------------------------------------------------------------
+def juntar_pdfs(itens: Iterable[dict], destino, titulos: dict) -> int:
+	"""
+	Junta os PDFs num único documento gravado em `destino` (ficheiro binário).
+
+	Cada requisição recebe um marcador "<id_custom> — <paciente>" e uma
+	numeração de páginas própria (etiquetas "<id_custom>-1", "<id_custom>-2", ...),
+	além do "Página X de Y" que cada PDF já traz no rodapé.
+
+	Todas as páginas ficam no PdfWriter até ao write() final: a memória usada
+	é da ordem do tamanho do documento junto (exportar() limita o lote a
+	max_pdf_unico() requisições).
+
+	:param titulos: {requisicao_id: (id_custom, nome do paciente)}
+	:returns: número de requisições incluídas
+	"""
+	if PdfWriter is None:
+		raise RuntimeError("A exportação num único PDF requer o pacote pypdf.")
+	writer = PdfWriter()
+	incluidas = 0
+	for item in itens:
+		if "erro" in item:
+			logger.warning("Requisição %s omitida do PDF em lote: %s", item["requisicao_id"], item["erro"])
+			continue
+		inicio = len(writer.pages)
+		writer.append(PdfReader(io.BytesIO(item["conteudo"])), import_outline=False)
+		id_custom, paciente = titulos[item["requisicao_id"]]
+		writer.add_outline_item(f"{id_custom} — {paciente}", inicio)
+		writer.set_page_label(inicio, len(writer.pages) - 1, style="/D", prefix=f"{id_custom}-", start=1)
+		incluidas += 1
+	writer.write(destino)
+	return incluidas
+
+
+# ---------------------------------------------------------------------------
+# Resposta HTTP
+# ---------------------------------------------------------------------------
+def exportar(requisicoes: Iterable, tipo: str, formato: str = "zip", apenas_validados: bool = True):
+	"""
+	Devolve a resposta de download com os PDFs de várias requisições.
+
+	:param requisicoes: queryset, instâncias ou ids de RequisicaoAnalise (a ordem é mantida)
+	:param tipo: "requisicao" ou "resultados"
+	:param formato: "zip" (StreamingHttpResponse) ou "pdf" (FileResponse de um ficheiro temporário)
+	:param apenas_validados: para "resultados", incluir só resultados validados
+	:raises ValueError: tipo ou formato desconhecido
+	:raises LoteGrande: formato "pdf" com mais de max_pdf_unico() requisições
+	"""
+	if tipo not in pdf_jobs.TIPOS:
+		raise ValueError(f"Tipo de PDF desconhecido: {tipo}")
+	if formato not in FORMATOS:
+		raise ValueError(f"Formato de exportação desconhecido: {formato}")
+	ids = _ids(requisicoes)
+	titulos = {
+		pk: (id_custom, paciente)
+		for pk, id_custom, paciente in RequisicaoAnalise.objects.filter(id__in=ids).values_list(
+			"id", "id_custom", "paciente__nome"
+		)
+	}
+	ids = list(dict.fromkeys(pk for pk in ids if pk in titulos))
+	if formato == "pdf" and len(ids) > max_pdf_unico():
+		raise LoteGrande(
+			f"Um PDF único aceita no máximo {max_pdf_unico()} requisições ({len(ids)} pedidas); use o ZIP."
+		)
+	itens = pdf_jobs.renderizar_em_lote(tipo, ids, apenas_validados=apenas_validados)
+
+	if formato == "zip":
+		response = StreamingHttpResponse(fluxo_zip(itens), content_type="application/zip")
+		response["Content-Disposition"] = f'attachment; filename="{_nome_lote(tipo, "zip")}"'
+		return response
+
+	destino = tempfile.TemporaryFile()
+	try:
+		juntar_pdfs(itens, destino, titulos)
+	except Exception:
+		destino.close()
+		raise
+	destino.seek(0)
+	return FileResponse(destino, as_attachment=True, filename=_nome_lote(tipo, "pdf"), content_type="application/pdf")
@@ -0,0 +1,96 @@
+"""
+lab.utils.pesquisa_pacientes
+----------------------------
+
+Pesquisa de pacientes para o autocomplete do admin e para a API.
+
+Em vez de `icontains` sobre cinco colunas (uma leitura sequencial da tabela
+inteira a cada tecla), a pesquisa usa:
+
+- prefixo exacto de `id_custom` / `numero_id` quando o termo parece um código
+  (servido pelos índices varchar_pattern_ops que o Django cria nas colunas únicas);
+- a coluna `Paciente.texto_pesquisa` (nome sem acentos em minúsculas + dígitos
+  do contacto), mantida em `Paciente.save()`, com um índice GIN pg_trgm para
+  `LIKE '%termo%'` e um índice text_pattern_ops para prefixos (migração 0011).
+
+Os resultados vêm ordenados por relevância: código, início do nome, início de
+uma palavra do nome e, no PostgreSQL, semelhança de trigramas.
+"""
+
+import re
+import unicodedata
+
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, QuerySet, Value, When
+
+from lab.models import Paciente
+
+# Abaixo disto os trigramas não ajudam: só se pesquisa pelo início do nome.
+MIN_TRIGRAMA = 3
+LIMITE = 20
+
+
+def normalizar(texto) -> str:
+	"""Minúsculas, sem acentos e com espaços simples: 'José  Ângelo' -> 'jose angelo'."""
+	decomposto = unicodedata.normalize("NFKD", str(texto or ""))
+	sem_acentos = "".join(c for c in decomposto if not unicodedata.combining(c))
+	return " ".join(sem_acentos.lower().split())
+
+
+def texto_pesquisa(paciente) -> str:
+	"""Valor de Paciente.texto_pesquisa: nome normalizado e dígitos do contacto."""
+	digitos = re.sub(r"\D", "", paciente.contacto or "")
+	return f"{normalizar(paciente.nome)} {digitos}".strip()
+
+
+def _parece_codigo(termo: str) -> bool:
+	return " " not in termo and any(c.isdigit() for c in termo)
+
+
+def pesquisar(termo: str, queryset: QuerySet = None) -> QuerySet:
+	"""
+	Filtra e ordena `queryset` (por omissão todos os pacientes) por `termo`.
+
+	O queryset devolvido traz a anotação `relevancia` (0 = melhor) e já vem
+	ordenado; um termo vazio devolve o queryset sem alterações.
+	"""
+	if queryset is None:
+		queryset = Paciente.objects.all()
+	termo = termo.strip()
+	normalizado = normalizar(termo)
+	if not normalizado:
+		return queryset
+
+	if len(normalizado) < MIN_TRIGRAMA:
+		filtro = Q(texto_pesquisa__startswith=normalizado)
+	else:
+		filtro = Q()
+		for palavra in normalizado.split():
+			filtro &= Q(texto_pesquisa__contains=palavra)
+
+	casos = []
+	if _parece_codigo(termo):
+		codigo = (
+			Q(id_custom__startswith=termo.upper())
+			| Q(numero_id__startswith=termo)
+			| Q(numero_id__startswith=termo.upper())
+		)
+		filtro |= codigo
+		casos.append(When(codigo, then=Value(0)))
+
+	queryset = queryset.filter(filtro).annotate(
+		relevancia=Case(
+			*casos,
+			When(texto_pesquisa__startswith=normalizado, then=Value(1)),
+			When(texto_pesquisa__contains=f" {normalizado}", then=Value(2)),
+			default=Value(3),
+			output_field=IntegerField(),
+		)
+	)
+	ordem = ["relevancia"]
+	if connections[queryset.db].vendor == "postgresql":
+		from django.contrib.postgres.search import TrigramWordSimilarity
+
+		queryset = queryset.annotate(semelhanca=TrigramWordSimilarity(Value(normalizado), "texto_pesquisa"))
+		ordem.append("-semelhanca")
+	return queryset.order_by(*ordem, "nome", "id")
@@ -0,0 +1,256 @@
+"""
+lab.utils.referencias
+---------------------
+
+Interpretação dos valores de referência (ExameCampo.valor_referencia, texto
+livre) e sinalização de resultados fora do intervalo, em lote com NumPy.
+
+Formatos reconhecidos, separados por ";", "|", mudança de linha ou " / ":
+
+	12 - 340            3,5 a 5,0           < 200           >= 40
+	H: 13 - 17; M: 12 - 15                  (H/M = homem/mulher)
+	Masculino: 13-17 / Feminino: 12-15      (sem "H", M = masculino)
+	Adultos: 3 - 8; Crianças: 5 - 10        0-12 anos: 5-10; > 12 anos: 3-8
+	Crítico: < 2,5 ou > 6,5
+
+interpretar() guarda o resultado por texto (lru_cache), pelo que cada texto
+distinto é analisado uma vez por processo. sinalizar() escolhe para cada
+resultado o intervalo do sexo e idade do paciente e classifica o lote de uma
+vez: "N" normal, "L"/"H" abaixo/acima, "LL"/"HH" abaixo/acima do valor
+crítico, "" sem valor numérico ou sem referência.
+"""
+
+import math
+import re
+import unicodedata
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from lab.utils import catalogo
+
+NUMERO = r"-?\d+(?:[.,]\d+)?"
+_SEPARADORES = re.compile(r"\s*[;|\n]\s*|\s+/\s+")
+_INTERVALO = re.compile(rf"^(?:entre\s+)?({NUMERO})\s*(?:-|–|a|ate|e)\s*({NUMERO})")
+_MAXIMO = re.compile(rf"^(?:<=?|≤|ate|inferior a|menor que|abaixo de)\s*({NUMERO})")
+_MINIMO = re.compile(rf"^(?:>=?|≥|superior a|maior que|acima de)\s*({NUMERO})")
+_CRITICO = re.compile(r"^(?:criticos?|critico|valores? criticos?|panico)\b\s*:?\s*")
+_ROTULO_SEM_DOIS_PONTOS = re.compile(r"^([a-z][a-z.\s]*?)\s+(?=[<>≤≥\d-])")
+
+_SEXO_M = {"homem", "homens", "masc", "masculino", "h"}
+_SEXO_F = {"mulher", "mulheres", "fem", "feminino", "f"}
+_DIAS_POR_ANO = 365.25
+
+
+class Intervalo(NamedTuple):
+	sexo: Optional[str]          # "M", "F" ou None (ambos)
+	idade_min: Optional[float]   # anos, inclusivo
+	idade_max: Optional[float]   # anos, exclusivo
+	baixo: Optional[float]
+	alto: Optional[float]
+
+
+class Referencia(NamedTuple):
+	intervalos: Tuple[Intervalo, ...]
+	critico_baixo: Optional[float] = None
+	critico_alto: Optional[float] = None
+
+	def limites(self, sexo: Optional[str], idade: Optional[float]) -> Tuple[float, float, float, float]:
+		"""(baixo, alto, crítico baixo, crítico alto) para o paciente; NaN onde não há limite."""
+		baixo, alto = _escolher(self.intervalos, sexo, idade)
+		return tuple(math.nan if v is None else v for v in (baixo, alto, self.critico_baixo, self.critico_alto))
+
+
+def _normalizar(texto: str) -> str:
+	decomposto = unicodedata.normalize("NFKD", texto)
+	return "".join(c for c in decomposto if not unicodedata.combining(c)).lower().strip()
+
+
+def _numero(texto: str) -> float:
+	return float(texto.replace(",", "."))
+
+
+def _valores(texto: str) -> Tuple[Optional[float], Optional[float]]:
+	"""Limites (baixo, alto) de "12 - 340", "< 200" ou "> 40"; (None, None) se não reconhecer."""
+	if m := _INTERVALO.match(texto):
+		return _numero(m.group(1)), _numero(m.group(2))
+	if m := _MAXIMO.match(texto):
+		return None, _numero(m.group(1))
+	if m := _MINIMO.match(texto):
+		return _numero(m.group(1)), None
+	return None, None
+
+
+def _sexo(palavras: set, h_e_homem: bool) -> Optional[str]:
+	if palavras & _SEXO_M:
+		return "M"
+	if palavras & _SEXO_F:
+		return "F"
+	if "m" in palavras:
+		return "F" if h_e_homem else "M"
+	return None
+
+
+def _idade(rotulo: str) -> Tuple[Optional[float], Optional[float]]:
+	unidades = {"anos": 1.0, "ano": 1.0, "meses": 1 / 12, "mes": 1 / 12, "dias": 1 / _DIAS_POR_ANO}
+	if m := re.search(r"(\d+)\s*(?:-|a)\s*(\d+)\s*(anos?|meses|mes|dias)", rotulo):
+		f = unidades[m.group(3)]
+		return int(m.group(1)) * f, int(m.group(2)) * f
+	if m := re.search(r"(?:>=?|≥|acima de|mais de)\s*(\d+)\s*(anos?|meses|mes|dias)", rotulo):
+		return int(m.group(1)) * unidades[m.group(2)], None
+	if m := re.search(r"(?:<=?|≤|abaixo de|menos de|ate)\s*(\d+)\s*(anos?|meses|mes|dias)", rotulo):
+		return None, int(m.group(1)) * unidades[m.group(2)]
+	if re.search(r"\badult", rotulo):
+		return 18.0, None
+	if re.search(r"\bcrianca", rotulo):
+		return None, 18.0
+	if re.search(r"\b(recem[- ]nascidos?|rn)\b", rotulo):
+		return None, 28 / _DIAS_POR_ANO
+	return None, None
+
+
+def _separar_rotulo(segmento: str) -> Tuple[str, str]:
+	"""("h", "13 - 17") de "h: 13 - 17" ou "h 13 - 17"; ("", segmento) sem rótulo."""
+	if ":" in segmento:
+		rotulo, valores = segmento.rsplit(":", 1)
+		return rotulo.strip(), valores.strip()
+	if _valores(segmento) == (None, None) and (m := _ROTULO_SEM_DOIS_PONTOS.match(segmento)):
+		return m.group(1).strip(), segmento[m.end():]
+	return "", segmento
+
+
+@lru_cache(maxsize=4096)
+def interpretar(texto: str) -> Referencia:
+	"""Converte o texto de valor_referencia numa Referencia (sem intervalos se nada for reconhecido)."""
+	critico_baixo = critico_alto = None
+	rotulados = []
+	for segmento in _SEPARADORES.split(_normalizar(texto or "")):
+		if not segmento:
+			continue
+		if m := _CRITICO.match(segmento):
+			for parte in re.split(r"\s+(?:ou|e)\s+|\s*,\s+", segmento[m.end():]):
+				baixo, alto = _valores(parte.strip())
+				if baixo is None and alto is not None:
+					critico_baixo = alto
+				elif baixo is not None and alto is None:
+					critico_alto = baixo
+			continue
+		rotulo, valores = _separar_rotulo(segmento)
+		rotulados.append((set(re.findall(r"[a-z]+", rotulo)), rotulo, valores))
+
+	# "M" é mulher quando o mesmo texto usa "H" para homem; caso contrário, masculino.
+	h_e_homem = any("h" in palavras for palavras, _, _ in rotulados)
+	intervalos = []
+	for palavras, rotulo, valores in rotulados:
+		baixo, alto = _valores(valores)
+		if baixo is None and alto is None:
+			continue
+		idade_min, idade_max = _idade(rotulo)
+		intervalos.append(Intervalo(_sexo(palavras, h_e_homem), idade_min, idade_max, baixo, alto))
+	return Referencia(tuple(intervalos), critico_baixo, critico_alto)
+
+
+def _escolher(intervalos, sexo, idade) -> Tuple[Optional[float], Optional[float]]:
+	"""Intervalo mais específico aplicável; sem nenhum, a união de todos."""
+	if not intervalos:
+		return None, None
+
+	def aplica(iv):
+		if iv.sexo is not None and iv.sexo != sexo:
+			return False
+		if iv.idade_min is None and iv.idade_max is None:
+			return True
+		if idade is None:
+			return False
+		return (iv.idade_min is None or idade >= iv.idade_min) and (iv.idade_max is None or idade < iv.idade_max)
+
+	candidatos = [iv for iv in intervalos if aplica(iv)]
+	if candidatos:
+		iv = max(candidatos, key=lambda iv: (iv.sexo is not None) + (iv.idade_min is not None or iv.idade_max is not None))
+		return iv.baixo, iv.alto
+	baixos = [iv.baixo for iv in intervalos]
+	altos = [iv.alto for iv in intervalos]
+	return (
+		None if None in baixos else min(baixos),
+		None if None in altos else max(altos),
+	)
+
+
+# ---------------------------------------------------------------------------
+# Avaliação em lote
+# ---------------------------------------------------------------------------
+def valor_numerico(resultado) -> float:
+	"""Valor do resultado como float (NaN se não for numérico); aceita vírgula decimal."""
+	try:
+		return float(str(resultado).strip().replace(",", "."))
+	except (TypeError, ValueError):
+		return math.nan
+
+
+def avaliar(valores, baixo, alto, critico_baixo, critico_alto) -> np.ndarray:
+	"""
+	Classifica um lote de valores contra os limites (arrays do mesmo tamanho,
+	NaN = sem valor ou sem limite). Devolve um array de "", "N", "L", "H", "LL", "HH".
+	"""
+	valores = np.asarray(valores, dtype=float)
+	baixo, alto, critico_baixo, critico_alto = (np.asarray(a, dtype=float) for a in (baixo, alto, critico_baixo, critico_alto))
+	sinais = np.full(valores.shape, "", dtype="<U2")
+	numerico = ~np.isnan(valores)
+	with np.errstate(invalid="ignore"):
+		sinais[numerico & ~(np.isnan(baixo) & np.isnan(alto))] = "N"
+		sinais[numerico & (valores < baixo)] = "L"
+		sinais[numerico & (valores > alto)] = "H"
+		sinais[numerico & (valores < critico_baixo)] = "LL"
+		sinais[numerico & (valores > critico_alto)] = "HH"
+	return sinais
+
+
+def idade_em_anos(data_nascimento, referencia=None) -> Optional[float]:
+	if not data_nascimento:
+		return None
+	if isinstance(referencia, datetime):
+		referencia = referencia.date()
+	return ((referencia or date.today()) - data_nascimento).days / _DIAS_POR_ANO
+
+
+def texto_referencia(ri, cat=None) -> str:
+	"""Texto de referência do resultado: o do campo `referencia`, se definido, senão o do exame_campo."""
+	cat = cat or catalogo.obter()
+	if ri.referencia_id:
+		campo = cat.campo(ri.referencia_id)
+		if campo is not None and campo.valor_referencia:
+			return campo.valor_referencia
+	campo = cat.campo(ri.exame_campo_id) or ri.exame_campo
+	return campo.valor_referencia or ""
+
+
+def sinalizar(resultados: Iterable, requisicao=None) -> list:
+	"""
+	Define `ri.sinal` em cada ResultadoItem e devolve-os numa lista.
+
+	O sexo e a idade (à data da requisição) vêm de `requisicao.paciente`
+	quando todos os resultados são da mesma requisição; senão, de
+	ri.requisicao.paciente de cada um (convém um select_related).
+	Os textos de referência vêm do catálogo em cache.
+	"""
+	resultados = list(resultados)
+	if not resultados:
+		return resultados
+	cat = catalogo.obter()
+	limites = np.empty((len(resultados), 4))
+	memo = {}
+	for i, ri in enumerate(resultados):
+		req = requisicao if requisicao is not None else ri.requisicao
+		sexo = req.paciente.genero or None
+		idade = idade_em_anos(req.paciente.data_nascimento, req.created_at)
+		chave = (texto_referencia(ri, cat), sexo, idade)
+		if chave not in memo:
+			memo[chave] = interpretar(chave[0]).limites(sexo, idade)
+		limites[i] = memo[chave]
+	# ResultadoItem.valor_numerico já traz o resultado convertido (None -> NaN)
+	valores = np.array([ri.valor_numerico for ri in resultados], dtype=float)
+	for ri, sinal in zip(resultados, avaliar(valores, *limites.T)):
+		ri.sinal = str(sinal)
+	return resultados
@@ -0,0 +1,62 @@
+"""
+lab.utils.resultados
+--------------------
+
+Materialização dos ResultadoItem de uma requisição.
+
+Em vez de percorrer exames × campos com get_or_create (uma consulta e um
+save() por campo), calcula numa única consulta os campos que ainda não têm
+resultado e insere-os de uma vez com bulk_create, usando um bloco de códigos
+id_custom reservado previamente. O contador n_resultados da requisição é
+actualizado no mesmo passo (bulk_create não envia sinais) com o número de
+linhas realmente inseridas.
+"""
+
+from typing import Iterable, Optional
+
+from lab.models import ExameCampo, RequisicaoAnalise, ResultadoItem, reservar_codigos
+
+
+def campos_em_falta(requisicao, exames: Optional[Iterable] = None) -> list:
+	"""
+	Devolve os ids dos ExameCampo dos exames da requisição que ainda não
+	têm ResultadoItem (diferença de conjuntos resolvida na base de dados).
+
+	:param requisicao: instância de RequisicaoAnalise
+	:param exames: limita a estes exames (instâncias ou ids); por omissão todos os da requisição
+	"""
+	if exames is None:
+		campos = ExameCampo.objects.filter(exame__requisicoes=requisicao)
+	else:
+		campos = ExameCampo.objects.filter(exame__in=exames)
+	existentes = ResultadoItem.objects.filter(requisicao=requisicao).values("exame_campo_id")
+	return list(campos.exclude(id__in=existentes).values_list("id", flat=True))
+
+
+def materializar_resultados(requisicao, exames: Optional[Iterable] = None, em_falta: Optional[Iterable] = None) -> int:
+	"""
+	Cria os ResultadoItem em falta para a requisição com um único bulk_create.
+
+	:param requisicao: instância de RequisicaoAnalise
+	:param exames: limita a estes exames (instâncias ou ids); por omissão todos os da requisição
+	:param em_falta: ids dos ExameCampo em falta, se já conhecidos (dispensa campos_em_falta)
+	:returns: número de resultados criados
+	"""
+	em_falta = campos_em_falta(requisicao, exames) if em_falta is None else list(em_falta)
+	if not em_falta:
+		return 0
+
+	codigos = reservar_codigos(ResultadoItem.prefixo, len(em_falta))
+	ResultadoItem.objects.bulk_create(
+		[
+			ResultadoItem(requisicao=requisicao, exame_campo_id=campo_id, id_custom=codigo)
+			for campo_id, codigo in zip(em_falta, codigos)
+		],
+		ignore_conflicts=True,
+	)
+	# com ignore_conflicts, os campos criados entretanto por outra transacção ficam de fora:
+	# contam-se as linhas inseridas, reconhecidas pelos códigos reservados acima
+	criados = ResultadoItem.objects.filter(requisicao=requisicao, id_custom__in=codigos).count()
+	if criados:
+		RequisicaoAnalise.objects.filter(pk=requisicao.pk).ajustar_contadores(resultados=criados)
+	return criados
@@ -0,0 +1,204 @@
+"""
+lab.utils.resumos
+-----------------
+
+Resumos diários de volume e tempo de resposta (TRL) por exame
+(ResumoDiarioExame), para o painel do admin e o endpoint JSON.
+
+Calcular o TRL sobre todo o histórico a cada pedido seria lento, por isso
+os agregados são gravados por dia e exame. O dia é o dia local da criação
+da requisição. Cada par (requisição, exame) conta uma vez no volume; fica
+concluído quando todos os seus resultados estão validados e o seu TRL vai
+da criação da requisição à última data_validacao. A mediana e o p95
+(interpolação linear, como percentile_cont) são calculados com NumPy sobre
+os pares de cada dia; o que vem da base de dados já vem agregado por par.
+
+actualizar() é incremental: recalcula só os dias com requisições ou
+resultados alterados (updated_at / atualizado_em) desde o início da
+execução anterior, menos MARGEM. Essa hora fica na MarcaActualizacao
+"resumos_diarios" e só actualizar() a avança; recalcular() de dias avulsos
+(calcular_resumos_diarios --dia) não a muda, para não saltar alterações de
+outros dias. Cada dia é apagado e regravado na mesma transacção.
+"""
+
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from lab.models import MarcaActualizacao, RequisicaoAnalise, ResultadoItem, ResumoDiarioExame
+from lab.utils import catalogo
+
+TAREFA = "resumos_diarios"
+MARGEM = timedelta(minutes=5)
+DIAS_POR_BLOCO = 31
+DIAS_PAINEL = 30
+
+
+def _inicio_do_dia(dia: date) -> datetime:
+	return timezone.make_aware(datetime.combine(dia, time.min))
+
+
+def _dias(requisicoes) -> set:
+	tz = timezone.get_current_timezone()
+	return set(requisicoes.annotate(dia=TruncDate("created_at", tzinfo=tz)).values_list("dia", flat=True).distinct())
+
+
+def dias_alterados(desde: datetime) -> set:
+	"""Dias (locais) das requisições alteradas, ou com resultados alterados, depois de `desde`."""
+	alteradas = RequisicaoAnalise.objects.order_by().filter(updated_at__gt=desde)
+	com_resultados = RequisicaoAnalise.objects.order_by().filter(
+		id__in=ResultadoItem.objects.filter(atualizado_em__gt=desde).values("requisicao_id")
+	)
+	return _dias(alteradas) | _dias(com_resultados)
+
+
+def _blocos(dias: Iterable[date]) -> Iterator[list]:
+	"""Divide os dias em sequências de dias consecutivos, com até DIAS_POR_BLOCO dias cada."""
+	bloco = []
+	for dia in sorted(set(dias)):
+		if bloco and (dia - bloco[-1] != timedelta(days=1) or len(bloco) == DIAS_POR_BLOCO):
+			yield bloco
+			bloco = []
+		bloco.append(dia)
+	if bloco:
+		yield bloco
+
+
+def _resumos(primeiro: date, ultimo: date, calculado_em: datetime) -> list:
+	"""ResumoDiarioExame (por gravar) de todos os dias locais de `primeiro` a `ultimo`, inclusive."""
+	pares = (
+		ResultadoItem.objects.order_by()
+		.filter(
+			requisicao__created_at__gte=_inicio_do_dia(primeiro),
+			requisicao__created_at__lt=_inicio_do_dia(ultimo + timedelta(days=1)),
+		)
+		.values("requisicao_id", "exame_campo__exame_id")
+		.annotate(
+			criada=Min("requisicao__created_at"),
+			n=Count("id"),
+			n_validados=Count("id", filter=Q(validado=True)),
+			ultima_validacao=Max("data_validacao"),
+		)
+	)
+	volume = defaultdict(int)
+	trl = defaultdict(list)
+	for par in pares:
+		dia = timezone.localdate(par["criada"])
+		chave = (dia, par["exame_campo__exame_id"])
+		volume[chave] += 1
+		if par["n_validados"] == par["n"] and par["ultima_validacao"] is not None:
+			trl[chave].append((par["ultima_validacao"] - par["criada"]).total_seconds() / 3600)
+
+	cat = catalogo.obter()
+	resumos = []
+	for (dia, exame_id), n in volume.items():
+		exame = cat.exame(exame_id)
+		horas = np.array(trl[(dia, exame_id)], dtype=float)
+		mediana, p95 = np.percentile(horas, [50, 95]) if horas.size else (None, None)
+		resumos.append(ResumoDiarioExame(
+			dia=dia,
+			setor=exame.setor if exame else "",
+			exame_id=exame_id,
+			volume=n,
+			validados=int(horas.size),
+			trl_mediana_h=None if mediana is None else round(float(mediana), 2),
+			trl_p95_h=None if p95 is None else round(float(p95), 2),
+			fora_trl=int((horas > exame.trl_horas).sum()) if exame else 0,
+			calculado_em=calculado_em,
+		))
+	return resumos
+
+
+def recalcular(dias: Iterable[date], calculado_em: Optional[datetime] = None) -> int:
+	"""Recalcula e regrava os resumos dos dias indicados; devolve o número de linhas gravadas."""
+	calculado_em = calculado_em or timezone.now()
+	gravados = 0
+	# um intervalo por sequência de dias consecutivos: dias alterados espalhados
+	# não arrastam a leitura de todas as requisições entre eles
+	for bloco in _blocos(dias):
+		resumos = _resumos(bloco[0], bloco[-1], calculado_em)
+		with transaction.atomic():
+			ResumoDiarioExame.objects.filter(dia__gte=bloco[0], dia__lte=bloco[-1]).delete()
+			ResumoDiarioExame.objects.bulk_create(resumos)
+		gravados += len(resumos)
+	return gravados
+
+
+def actualizar(completo: bool = False) -> dict:
+	"""
+	Recalcula os dias alterados desde a última execução (ou todos, com
+	completo=True ou na primeira execução). Devolve {"dias", "linhas"}.
+	"""
+	inicio = timezone.now()
+	ultima = None if completo else MarcaActualizacao.objects.filter(tarefa=TAREFA).values_list("ate", flat=True).first()
+	if ultima is None:
+		dias = _dias(RequisicaoAnalise.objects.order_by())
+		# dias que deixaram de ter requisições não ficam com resumos antigos
+		ResumoDiarioExame.objects.exclude(dia__in=dias).delete()
+	else:
+		dias = dias_alterados(ultima - MARGEM)
+	linhas = recalcular(dias, inicio)
+	# só depois de todos os dias gravados: uma execução interrompida repete-se
+	MarcaActualizacao.objects.update_or_create(tarefa=TAREFA, defaults={"ate": inicio})
+	return {"dias": len(dias), "linhas": linhas}
+
+
+# ---------------------------------------------------------------------------
+# Leitura (painel e endpoint JSON)
+# ---------------------------------------------------------------------------
+def painel(desde: Optional[date] = None, ate: Optional[date] = None, setor: Optional[str] = None) -> dict:
+	"""
+	Totais do período por setor e por exame e a série diária, lidos só dos
+	resumos. O TRL de um período é a média dos valores diários pesada pelas
+	requisições concluídas em cada dia (não a mediana exacta do período).
+	"""
+	ate = ate or timezone.localdate()
+	desde = desde or ate - timedelta(days=DIAS_PAINEL - 1)
+	qs = ResumoDiarioExame.objects.order_by().filter(dia__gte=desde, dia__lte=ate)
+	if setor:
+		qs = qs.filter(setor=setor)
+
+	def totais(*campos) -> list:
+		linhas = []
+		agregados = qs.values(*campos).annotate(
+			volume_total=Sum("volume"),
+			validados_total=Sum("validados"),
+			fora_trl_total=Sum("fora_trl"),
+			trl_mediana_pesada=Sum(F("trl_mediana_h") * F("validados")),
+			trl_p95_pesada=Sum(F("trl_p95_h") * F("validados")),
+		).order_by(*campos)
+		for v in agregados:
+			validados = v["validados_total"] or 0
+			linhas.append({
+				**{c: v[c] for c in campos},
+				"volume": v["volume_total"] or 0,
+				"validados": validados,
+				"fora_trl": v["fora_trl_total"] or 0,
+				"trl_mediana_h": round(v["trl_mediana_pesada"] / validados, 2) if validados else None,
+				"trl_p95_h": round(v["trl_p95_pesada"] / validados, 2) if validados else None,
+			})
+		return linhas
+
+	cat = catalogo.obter()
+	exames = totais("setor", "exame_id")
+	for item in exames:
+		exame = cat.exame(item["exame_id"])
+		item["exame"] = exame.nome if exame else None
+		item["trl_horas"] = exame.trl_horas if exame else None
+	dias = totais("dia")
+	for item in dias:
+		item["dia"] = item["dia"].isoformat()
+	return {
+		"desde": desde.isoformat(),
+		"ate": ate.isoformat(),
+		"setor": setor,
+		"setores": totais("setor"),
+		"exames": exames,
+		"dias": dias,
+	}
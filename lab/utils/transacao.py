@@ -0,0 +1,103 @@
+"""
+lab.utils.transacao
+-------------------
+
+Trabalho acumulado durante uma transacção e feito uma só vez no commit.
+
+	acumular_no_commit("pdf_cache", requisicao_id, invalidar_todas, criar=set)
+
+Na primeira chamada em cada nível da transacção (o bloco atómico exterior
+ou um savepoint) cria o acumulador (criar()) e regista um callback em
+transaction.on_commit; as chamadas seguintes no mesmo nível só lhe juntam o
+item. No commit, cada callback recebe o seu acumulador inteiro. Fora de um
+bloco atómico o callback corre logo, só com o item.
+
+Um acumulador por nível acompanha as regras do on_commit do Django: se um
+savepoint for revertido, o callback registado nele é descartado e, com ele,
+os itens juntados nesse savepoint; os dos níveis exteriores continuam.
+
+O registo fica num WeakKeyDictionary na própria ligação (uma por thread),
+indexado pelo bloco atómico de cada nível e validado pelo id do savepoint,
+que o Django nunca repete na mesma ligação. O nível exterior não tem
+savepoint: a sua entrada é retirada pelo próprio callback no commit; se a
+transacção for revertida, fica até o bloco ser libertado ou até à próxima
+chamada fora de uma transacção.
+"""
+
+import weakref
+from typing import Any, Callable, List, Optional, Tuple
+
+from django.db import connection, transaction
+
+_ATRIBUTO = "_lab_no_commit"
+
+
+def _registo() -> "weakref.WeakKeyDictionary":
+	"""{bloco atómico: {chave: (savepoint, acumulador)}} desta ligação."""
+	registo = getattr(connection, _ATRIBUTO, None)
+	if registo is None:
+		registo = weakref.WeakKeyDictionary()
+		setattr(connection, _ATRIBUTO, registo)
+	return registo
+
+
+def _niveis() -> List[Tuple[Any, Optional[str]]]:
+	"""(bloco, savepoint) de cada nível da transacção actual, do exterior para o interior."""
+	blocos = connection.atomic_blocks
+	sids = connection.savepoint_ids[len(connection.savepoint_ids) - len(blocos) + 1:] if len(blocos) > 1 else []
+	# blocos com savepoint=False pertencem ao nível que os contém
+	return [(blocos[0], None)] + [(bloco, sid) for bloco, sid in zip(blocos[1:], sids) if sid is not None]
+
+
+def pendente(chave: str) -> Optional[Any]:
+	"""Acumulador de `chave` mais interior ainda por confirmar na transacção actual, ou None."""
+	if not connection.in_atomic_block:
+		return None
+	registo = _registo()
+	for bloco, sid in reversed(_niveis()):
+		estado = registo.get(bloco, {}).get(chave)
+		if estado is not None and estado[0] == sid:
+			return estado[1]
+	return None
+
+
+def _juntar(acumulador, item) -> None:
+	if item is None:
+		return
+	if isinstance(acumulador, list):
+		acumulador.append(item)
+	else:
+		acumulador.add(item)
+
+
+def acumular_no_commit(chave: str, item, callback: Callable[[Any], None], criar: Callable[[], Any] = list) -> Any:
+	"""
+	Junta `item` ao acumulador de `chave` do nível actual da transacção e
+	garante que callback(acumulador) corre uma vez no commit. Devolve o
+	acumulador.
+
+	:param item: valor a juntar (append numa lista, add num conjunto); None não junta nada
+	:param criar: fábrica do acumulador (list, set, dict, ...)
+	"""
+	if not connection.in_atomic_block:
+		setattr(connection, _ATRIBUTO, None)
+		acumulador = criar()
+		_juntar(acumulador, item)
+		callback(acumulador)
+		return acumulador
+
+	bloco, sid = _niveis()[-1]
+	estados = _registo().setdefault(bloco, {})
+	estado = estados.get(chave)
+	if estado is None or estado[0] != sid:
+		acumulador = criar()
+		estado = estados[chave] = (sid, acumulador)
+
+		def confirmar():
+			if estados.get(chave) is estado:
+				del estados[chave]
+			callback(acumulador)
+
+		transaction.on_commit(confirmar)
+	_juntar(estado[1], item)
+	return estado[1]
@@ -0,0 +1,81 @@
+"""
+lab.utils.validacao
+-------------------
+
+Validação em massa de resultados.
+
+Valida todos os resultados pendentes de uma ou várias requisições com um
+único UPDATE sobre as linhas bloqueadas antes (SELECT ... FOR UPDATE),
+regista um evento de histórico agregado por requisição e actualiza, na
+mesma transacção, os contadores n_validados; as requisições
+em que n_validados chega a n_resultados passam a "VAL". Usado pela view de
+validação, pelo admin e pela API.
+"""
+
+from collections import Counter
+from typing import Iterable, Optional
+
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, When
+from django.utils import timezone
+
+from lab.models import RequisicaoAnalise, ResultadoItem
+from lab.utils import historico_paciente, pdf_cache
+from lab.utils.auditoria import registar_evento
+
+
+def validar_requisicoes(requisicoes: Iterable, usuario, resultados: Optional[Iterable] = None) -> int:
+	"""
+	Valida os resultados pendentes das requisições indicadas.
+
+	:param requisicoes: queryset, instâncias ou ids de RequisicaoAnalise
+	:param usuario: utilizador que valida
+	:param resultados: limita a estes ResultadoItem (queryset ou ids); por omissão todos
+	:returns: número de resultados validados
+	"""
+	if isinstance(requisicoes, RequisicaoAnalise):
+		requisicoes = [requisicoes]
+	ids_requisicoes = [getattr(r, "pk", r) for r in requisicoes]
+	if not ids_requisicoes:
+		return 0
+
+	pendentes = ResultadoItem.objects.filter(requisicao_id__in=ids_requisicoes, validado=False)
+	if resultados is not None:
+		pendentes = pendentes.filter(id__in=resultados)
+
+	agora = timezone.now()
+	with transaction.atomic():
+		# bloqueia os pendentes antes de contar: uma validação concorrente espera pelo commit desta e,
+		# se confirmar primeiro, os resultados que validou já não entram aqui nem nos contadores
+		bloqueados = list(pendentes.select_for_update().order_by("id").values_list("id", "requisicao_id"))
+		por_requisicao = Counter(requisicao_id for _, requisicao_id in bloqueados)
+		total = ResultadoItem.objects.filter(id__in=[pk for pk, _ in bloqueados]).update(
+			validado=True, validado_por=usuario, data_validacao=agora, atualizado_em=agora
+		)
+
+		if por_requisicao:
+			RequisicaoAnalise.objects.filter(id__in=por_requisicao).update(n_validados=Case(
+				*(When(id=requisicao_id, then=F("n_validados") + n) for requisicao_id, n in por_requisicao.items()),
+				default=F("n_validados"),
+				output_field=PositiveIntegerField(),
+			))
+		# só passa a "VAL" a requisição que já não tem resultados pendentes
+		RequisicaoAnalise.objects.filter(
+			id__in=ids_requisicoes, n_resultados__gt=0, n_validados__gte=F("n_resultados")
+		).exclude(status="VAL").update(status="VAL", updated_at=agora)
+
+		data = timezone.localtime(agora).strftime('%d/%m/%Y %H:%M')
+		for requisicao_id, n in por_requisicao.items():
+			registar_evento(
+				requisicao_id,
+				"Validação de Resultados",
+				"{n} resultado(s) validado(s) por {validador} em {data}.",
+				utilizador_id=usuario.pk,
+				validador_id=usuario.pk,
+				n=n,
+				data=data,
+			)
+		for requisicao_id in ids_requisicoes:
+			pdf_cache.invalidar_no_commit(requisicao_id)
+			historico_paciente.invalidar_no_commit(requisicao_id)
+	return total
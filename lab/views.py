@@ -1,9 +1,14 @@
 from django.shortcuts import get_object_or_404, render, redirect
 from django import forms
 from django.db import transaction
-from django.http import HttpResponse
-from .models import RequisicaoAnalise, ResultadoItem, ExameCampo
-from .utils.pdf_generator import gerar_pdf_requisicao, gerar_pdf_resultados
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.contrib.auth.decorators import login_required
+from django.urls import reverse
+from django.utils.dateparse import parse_date
+from django.views.decorators.http import require_POST
+from .models import RequisicaoAnalise, ResultadoItem
+from .utils import cache_partilhada, folha_trabalho, historico_paciente, pdf_cache, pdf_jobs, pdf_lote, referencias, resumos
+from .utils.validacao import validar_requisicoes
 
 
 <<<<<<< HEAD
@@ -139,24 +144,9 @@ def preencher_resultados(request, requisicao_id):
 	Exibe apenas os campos dos exames selecionados na requisição
 	e permite preencher os valores.
 	"""
-	requisicao = get_object_or_404(RequisicaoAnalise, id=requisicao_id)
-
-	# Filtra apenas os exames escolhidos
-	exames_selecionados = requisicao.exames.all()
-	exames_campos = ExameCampo.objects.filter(exame__in=exames_selecionados)
-
-	# Cria ou obtém ResultadoItem apenas para esses exames_campos
-	for campo in exames_campos:
-		ResultadoItem.objects.get_or_create(
-			requisicao=requisicao,
-			exame_campo=campo
-		)
-
-	# Agora busca apenas os resultados coerentes
-	resultado_items = ResultadoItem.objects.filter(
-		requisicao=requisicao,
-		exame_campo__in=exames_campos
-	).select_related('exame_campo', 'exame_campo__exame')
+	# requisição, exames, campos e resultados (os em falta são criados de uma só vez)
+	folha = folha_trabalho.obter(request, requisicao_id, materializar=True)
+	resultado_items = folha.resultados
 
 	if request.method == "POST":
 		form = ResultadosDinamicosForm(resultado_items, request.POST)
@@ -166,17 +156,17 @@ def preencher_resultados(request, requisicao_id):
 					key = f"ri_{ri.id}"
 					ri.resultado = form.cleaned_data.get(key, "")
 					ri.save()
-			return redirect("lab:revisar_resultados", requisicao_id=requisicao.id)
+			return redirect("lab:revisar_resultados", requisicao_id=folha.requisicao.id)
 	else:
 		form = ResultadosDinamicosForm(resultado_items)
 
-	# Agrupa por exame
-	grouped = {}
+	# Agrupa por exame, com o campo do formulário de cada resultado
+	grouped = folha.agrupados()
 	for ri in resultado_items:
-		grouped.setdefault(ri.exame_campo.exame.nome, []).append(ri)
+		ri.campo_form = form[f"ri_{ri.id}"]
 
 	return render(request, "lab/preencher_resultados.html", {
-		"requisicao": requisicao,
+		"requisicao": folha.requisicao,
 		"form": form,
 		"grouped": grouped,
 	})
@@ -187,19 +177,16 @@ def revisar_resultados(request, requisicao_id):
 	"""
 	Mostra todos os resultados preenchidos antes da validação.
 	"""
-	requisicao = get_object_or_404(RequisicaoAnalise, id=requisicao_id)
-	resultado_items = ResultadoItem.objects.filter(
-		requisicao=requisicao,
-		exame_campo__exame__in=requisicao.exames.all()
-	).select_related('exame_campo', 'exame_campo__exame')
-
-	grouped = {}
-	for ri in resultado_items:
-		grouped.setdefault(ri.exame_campo.exame.nome, []).append(ri)
+	folha = folha_trabalho.obter(request, requisicao_id)
+	# sinal H/L (e HH/LL críticos) de todos os resultados de uma vez
+	referencias.sinalizar(folha.resultados, folha.requisicao)
+	# valores anteriores do paciente para o controlo delta (uma consulta)
+	historico_paciente.ligar_anteriores(folha.resultados, folha.requisicao)
 
 	return render(request, "lab/revisar_resultados.html", {
-		"requisicao": requisicao,
-		"grouped": grouped,
+		"requisicao": folha.requisicao,
+		"grouped": folha.agrupados(),
+		"progresso": folha.progresso,
 	})
 
 
@@ -208,26 +195,20 @@ def validar_resultados_view(request, requisicao_id):
 	"""
 	Marca todos os resultados como validados pelo utilizador autenticado.
 	"""
-	requisicao = get_object_or_404(RequisicaoAnalise, id=requisicao_id)
-	resultado_items = ResultadoItem.objects.filter(
-		requisicao=requisicao,
-		exame_campo__exame__in=requisicao.exames.all()
-	)
+	folha = folha_trabalho.obter(request, requisicao_id)
 
 	if request.method == "POST":
-		with transaction.atomic():
-			for ri in resultado_items:
-				ri.validar(request.user)
-			requisicao.marcar_validada()
+		# um único UPDATE para todos os resultados + estado da requisição
+		validar_requisicoes([folha.requisicao], request.user, resultados=[ri.pk for ri in folha.resultados])
 		return redirect("admin:lab_requisicaoanalise_changelist")
 
-	grouped = {}
-	for ri in resultado_items:
-		grouped.setdefault(ri.exame_campo.exame.nome, []).append(ri)
+	referencias.sinalizar(folha.resultados, folha.requisicao)
+	historico_paciente.ligar_anteriores(folha.resultados, folha.requisicao)
 
 	return render(request, "lab/revisar_resultados.html", {
-		"requisicao": requisicao,
-		"grouped": grouped,
+		"requisicao": folha.requisicao,
+		"grouped": folha.agrupados(),
+		"progresso": folha.progresso,
 	})
 
 
@@ -241,10 +222,8 @@ def pdf_requisicao(request, requisicao_id):
 		RequisicaoAnalise.objects.select_related("paciente"),
 		id=requisicao_id
 	)
-	pdf_bytes, filename = gerar_pdf_requisicao(requisicao)
-	response = HttpResponse(pdf_bytes, content_type="application/pdf")
-	response["Content-Disposition"] = f'attachment; filename="{filename}"'
-	return response
+	ficheiro, filename = pdf_cache.abrir_pdf_requisicao(requisicao)
+	return FileResponse(ficheiro, as_attachment=True, filename=filename, content_type="application/pdf")
 
 
 def pdf_resultados(request, requisicao_id):
@@ -256,10 +235,110 @@ def pdf_resultados(request, requisicao_id):
 		RequisicaoAnalise.objects.select_related("paciente"),
 		id=requisicao_id
 	)
-	pdf_bytes, filename = gerar_pdf_resultados(requisicao, apenas_validados=True)
-	response = HttpResponse(pdf_bytes, content_type="application/pdf")
-	response["Content-Disposition"] = f'attachment; filename="{filename}"'
-	return response
+	ficheiro, filename = pdf_cache.abrir_pdf_resultados(requisicao, apenas_validados=True)
+	return FileResponse(ficheiro, as_attachment=True, filename=filename, content_type="application/pdf")
+
+
+# ========================== PDFs EM SEGUNDO PLANO ==========================
+def _estado_trabalho(request, job_id, dados):
+	dados = dict(dados)
+	dados["estado_url"] = request.build_absolute_uri(reverse("lab:pdf_trabalho_estado", args=[job_id]))
+	if dados.get("estado") == "concluido":
+		dados["download_url"] = request.build_absolute_uri(reverse("lab:pdf_trabalho_download", args=[job_id]))
+	return dados
+
+
+@login_required
+@require_POST
+def pdf_trabalho_criar(request, requisicao_id, tipo):
+	"""
+	Submete a geração do PDF ao pool de processos e devolve o id do trabalho.
+	Responde 503 se a fila de renderização estiver cheia.
+	"""
+	get_object_or_404(RequisicaoAnalise, id=requisicao_id)
+	try:
+		job_id = pdf_jobs.submeter(tipo, requisicao_id, apenas_validados=True)
+	except ValueError:
+		raise Http404("Tipo de PDF desconhecido.")
+	except pdf_jobs.FilaCheia as e:
+		return JsonResponse({"erro": str(e)}, status=503, headers={"Retry-After": "5"})
+	return JsonResponse(_estado_trabalho(request, job_id, pdf_jobs.estado(job_id)), status=202)
+
+
+@login_required
+def pdf_trabalho_estado(request, job_id):
+	"""Estado do trabalho de PDF (para polling)."""
+	dados = pdf_jobs.estado(job_id)
+	if dados is None:
+		raise Http404("Trabalho não encontrado.")
+	return JsonResponse(_estado_trabalho(request, job_id, dados))
+
+
+@login_required
+def pdf_trabalho_download(request, job_id):
+	"""Entrega em streaming o PDF de um trabalho concluído."""
+	dados = pdf_jobs.estado(job_id)
+	caminho = pdf_jobs.caminho_pdf(job_id)
+	if dados is None or caminho is None:
+		raise Http404("PDF ainda não disponível.")
+	try:
+		# a limpeza periódica pode ter apagado o trabalho entretanto
+		ficheiro = open(caminho, "rb")
+	except OSError:
+		raise Http404("PDF ainda não disponível.")
+	filename = dados.get("filename", f"{job_id}.pdf")
+	return FileResponse(ficheiro, as_attachment=True, filename=filename, content_type="application/pdf")
+
+
+@login_required
+def pdf_lote_exportar(request, tipo):
+	"""
+	Exporta os PDFs de várias requisições (?ids=1,2,3) num ZIP em streaming
+	ou, com ?formato=pdf, num único PDF com numeração por paciente.
+	"""
+	try:
+		ids = [int(pk) for pk in request.GET.get("ids", "").split(",") if pk.strip()]
+	except ValueError:
+		return JsonResponse({"erro": "Parâmetro ids inválido."}, status=400)
+	if not ids:
+		return JsonResponse({"erro": "Indique as requisições em ?ids=."}, status=400)
+	formato = request.GET.get("formato", "zip")
+	if formato == "pdf" and pdf_lote.PdfWriter is None:
+		return JsonResponse({"erro": "Exportação em PDF único indisponível (pypdf não instalado)."}, status=501)
+	try:
+		return pdf_lote.exportar(ids, tipo, formato)
+	except pdf_lote.LoteGrande as e:
+		return JsonResponse({"erro": str(e)}, status=413)
+	except ValueError as e:
+		raise Http404(str(e))
+
+
+@login_required
+def pdf_trabalhos_metricas(request):
+	"""Métricas do pool de renderização deste processo."""
+	return JsonResponse(pdf_jobs.metricas())
+
+
+@login_required
+def cache_estatisticas(request):
+	"""Acertos/falhas da cache partilhada por espaço (todos os processos)."""
+	return JsonResponse(cache_partilhada.estatisticas())
+
+
+@login_required
+def painel_trl_dados(request):
+	"""
+	Volume e TRL por setor, exame e dia, lidos dos resumos diários
+	(?desde=&ate= AAAA-MM-DD, por omissão os últimos 30 dias; ?setor=).
+	"""
+	datas = {}
+	for nome in ("desde", "ate"):
+		valor = request.GET.get(nome)
+		if valor:
+			datas[nome] = parse_date(valor)
+			if datas[nome] is None:
+				return JsonResponse({"erro": f"{nome} deve ser uma data AAAA-MM-DD"}, status=400)
+	return JsonResponse(resumos.painel(setor=request.GET.get("setor") or None, **datas))
 
 
 def inserir_resultados(request):
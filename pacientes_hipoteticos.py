@@ -11,7 +11,7 @@ from django.utils import timezone
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")  # ajuste conforme o projeto
 django.setup()
 
-from lab.models import Paciente  # modelo
+from lab.models import Paciente, reservar_codigos  # modelo
 
 # =====================================
 # GERADOR DE PACIENTES FALSOS
@@ -25,16 +25,10 @@ generos = ["M", "F"]
 def gerar_pacientes(qtd=5000):
     print(f"🧬 Gerando {qtd} pacientes hipotéticos...")
 
-    hoje_str = timezone.now().strftime("%Y%m%d")
-    # último código do dia
-    ultimo = Paciente.objects.filter(id_custom__startswith=f"PAC{hoje_str}") \
-                             .order_by('id_custom').last()
-    if ultimo:
-        ultima_ordem = int(ultimo.id_custom[-4:])
-    else:
-        ultima_ordem = 0
+    # reserva de uma só vez o bloco de códigos do dia
+    codigos = reservar_codigos(Paciente.prefixo, qtd)
 
-    for i in range(1, qtd + 1):
+    for i, id_custom in enumerate(codigos, start=1):
         nome = f"{fake.first_name()} {fake.last_name()}"
         numero_id = f"ID{Paciente.objects.count() + i:06d}"
         data_nascimento = fake.date_of_birth(minimum_age=1, maximum_age=90)
@@ -42,9 +36,6 @@ def gerar_pacientes(qtd=5000):
         contacto = f"+2588{random.randint(20000000, 99999999)}"
         proveniencia = random.choice(proveniencias)
 
-        ordem = ultima_ordem + i
-        id_custom = f"PAC{hoje_str}{ordem:04d}"
-
         paciente = Paciente(
             id_custom=id_custom,
             nome=nome,
@@ -9,6 +9,7 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")  # ajuste co
 django.setup()
 
 from lab.models import RequisicaoAnalise, ResultadoItem, ExameCampo
+from lab.utils.resultados import materializar_resultados
 from django.contrib.auth import get_user_model
 
 fake = Faker('pt_PT')
@@ -23,24 +24,8 @@ def gerar_resultados_para_requisicoes(limit=None):
     total_criados = 0
     print(f"🧾 Gerando resultados para {reqs.count()} requisições...")
     for req in reqs:
-        # para cada exame vinculado, criar ResultadoItem para cada campo do exame
-        exames = req.exames.all()
-        for exame in exames:
-            campos = exame.campos.all()
-            for campo in campos:
-                # get_or_create evita duplicação se o script for rodado novamente
-                obj, created = ResultadoItem.objects.get_or_create(
-                    requisicao=req,
-                    exame_campo=campo,
-                    defaults={
-                        'resultado': "",
-                        'validado': False
-                    }
-                )
-                if created:
-                    # salvar garante que o id_custom seja gerado se usar o mixin
-                    obj.save()
-                    total_criados += 1
+        # cria apenas os ResultadoItem em falta (seguro se o script for rodado novamente)
+        total_criados += materializar_resultados(req)
     print(f"✅ {total_criados} ResultadoItem criados/garantidos. Total de resultados na base: {ResultadoItem.objects.count()}")
 
 if __name__ == "__main__":